@@ -0,0 +1,80 @@
+import json
+import os
+
+# Limits on a single batch input file
+MAX_REQUESTS_PER_SHARD = 50000
+MAX_BYTES_PER_SHARD = 190 * 1024 * 1024
+
+CHAT_COMPLETIONS_URL = "/chat/completions"
+
+def custom_id(prompt_idx):
+    """
+    Stable id of the request for a prompt, independent of shard layout and run time.
+    """
+    return f"prompt-{prompt_idx}"
+
+def prompt_idx_from_custom_id(request_id):
+    return int(request_id.split("-")[-1])
+
+class BatchRequestWriter:
+    """
+    Writes chat completion requests in batch API input format, rolling over to a new shard
+    whenever the request count or size limit of a batch input file would be exceeded.
+    """
+    def __init__(self, folder, file_prefix, model_name, max_requests=MAX_REQUESTS_PER_SHARD, max_bytes=MAX_BYTES_PER_SHARD):
+        self.folder = folder
+        self.file_prefix = file_prefix
+        self.model_name = model_name
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.shard_paths = []
+        self.file = None
+        self.num_requests = 0
+        self.num_bytes = 0
+        os.makedirs(folder, exist_ok=True)
+
+    def open_shard(self):
+        if self.file is not None:
+            self.file.close()
+        path = os.path.join(self.folder, f"{self.file_prefix}_batch_{len(self.shard_paths):04d}.jsonl")
+        self.shard_paths.append(path)
+        self.file = open(path, "w")
+        self.num_requests = 0
+        self.num_bytes = 0
+
+    def write(self, prompt_idx, request):
+        line = json.dumps({
+            "custom_id": custom_id(prompt_idx),
+            "method": "POST",
+            "url": CHAT_COMPLETIONS_URL,
+            "body": {"model": self.model_name, **request}
+        }) + "\n"
+        line_bytes = len(line.encode("utf-8"))
+        if self.file is None or self.num_requests >= self.max_requests or self.num_bytes + line_bytes > self.max_bytes:
+            self.open_shard()
+        self.file.write(line)
+        self.num_requests += 1
+        self.num_bytes += line_bytes
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+def iter_batch_results(paths):
+    """
+    Read batch API output files, yielding (prompt_idx, response content, error) per line.
+    Content is None for requests that failed, with error describing why.
+    """
+    for path in paths:
+        with open(path, "r") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                result = json.loads(line)
+                prompt_idx = prompt_idx_from_custom_id(result["custom_id"])
+                response = result.get("response") or {}
+                if result.get("error") or response.get("status_code") != 200:
+                    yield prompt_idx, None, result.get("error") or response.get("body")
+                    continue
+                yield prompt_idx, response["body"]["choices"][0]["message"]["content"], None
@@ -1,84 +1,200 @@
-import argparse 
-import json 
+import argparse
 import os
 import subprocess
+import sys
 import time
+from src.data_generation.prompt_file import is_prompt_manifest, load_prompt_file, load_prompt_manifest
+from src.data_generation.work_queue import DEFAULT_LEASE_SEC, DEFAULT_RANGE_SIZE, WorkQueue
 
 MAX_CONCURRENT_JOBS = 12
 
-def main(args):
-    prompt_file = os.path.join(args.input_folder, args.prompt_file)
-    with open(prompt_file, 'r') as file:
-        prompts = json.load(file)
-    total_prompts = len(prompts["prompts"])
-    
+def worker_command(args, command_input_folder, command_output_folder, range_args, prompt_file=None):
+    return (
+        f"python src/data_generation/data_generator.py "
+        f"--model_name {args.model_name} "
+        f"--input_folder {command_input_folder} "
+        f"--output_folder {command_output_folder} "
+        f"--prompt_file {prompt_file or args.prompt_file} "
+        f"{range_args} "
+        f"{'--azure_endpoint_url ' + args.azure_endpoint_url if args.azure_endpoint_url else ''} "
+        f"{'--deployments ' + ' '.join(args.deployments) if args.deployments else ''} "
+        f"--concurrency {args.concurrency} "
+        f"{'--prefix_order' if args.prefix_order else ''} "
+        f"--rpm_limit {args.rpm_limit} "
+        f"--tpm_limit {args.tpm_limit} "
+        f"{'--image_cache_dir ' + args.image_cache_dir if args.image_cache_dir else ''} "
+        f"{'--response_cache ' + args.response_cache if args.response_cache else ''} "
+        f"{'--resume' if args.resume else ''} "
+        f"{'--debug' if args.debug else ''}"
+    )
+
+def start_worker(args, command, run_id, command_file):
+    print(f"Running {command}")
+
+    output_file = None
+    if not args.aml:
+        log_folder = os.path.join(args.output_folder, "logs")
+        os.makedirs(log_folder, exist_ok=True)
+        output_file = os.path.join(log_folder, f"run_{run_id}_{args.file_prefix}.log")
+
+        with open(output_file, 'w') as f:
+            f.write(f"Command: {command}\n")
+
+    print(f"Logging to file {output_file}")
+
+    with open(command_file, 'a') as f:
+        f.write(command + "\n")
+
+    # Start the command as a new process and redirect stdout and stderr to the output file
+    if not args.dry_run and not args.aml:
+        with open(output_file, 'a') as f:
+            return subprocess.Popen(command, shell=True, stdout=f, stderr=subprocess.STDOUT)
+    return None
+
+def run_static_chunks(args, total_prompts, command_input_folder, command_output_folder, command_file):
     chunk_size = total_prompts // args.num_parallel
     chunks_start_idx = [(i, chunk_size) for i in range(0, total_prompts, chunk_size)]
     chunks_start_idx[-1] = (chunks_start_idx[-1][0], -1)
-    
+
     if args.num_parallel > MAX_CONCURRENT_JOBS:
         print(f"Number of parallel jobs {args.num_parallel} exceeds the maximum number of concurrent jobs {MAX_CONCURRENT_JOBS}.")
         print(f"Jobs batched into batches of size {MAX_CONCURRENT_JOBS}.")
         print(f"Will run batch {args.batch_num} now.")
-    
-    command_file = os.path.join(args.output_folder, f"commands_{args.file_prefix}.sh")
-    print(f"Writing all commands to {command_file}")
-    
-    command_input_folder = args.input_folder if not args.aml else "$INPUT_FOLDER"
-    command_output_folder = args.output_folder if not args.aml else "$OUTPUT_FOLDER"
-    
+
     for run_id, (start_idx, num_prompts) in enumerate(chunks_start_idx):
         if int(run_id / MAX_CONCURRENT_JOBS) != args.batch_num:
             continue
         time.sleep(1)
-        command = (
-            f"python src/data_generation/data_generator.py "
-            f"--model_name {args.model_name} "
-            f"--input_folder {command_input_folder} "
-            f"--output_folder {command_output_folder} "
-            f"--prompt_file {args.prompt_file} "
+        range_args = (
             f"--file_prefix {args.file_prefix}_{run_id} "
             f"--start_idx {start_idx} "
-            f"--num_prompts {num_prompts} "
-            f"--azure_endpoint_url {args.azure_endpoint_url} "
-            f"{'--debug' if args.debug else ''}"
+            f"--num_prompts {num_prompts}"
+        )
+        start_worker(args, worker_command(args, command_input_folder, command_output_folder, range_args), run_id, command_file)
+
+def run_shards(args, manifest, command_input_folder, command_output_folder, command_file):
+    """
+    One process per shard of a sharded prompt run (see prompt_generator.py --num_shards), each
+    reading only its own shard file.
+    """
+    shards = manifest["shards"]
+    if len(shards) > MAX_CONCURRENT_JOBS:
+        print(f"Number of shards {len(shards)} exceeds the maximum number of concurrent jobs {MAX_CONCURRENT_JOBS}.")
+        print(f"Jobs batched into batches of size {MAX_CONCURRENT_JOBS}.")
+        print(f"Will run batch {args.batch_num} now.")
+
+    for shard in shards:
+        run_id = shard["shard_id"]
+        if int(run_id / MAX_CONCURRENT_JOBS) != args.batch_num:
+            continue
+        time.sleep(1)
+        range_args = (
+            f"--file_prefix {args.file_prefix}_{run_id} "
+            f"--start_idx {shard['start_idx']} "
+            f"--num_prompts {shard['num_prompts']}"
         )
-        
-        print(f"Running {command}")
-        
-        output_file = None
-        if not args.aml:
-            log_folder = os.path.join(args.output_folder, "logs")
-            os.makedirs(log_folder, exist_ok=True)
-            output_file = os.path.join(log_folder, f"run_{run_id}_{args.file_prefix}.log")
-        
-            with open(output_file, 'w') as f:
-                f.write(f"Command: {command}\n")
-            
-        print(f"Logging to file {output_file}")
-        
-        # Start the command as a new process and redirect stdout and stderr to the output file
-        if not args.dry_run:
-            with open(output_file, 'a') as f:
-                process = subprocess.Popen(command, shell=True, stdout=f, stderr=subprocess.STDOUT)
-        
-        with open(command_file, 'a') as f:
-            f.write(command + "\n")
-    
+        # Shard paths are relative to the input folder, like the manifest's
+        prompt_file = os.path.relpath(shard["path"], args.input_folder) if args.input_folder else shard["path"]
+        start_worker(args, worker_command(args, command_input_folder, command_output_folder, range_args, prompt_file), run_id, command_file)
+
+def run_work_queue(args, total_prompts, command_input_folder, command_output_folder, command_file):
+    """
+    Start num_parallel workers that lease small prompt ranges from a shared queue, then wait on
+    them while reporting aggregate progress. Running the same command on other nodes that see the
+    same output folder adds their workers to the same queue.
+    """
+    queue_folder = os.path.join(args.output_folder, "queues")
+    os.makedirs(queue_folder, exist_ok=True)
+    queue_db = args.queue_db or os.path.join(queue_folder, f"{args.file_prefix}.sqlite")
+    queue = WorkQueue(queue_db, lease_sec=args.lease_sec)
+    queue.initialize(total_prompts, args.range_size)
+    print(f"Work queue {queue_db}: {queue.progress()}")
+
+    command_queue_db = queue_db if not args.aml else os.path.join(command_output_folder, os.path.relpath(queue_db, args.output_folder))
+    range_args = (
+        f"--file_prefix {args.file_prefix} "
+        f"--queue_db {command_queue_db} "
+        f"--lease_sec {args.lease_sec}"
+    )
+
+    processes = []
+    for run_id in range(args.num_parallel):
+        process = start_worker(args, worker_command(args, command_input_folder, command_output_folder, range_args), run_id, command_file)
+        if process is not None:
+            processes.append(process)
+    if not processes:
+        return 0
+
+    # Wait on workers and report aggregate progress
+    start_time = time.time()
+    exit_codes = [None]
+    while None in exit_codes:
+        time.sleep(args.progress_interval_sec)
+        exit_codes = [process.poll() for process in processes]
+        progress = queue.progress()
+        elapsed_sec = time.time() - start_time
+        print(
+            f"[{elapsed_sec:.0f}s] {progress['prompts_done']}/{progress['total_prompts']} prompts done, "
+            f"ranges: {progress['ranges']}, workers running: {exit_codes.count(None)}/{len(processes)}"
+        )
+
+    progress = queue.progress()
+    failed_workers = [run_id for run_id, exit_code in enumerate(exit_codes) if exit_code != 0]
+    print(f"All workers exited. Exit codes: {exit_codes}")
+    print(f"Final progress: {progress}")
+    if failed_workers:
+        print(f"Workers {failed_workers} failed, see their logs.")
+    if not queue.is_finished() or progress["ranges"]["failed"] > 0:
+        print("Work queue not fully processed. Re-run the same command to resume the remaining ranges.")
+        return 1
+    return 1 if failed_workers else 0
+
+def main(args):
+    prompt_file = os.path.join(args.input_folder, args.prompt_file)
+
+    command_file = os.path.join(args.output_folder, f"commands_{args.file_prefix}.sh")
+    print(f"Writing all commands to {command_file}")
+
+    command_input_folder = args.input_folder if not args.aml else "$INPUT_FOLDER"
+    command_output_folder = args.output_folder if not args.aml else "$OUTPUT_FOLDER"
+
+    if is_prompt_manifest(prompt_file):
+        run_shards(args, load_prompt_manifest(prompt_file), command_input_folder, command_output_folder, command_file)
+        return 0
+    total_prompts = len(load_prompt_file(prompt_file))
+
+    if args.static_chunks:
+        run_static_chunks(args, total_prompts, command_input_folder, command_output_folder, command_file)
+        return 0
+    return run_work_queue(args, total_prompts, command_input_folder, command_output_folder, command_file)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Multimodal Data Generator")
     parser.add_argument("--model_name", type=str, default="gpt-4o-450K", help="Name of model to use with GPT4 endpoint")
     parser.add_argument("--azure_endpoint_url", type=str, default="", help="Endpoint to use")
+    parser.add_argument("--deployments", type=str, nargs="+", default=[], help="Deployments (model_name[@url]) each worker spreads its requests over.")
     parser.add_argument('--input_folder', type=str, default="", help='Input Folder')
     parser.add_argument('--output_folder', type=str, default="", help='Output Folder')
-    parser.add_argument("--prompt_file", type=str, required=True, help="Path to the JSON file containing the prompts")
+    parser.add_argument("--prompt_file", type=str, required=True, help="Path to the JSON file containing the prompts, or to the manifest of sharded prompts (one process per shard)")
     parser.add_argument("--save_path", type=str, default="", help="Path to save the generated questions and answers")
     parser.add_argument("--file_prefix", type=str, required=True, help="Prefix for file with generated questions")
-    parser.add_argument("--num_parallel", type=int, default=1, help="Index to start at in the list of the prompts.")
-    parser.add_argument("--batch_num", type=int, default=0, help="Which batch of concurrent runs to start if running > max conccurent jobs")
+    parser.add_argument("--num_parallel", type=int, default=1, help="Number of generation processes to run.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of requests each generation process keeps in flight.")
+    parser.add_argument("--prefix_order", action='store_true', help="Order each process's prompts so provider side prompt caching can hit.")
+    parser.add_argument("--rpm_limit", type=int, default=0, help="Requests/min quota of the deployment, shared by all processes (0 disables).")
+    parser.add_argument("--tpm_limit", type=int, default=0, help="Tokens/min quota of the deployment, shared by all processes (0 disables).")
+    parser.add_argument("--image_cache_dir", type=str, default="", help="Folder for the encoded image cache shared by all processes (empty disables).")
+    parser.add_argument("--response_cache", type=str, default="", help="SQLite file caching raw responses, shared by all processes (empty disables).")
+    parser.add_argument("--queue_db", type=str, default="", help="Work queue file, defaults to <output_folder>/queues/<file_prefix>.sqlite.")
+    parser.add_argument("--range_size", type=int, default=DEFAULT_RANGE_SIZE, help="Number of prompts per leased range of the work queue.")
+    parser.add_argument("--lease_sec", type=float, default=DEFAULT_LEASE_SEC, help="Lease duration on a range, expired leases are handed to other workers.")
+    parser.add_argument("--progress_interval_sec", type=float, default=30, help="Seconds between progress reports.")
+    parser.add_argument("--static_chunks", action='store_true', help="Split prompts into num_parallel fixed chunks instead of using the work queue.")
+    parser.add_argument("--resume", action='store_true', help="Resume each generation process from its checkpoint.")
+    parser.add_argument("--batch_num", type=int, default=0, help="Which batch of concurrent runs to start if running > max conccurent jobs (static chunks only)")
     parser.add_argument("--dry_run", action='store_true', help="Dry run the script without executing the commands.")
     parser.add_argument("--aml", action='store_true', help="Run on aml")
     parser.add_argument("--debug", action='store_true', help="Enable debug logging")
 
     args = parser.parse_args()
-    main(args)
+    sys.exit(main(args))
@@ -0,0 +1,371 @@
+from argparse import Namespace
+from datetime import datetime
+from loguru import logger
+from PIL import Image
+from queue import Empty
+from src.data_generation.data_generator import MultimodalDataGenerator, build_parser
+from src.data_generation.image_payload import PayloadConfig, encode_image_file
+from src.data_generation.merge import ShardReader, merge_json_files
+from src.data_generation.minimal_dep_utils import GenerationMode, is_image_file
+from src.data_generation.prompt_file import load_prompt_file
+from src.data_generation.prompt_generator import PromptGenerator
+from src.data_generation.simulated_backend import MALFORMED_KINDS, SimulatedBackend
+import argparse
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+STAGES = ["generate_prompts", "load_prompts", "image_encode", "generate", "parse_response", "save_gen_text", "merge"]
+
+RESULTS_FOLDER = "benchmark_results"
+
+# How often a stage's process is checked for having died without reporting, e.g. OOM killed
+STAGE_POLL_SEC = 5
+RUN_ID = "bench"
+
+# Synthetic task files reuse a small set of real images, scale is in prompts not in image files
+NUM_IMAGES = 64
+IMAGE_SIZE = (1024, 768)
+KEYWORDS = ["bar chart", "line chart", "pie chart", "table", "diagram", "map", "photo", "screenshot"]
+
+def make_task_file(folder, num_prompts, seed):
+    """
+    Write a synthetic task file for num_prompts prompts: NUM_IMAGES images, one reference sample
+    per 100 prompts and subgroups with one candidate per prompt. Returns its file name.
+    """
+    rng = random.Random(seed)
+    image_folder = os.path.join(folder, "images")
+    os.makedirs(image_folder, exist_ok=True)
+    for idx in range(NUM_IMAGES):
+        path = os.path.join(image_folder, f"img_{idx}.jpg")
+        if not os.path.exists(path):
+            # Noise so JPEG encoding does real work
+            image = Image.effect_noise(IMAGE_SIZE, 40 + idx).convert("RGB")
+            image.save(path, quality=90)
+
+    num_samples = max(len(KEYWORDS), num_prompts // 100)
+    samples = [
+        {
+            "id": idx,
+            "image_1": f"img_{idx % NUM_IMAGES}.jpg",
+            "conversations": [
+                {"from": "human", "value": f"<image>\nWhat is the value of series {idx} in the {rng.choice(KEYWORDS)}?"},
+                {"from": "gpt", "value": f"The value is {rng.randint(0, 1000)}."}
+            ]
+        }
+        for idx in range(num_samples)
+    ]
+    subgroups = []
+    for keyword_idx, keyword in enumerate(KEYWORDS):
+        num_candidates = max(1, num_prompts // len(KEYWORDS))
+        subgroups.append({
+            "keyword": keyword,
+            "reference_sample_idx": list(range(keyword_idx, num_samples, len(KEYWORDS))),
+            "candidate_image_paths": [os.path.join("images", f"img_{rng.randrange(NUM_IMAGES)}.jpg") for _ in range(num_candidates)]
+        })
+    task_desc = {
+        "image_folder": "images",
+        "dataset_description": "charts and diagrams",
+        "subgroups": subgroups,
+        "samples": samples
+    }
+    task_file = f"task_{num_prompts}.json"
+    with open(os.path.join(folder, task_file), "w") as file:
+        json.dump(task_desc, file)
+    return task_file
+
+def prompt_file_path(folder):
+    return glob.glob(os.path.join(folder, "generated_prompts", "*_prompts_*.jsonl"))[0]
+
+def shard_ranges(num_prompts, num_shards):
+    shard_size = -(-num_prompts // num_shards)
+    return [(start_idx, min(shard_size, num_prompts - start_idx)) for start_idx in range(0, num_prompts, shard_size)]
+
+def create_generator(config, num_prompts):
+    """
+    A mock MultimodalDataGenerator over the benchmark's prompt file, configured like a real run.
+    """
+    args = build_parser().parse_args([
+        "--model_name", "mock",
+        "--input_folder", config["folder"],
+        "--output_folder", config["folder"],
+        "--prompt_file", prompt_file_path(config["folder"]),
+        "--file_prefix", RUN_ID,
+        "--start_idx", "0",
+        "--num_prompts", str(num_prompts),
+        "--concurrency", str(config["concurrency"]),
+        "--mock_malformed_rate", str(config["malformed_rate"]),
+        "--mock_seed", str(config["seed"])
+    ])
+    args.prompt_file = load_prompt_file(args.prompt_file)
+    return MultimodalDataGenerator(args, logger)
+
+def stage_generate_prompts(config):
+    args = Namespace(
+        task_desc=config["task_file"],
+        input_folder=config["folder"],
+        output_folder=config["folder"],
+        file_prefix=RUN_ID,
+        total_gen=config["num_prompts"],
+        min_gen_per_candidate=1,
+        num_icl_samples=config["num_icl_samples"],
+        mode=GenerationMode(config["mode"]),
+        seed=config["seed"],
+        num_shards=1,
+        num_workers=1
+    )
+    generator = PromptGenerator(args, logger)
+    return generator.generate_prompts()
+
+def stage_load_prompts(config):
+    """
+    What every worker does on start: open the prompt file and read its range.
+    """
+    prompt_file = load_prompt_file(prompt_file_path(config["folder"]))
+    num_prompts = len(prompt_file)
+    for start_idx, shard_size in shard_ranges(num_prompts, config["num_shards"]):
+        prompt_objects = prompt_file.slice(start_idx, shard_size)
+        assert len(prompt_objects) == shard_size
+    return num_prompts
+
+def stage_image_encode(config):
+    """
+    Open and re-encode the images of the first prompts, as sent to the model without passthrough.
+    """
+    prompt_file = load_prompt_file(prompt_file_path(config["folder"]))
+    paths = []
+    for prompt_object in prompt_file.slice(0, config["max_images"]):
+        paths.extend(os.path.join(config["folder"], content) for content in prompt_file.contents(prompt_object) if is_image_file(content))
+    paths = paths[:config["max_images"]]
+    payload_config = PayloadConfig(passthrough=False)
+    start_time = time.time()
+    for path in paths:
+        encode_image_file(path, payload_config)
+    return len(paths), time.time() - start_time
+
+def stage_generate(config):
+    """
+    Mock generation over the first prompts, split in shards like batch_data_generator does.
+    Samples are left in the checkpoints for save_gen_text.
+    """
+    num_prompts = min(config["num_prompts"], config["max_generate"])
+    generator = create_generator(config, num_prompts)
+    start_time = time.time()
+    for start_idx, shard_size in shard_ranges(num_prompts, config["num_shards"]):
+        generator.set_range(start_idx, shard_size, f"{RUN_ID}_{start_idx}")
+        generator.generate_questions()
+        generator.checkpoint.close()
+    elapsed_sec = time.time() - start_time
+    generator.metrics_writer.close()
+    return num_prompts, elapsed_sec
+
+def stage_parse_response(config):
+    """
+    Parse simulated responses for the mode, a share of them malformed.
+    """
+    generator = create_generator(config, 1)
+    backend = SimulatedBackend(seed=config["seed"])
+    request = {"messages": [
+        {"role": "system", "content": generator.model.sys_prompt},
+        {"role": "user", "content": generator.generation_prompt}
+    ]}
+    responses = []
+    for _ in range(min(config["num_prompts"], config["max_parse"])):
+        response = backend.completion_content(request)
+        if backend.random.random() < config["malformed_rate"]:
+            response = backend.malform(response, backend.random.choice(MALFORMED_KINDS))
+        responses.append(response)
+
+    start_time = time.time()
+    for response in responses:
+        try:
+            generator.parse_response(response)
+        except ValueError:
+            pass
+    return len(responses), time.time() - start_time
+
+def stage_save_gen_text(config):
+    num_prompts = min(config["num_prompts"], config["max_generate"])
+    generator = create_generator(config, num_prompts)
+    num_samples = 0
+    start_time = time.time()
+    for start_idx, shard_size in shard_ranges(num_prompts, config["num_shards"]):
+        generator.set_range(start_idx, shard_size, f"{RUN_ID}_{start_idx}", resume=True)
+        num_samples += generator.checkpoint.num_samples
+        generator.save_gen_text()
+    elapsed_sec = time.time() - start_time
+    generator.metrics_writer.close()
+    return num_samples, elapsed_sec
+
+def stage_merge(config):
+    output_folder = os.path.join(config["folder"], "merged")
+    os.makedirs(output_folder, exist_ok=True)
+    # merge prints its progress
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        output_file = merge_json_files(os.path.join(config["folder"], "generated_data"), RUN_ID, output_folder)
+    # The header, with len_samples, comes before the samples
+    reader = ShardReader(output_file)
+    next(reader.iter_samples(), None)
+    reader.close()
+    return reader.header["len_samples"]
+
+STAGE_FUNCTIONS = {
+    "generate_prompts": stage_generate_prompts,
+    "load_prompts": stage_load_prompts,
+    "image_encode": stage_image_encode,
+    "generate": stage_generate,
+    "parse_response": stage_parse_response,
+    "save_gen_text": stage_save_gen_text,
+    "merge": stage_merge
+}
+
+def run_stage(stage, config, queue):
+    """
+    Entry point of the process running one stage, so its peak RSS is its own. Stages return
+    the number of items processed, or that and their time if setup should not count.
+    """
+    # Malformed responses are expected, keep parse warnings out of the output
+    logger.remove()
+    logger.add(sys.stderr, level="ERROR")
+    start_time = time.time()
+    try:
+        result = STAGE_FUNCTIONS[stage](config)
+    except Exception as e:
+        queue.put({"error": f"{type(e).__name__}: {e}"})
+        raise
+    elapsed_sec = time.time() - start_time
+    num_items, elapsed_sec = result if isinstance(result, tuple) else (result, elapsed_sec)
+    queue.put({
+        "items": num_items,
+        "sec": round(elapsed_sec, 3),
+        "items_per_sec": round(num_items / elapsed_sec, 1) if elapsed_sec > 0 else None,
+        # Kilobytes on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    })
+
+def wait_for_result(process, queue):
+    """
+    Result a stage's process put on queue, or an error if the process exited without one.
+    """
+    while True:
+        try:
+            return queue.get(timeout=STAGE_POLL_SEC)
+        except Empty:
+            if process.is_alive():
+                continue
+        # The result may have been put just before the process exited
+        try:
+            return queue.get(timeout=1)
+        except Empty:
+            process.join()
+            return {"error": f"exit code {process.exitcode}"}
+
+def benchmark_scale(num_prompts, args, work_dir):
+    folder = os.path.join(work_dir, f"scale_{num_prompts}")
+    os.makedirs(folder, exist_ok=True)
+    config = {
+        "folder": folder,
+        "task_file": make_task_file(folder, num_prompts, args.seed),
+        "num_prompts": num_prompts,
+        "mode": args.mode,
+        "num_icl_samples": args.num_icl_samples,
+        "num_shards": args.num_shards,
+        "concurrency": args.concurrency,
+        "malformed_rate": args.malformed_rate,
+        "max_images": args.max_images,
+        "max_generate": args.max_generate,
+        "max_parse": args.max_parse,
+        "seed": args.seed
+    }
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for stage in args.stages:
+        queue = context.Queue()
+        process = context.Process(target=run_stage, args=(stage, config, queue))
+        process.start()
+        result = wait_for_result(process, queue)
+        process.join()
+        results[stage] = result
+        logger.info(f"{num_prompts} prompts, {stage}: {result}")
+        if "error" in result:
+            # Later stages read what this one writes
+            break
+    return results
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def compare(report, baseline):
+    """
+    Log the throughput of each stage relative to a previous report.
+    """
+    for scale, stages in report["scales"].items():
+        for stage, result in stages.items():
+            base = baseline["scales"].get(scale, {}).get(stage)
+            if not base or not base.get("items_per_sec") or not result.get("items_per_sec"):
+                continue
+            ratio = result["items_per_sec"] / base["items_per_sec"]
+            rss_delta = result["peak_rss_mb"] - base["peak_rss_mb"]
+            logger.info(f"{scale} prompts, {stage}: {ratio:.2f}x throughput, {rss_delta:+.1f} MB peak RSS vs {baseline['revision']}")
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.debug else "INFO")
+    # Child processes inherit this, progress bars only add noise to the timings
+    os.environ["TQDM_DISABLE"] = "1"
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": vars(args),
+        "scales": {}
+    }
+    with tempfile.TemporaryDirectory(dir=args.work_dir or None) as work_dir:
+        for num_prompts in args.scales:
+            report["scales"][str(num_prompts)] = benchmark_scale(num_prompts, args, work_dir)
+
+    output_file = args.output_file or os.path.join(RESULTS_FOLDER, f"pipeline_{report['revision']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, "w") as file:
+        json.dump(report, file, indent=3)
+    logger.info(f"Saved results to {output_file}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            compare(report, json.load(file))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the stages of the generation pipeline on synthetic task files")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 100000, 1000000], help="Numbers of prompts to benchmark")
+    parser.add_argument("--stages", type=str, nargs="+", default=STAGES, choices=STAGES, help="Stages to run, later stages need the output of earlier ones")
+    parser.add_argument("--mode", type=str, default="vqa_nr", help="Generation mode of the prompts")
+    parser.add_argument("--num_icl_samples", type=int, default=1, help="ICL samples per prompt")
+    parser.add_argument("--num_shards", type=int, default=8, help="Prompt ranges the prompts are split into, as for parallel workers")
+    parser.add_argument("--concurrency", type=int, default=1, help="Requests in flight during mock generation")
+    parser.add_argument("--malformed_rate", type=float, default=0.1, help="Share of simulated responses with malformed JSON")
+    parser.add_argument("--max_images", type=int, default=1000, help="Images encoded at most per scale")
+    parser.add_argument("--max_generate", type=int, default=20000, help="Prompts generated (and saved, merged) at most per scale")
+    parser.add_argument("--max_parse", type=int, default=100000, help="Responses parsed at most per scale")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic data")
+    parser.add_argument("--work_dir", type=str, default="", help="Parent folder of the temporary benchmark data (defaults to the system temp folder)")
+    parser.add_argument("--output_file", type=str, default="", help=f"Results file (defaults to {RESULTS_FOLDER}/pipeline_<revision>_<time>.json)")
+    parser.add_argument("--baseline", type=str, default="", help="Results file of a previous run to compare throughput and peak RSS against")
+    parser.add_argument("--debug", action='store_true', help="Enable debug logging")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,105 @@
+from loguru import logger
+from src.data_generation.deployment_pool import Deployment, DeploymentPool
+from src.data_generation.fake_openai_server import FakeOpenAIServer
+from src.data_generation.gpt4 import GPTEndPoint
+from src.data_generation.simulated_backend import SimulatedBackend
+import argparse
+import asyncio
+import json
+import sys
+import tempfile
+import time
+
+async def run_requests(endpoint, num_requests, concurrency):
+    """
+    Send num_requests with concurrency in flight, returns the number that succeeded.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(idx):
+        async with semaphore:
+            try:
+                await endpoint.generate_async([f"Request {idx}"])
+                return True
+            except Exception as e:
+                logger.debug(f"Request {idx} failed: {e}")
+                return False
+
+    results = await asyncio.gather(*[send(idx) for idx in range(num_requests)])
+    return sum(results)
+
+def make_endpoint(deployments, args):
+    pool = DeploymentPool(deployments, eject_sec=args.eject_sec, logger=logger)
+    return GPTEndPoint("gpt-4o", logger, sys_prompt="You are a data generation agent.", retry_delay_sec=args.retry_after_sec, pool=pool)
+
+async def run_pinned(servers, args, rate_limit_dir):
+    """
+    Today's setup: one worker per deployment, each pinned to it with an equal share of the requests.
+    """
+    num_per_worker = args.num_requests // len(servers)
+    endpoints = [make_endpoint([Deployment("gpt-4o", server.url, rate_limit_dir=rate_limit_dir, logger=logger)], args) for server in servers]
+    for endpoint in endpoints:
+        for deployment in endpoint.pool.deployments:
+            deployment.create_clients()
+    results = await asyncio.gather(*[run_requests(endpoint, num_per_worker, args.concurrency) for endpoint in endpoints])
+    return sum(results), num_per_worker * len(servers), [endpoint.pool.summary() for endpoint in endpoints]
+
+async def run_pooled(servers, args, rate_limit_dir):
+    """
+    The same workers sharing a pool over all deployments.
+    """
+    deployments = [Deployment("gpt-4o", server.url, rate_limit_dir=rate_limit_dir, logger=logger) for server in servers]
+    for deployment in deployments:
+        deployment.create_clients()
+    endpoint = make_endpoint(deployments, args)
+    num_requests = args.num_requests // len(servers) * len(servers)
+    succeeded = await run_requests(endpoint, num_requests, args.concurrency * len(servers))
+    return succeeded, num_requests, endpoint.pool.summary()
+
+def benchmark(name, run, servers, args):
+    with tempfile.TemporaryDirectory() as rate_limit_dir:
+        start_time = time.time()
+        succeeded, num_requests, summary = asyncio.run(run(servers, args, rate_limit_dir))
+        elapsed_sec = time.time() - start_time
+    result = {
+        "setup": name,
+        "requests": num_requests,
+        "succeeded": succeeded,
+        "elapsed_sec": round(elapsed_sec, 2),
+        "requests_per_sec": round(succeeded / elapsed_sec, 2),
+        "deployments": summary
+    }
+    logger.info(json.dumps(result, indent=3))
+    return result
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.debug else "INFO")
+
+    servers = [
+        FakeOpenAIServer(SimulatedBackend(latency_sec=args.latency_sec, latency_dist="fixed", throttle_rate=throttle_rate, retry_after_sec=args.retry_after_sec)).start()
+        for throttle_rate in args.throttle_rates
+    ]
+    try:
+        pinned = benchmark("pinned", run_pinned, servers, args)
+        pooled = benchmark("pool", run_pooled, servers, args)
+    finally:
+        for server in servers:
+            server.stop()
+    logger.info(
+        f"Throughput with uneven throttling {args.throttle_rates}: pinned {pinned['requests_per_sec']} req/s "
+        f"({pinned['elapsed_sec']}s), pool {pooled['requests_per_sec']} req/s ({pooled['elapsed_sec']}s)"
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare pinned workers with a deployment pool on local fake deployments")
+    parser.add_argument("--num_requests", type=int, default=300, help="Total number of requests")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests in flight per worker (pinned) or per deployment (pool)")
+    parser.add_argument("--latency_sec", type=float, default=0.2, help="Response latency of every fake deployment")
+    parser.add_argument("--throttle_rates", type=float, nargs="+", default=[0.7, 0.05, 0.0], help="Share of requests each fake deployment throttles")
+    parser.add_argument("--retry_after_sec", type=float, default=2.0, help="Retry-After sent with 429s")
+    parser.add_argument("--eject_sec", type=float, default=5.0, help="Base ejection cooldown of the pool")
+    parser.add_argument("--debug", action='store_true', help="Enable debug logging")
+
+    args = parser.parse_args()
+    main(args)
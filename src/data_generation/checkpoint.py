@@ -0,0 +1,139 @@
+import json
+import os
+
+def checkpoint_paths(folder, file_prefix):
+    return os.path.join(folder, f"{file_prefix}.partial.jsonl"), os.path.join(folder, f"{file_prefix}.progress.jsonl")
+
+def adopt_checkpoint(folder, source_prefix, target_prefix):
+    """
+    Start checkpoint target_prefix with the prompts completed in checkpoint source_prefix. The source
+    may still be appended to by a worker that lost its lease without noticing yet: only the prompts
+    recorded in its manifest so far are copied, and the source is never written to.
+    Returns the number of prompts adopted.
+    """
+    source_samples_path, source_progress_path = checkpoint_paths(folder, source_prefix)
+    target_samples_path, target_progress_path = checkpoint_paths(folder, target_prefix)
+    progress_lines = []
+    samples_offset = 0
+    with open(source_progress_path, "r") as file:
+        for line in file:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Partially written last line
+                break
+            if not line.endswith("\n"):
+                break
+            progress_lines.append(line)
+            samples_offset = entry["offset"]
+
+    # Samples are on disk before their manifest line is written
+    with open(source_samples_path, "rb") as source, open(target_samples_path, "wb") as target:
+        remaining = samples_offset
+        while remaining:
+            chunk = source.read(min(remaining, 1 << 20))
+            if not chunk:
+                break
+            target.write(chunk)
+            remaining -= len(chunk)
+    with open(target_progress_path, "w") as file:
+        file.writelines(progress_lines)
+    return len(progress_lines)
+
+class GenerationCheckpoint:
+    """
+    Streams formatted samples to a JSONL file as soon as they are parsed, together with a progress
+    manifest of completed prompt indices, so an interrupted run can resume without paying twice.
+
+    Each manifest line records the size of the samples file after the prompt's samples were written.
+    On resume the samples file is truncated to the last recorded size, dropping samples of a prompt
+    that was interrupted half way through being written.
+    """
+    def __init__(self, folder, file_prefix, resume=False, logger=None):
+        self.samples_path, self.progress_path = checkpoint_paths(folder, file_prefix)
+        self.logger = logger
+        self.done = set()
+        self.next_gen_id = 0
+        self.num_samples = 0
+
+        if resume:
+            self.load()
+        else:
+            open(self.samples_path, "w").close()
+            open(self.progress_path, "w").close()
+
+        self.samples_file = open(self.samples_path, "a")
+        self.progress_file = open(self.progress_path, "a")
+
+    def load(self):
+        samples_offset = 0
+        progress_offset = 0
+        if os.path.exists(self.progress_path):
+            with open(self.progress_path, "r") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Partially written last line
+                        break
+                    self.done.add(entry["prompt_idx"])
+                    self.next_gen_id += entry["num_gen"]
+                    self.num_samples += entry["num_samples"]
+                    samples_offset = entry["offset"]
+                    progress_offset += len(line.encode("utf-8"))
+            os.truncate(self.progress_path, progress_offset)
+        else:
+            open(self.progress_path, "w").close()
+
+        if os.path.exists(self.samples_path):
+            os.truncate(self.samples_path, samples_offset)
+        else:
+            open(self.samples_path, "w").close()
+
+        if self.logger is not None:
+            self.logger.info(f"Resuming: {len(self.done)} prompts and {self.num_samples} samples already done.")
+
+    def is_done(self, prompt_idx):
+        return prompt_idx in self.done
+
+    def append(self, prompt_idx, num_gen, formatted_samples):
+        """
+        Persist the samples generated for a prompt, then mark the prompt as done.
+        """
+        for sample in formatted_samples:
+            self.samples_file.write(json.dumps(sample) + "\n")
+        self.samples_file.flush()
+        os.fsync(self.samples_file.fileno())
+
+        entry = {
+            "prompt_idx": prompt_idx,
+            "num_gen": num_gen,
+            "num_samples": len(formatted_samples),
+            "offset": self.samples_file.tell()
+        }
+        self.progress_file.write(json.dumps(entry) + "\n")
+        self.progress_file.flush()
+        os.fsync(self.progress_file.fileno())
+
+        self.done.add(prompt_idx)
+        self.next_gen_id += num_gen
+        self.num_samples += len(formatted_samples)
+
+    def end_idx(self, start_idx):
+        """
+        Index of the first prompt, from start_idx on, that has not been completed.
+        """
+        end_idx = start_idx
+        while end_idx in self.done:
+            end_idx += 1
+        return end_idx
+
+    def iter_samples(self):
+        self.samples_file.flush()
+        with open(self.samples_path, "r") as file:
+            for line in file:
+                yield json.loads(line)
+
+    def close(self):
+        self.samples_file.close()
+        self.progress_file.close()
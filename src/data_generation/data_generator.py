@@ -1,16 +1,33 @@
-from PIL import Image
 from datetime import datetime
 from loguru import logger
+from src.data_generation.batch_api import BatchRequestWriter, iter_batch_results
+from src.data_generation.checkpoint import GenerationCheckpoint, adopt_checkpoint, checkpoint_paths
+from src.data_generation.deployment_pool import DEFAULT_EJECT_SEC, create_pool
 from src.data_generation.gpt4 import GPTEndPoint
+from src.data_generation.image_cache import DEFAULT_MEMORY_MB, ImageCache
+from src.data_generation.image_payload import DETAIL_POLICY, MAX_SIDE, PayloadConfig
+from src.data_generation.image_prefetch import DEFAULT_PREFETCH_DEPTH, DEFAULT_PREFETCH_WORKERS, ImagePrefetcher
+from src.data_generation.json_repair import loads_repaired, loads_strict
+from src.data_generation.metrics import METRICS_FOLDER, MetricsWriter, new_call_metrics
 from src.data_generation.minimal_dep_utils import is_image_file, GenerationMode
+from src.data_generation.prefix_cache import order_by_prefix, prefix_group_key
+from src.data_generation.prompt_file import load_prompt_file
+from src.data_generation.rate_limiter import DEFAULT_STATE_DIR
+from src.data_generation.response_cache import DEFAULT_MAX_MB, ResponseCache
+from src.data_generation.simulated_backend import LATENCY_DISTRIBUTIONS, SimulatedBackend
+from src.data_generation.work_queue import DEFAULT_LEASE_SEC, LeaseLostError, WorkQueue
 from tqdm import tqdm 
 import argparse
+import asyncio
 import json
 import os
 import random
 import re
 import signal
+import socket
 import sys
+import threading
+import time
     
 VQA_SYS_PROMPT = """You are an expert in <DATASET_DESC>. Your task is to generate high-quality question-answer pairs relevant to this skill similar to the following examples. 
 
@@ -298,6 +315,10 @@ ONLY_ANS_PROMPT = "Provide a concise answer."
 
 SAVE_PATH = "generated_data"
 
+# Completed prompts waiting on an earlier, still running prompt are buffered so results
+# stay in prompt order. Buffer is capped at ASYNC_REORDER_FACTOR * concurrency prompts.
+ASYNC_REORDER_FACTOR = 4
+
 class BatchSampler:
     def __init__(self, samples, batch_size):
         self.samples = samples
@@ -341,21 +362,71 @@ class MultimodalDataGenerator:
         """
         self.prompt_file = args.prompt_file
         self.model_name = args.model_name
-        self.start_idx = args.start_idx 
-        self.num_prompts = args.num_prompts
+        self.output_folder = args.output_folder
         self.logger = logger
-        self.min_gen_per_candidate = self.prompt_file["min_gen_per_candidate"]
+        self.min_gen_per_candidate = self.prompt_file.header["min_gen_per_candidate"]
         self.input_folder = args.input_folder
-        self.mode = GenerationMode(self.prompt_file["mode"])
+        self.mode = GenerationMode(self.prompt_file.header["mode"])
+        self.concurrency = args.concurrency
+        self.prefix_order = args.prefix_order
+        self.prefetch_workers = args.prefetch_workers
+        # Async generation takes up to concurrency prompts at once, keep at least that many ready
+        self.prefetch_depth = max(args.prefetch_depth, self.concurrency)
         self.logger.info(f"Generation Mode: {self.mode}")
+        endpoint_kwargs = {
+            "azure_endpoint_url": args.azure_endpoint_url,
+            "base_url": args.base_url,
+            "mock_latency_sec": args.mock_latency_sec,
+            "rpm_limit": args.rpm_limit,
+            "tpm_limit": args.tpm_limit,
+            "rate_limit_dir": args.rate_limit_dir
+        }
+        
+        # One simulated backend for both endpoints, so its quota and prefix cache are shared
+        if self.model_name == "mock":
+            endpoint_kwargs["mock_backend"] = SimulatedBackend(
+                latency_sec=args.mock_latency_sec,
+                latency_dist=args.mock_latency_dist,
+                throttle_rate=args.mock_throttle_rate,
+                error_rate=args.mock_error_rate,
+                malformed_rate=args.mock_malformed_rate,
+                seed=args.mock_seed
+            )
+        
+        # Spread requests over several deployments, shared by the generation and format fixing endpoints
+        if args.deployments and self.model_name != "mock":
+            endpoint_kwargs["pool"] = create_pool(
+                args.deployments,
+                rpm_limit=args.rpm_limit,
+                tpm_limit=args.tpm_limit,
+                rate_limit_dir=args.rate_limit_dir,
+                eject_sec=args.eject_sec,
+                logger=self.logger
+            )
+        
+        # Opt-in cache of raw responses, shared by the generation and format fixing endpoints
+        self.response_cache = None
+        if args.response_cache:
+            self.response_cache = ResponseCache(args.response_cache, max_mb=args.response_cache_mb, logger=self.logger)
+            endpoint_kwargs["response_cache"] = self.response_cache
+        
+        # Payload settings for ICL and candidate images, detail defaults to the per mode policy
+        payload_config = PayloadConfig(
+            passthrough=not args.no_image_passthrough,
+            max_side=args.image_max_side,
+            format=args.image_format,
+            quality=args.image_quality
+        )
+        self.icl_payload_config = payload_config.with_detail(args.icl_image_detail or DETAIL_POLICY[self.mode]["icl"])
+        self.candidate_payload_config = payload_config.with_detail(args.candidate_image_detail or DETAIL_POLICY[self.mode]["candidate"])
         
         # Create agent to fix formats
         if self.mode == GenerationMode.VQA or self.mode == GenerationMode.TQA:
-            self.format_fix_agent = GPTEndPoint(self.model_name, self.logger, sys_prompt=QA_FORMAT_FIX_SYS_PROMPT, azure_endpoint_url=args.azure_endpoint_url)
+            self.format_fix_agent = GPTEndPoint(self.model_name, self.logger, sys_prompt=QA_FORMAT_FIX_SYS_PROMPT, **endpoint_kwargs)
         elif self.mode == GenerationMode.VQA_NR or self.mode == GenerationMode.VQA_TASK_DESC:
-            self.format_fix_agent = GPTEndPoint(self.model_name, self.logger, sys_prompt=QA_NR_FORMAT_FIX_SYS_PROMPT, azure_endpoint_url=args.azure_endpoint_url)
+            self.format_fix_agent = GPTEndPoint(self.model_name, self.logger, sys_prompt=QA_NR_FORMAT_FIX_SYS_PROMPT, **endpoint_kwargs)
         elif self.mode == GenerationMode.DESCRIPT or self.mode == GenerationMode.GENERIC or self.mode == GenerationMode.DESCRIPT_TASK_DESC:
-            self.format_fix_agent = GPTEndPoint(self.model_name, self.logger, sys_prompt=DESCRIPT_FORMAT_FIX_SYS_PROMPT, azure_endpoint_url=args.azure_endpoint_url)
+            self.format_fix_agent = GPTEndPoint(self.model_name, self.logger, sys_prompt=DESCRIPT_FORMAT_FIX_SYS_PROMPT, **endpoint_kwargs)
         else:
             raise ValueError()
         
@@ -384,12 +455,54 @@ class MultimodalDataGenerator:
         else:
             raise ValueError(f"Invalid value for mode")
         self.generation_prompt = self.generation_prompt.replace("<NUM>", str(self.min_gen_per_candidate))        
-        self.model = GPTEndPoint(self.model_name, sys_prompt=self.sys_prompt.replace("<DATASET_DESC>", self.prompt_file["dataset_description"]), logger=logger, azure_endpoint_url=args.azure_endpoint_url)
+        self.model = GPTEndPoint(self.model_name, sys_prompt=self.sys_prompt.replace("<DATASET_DESC>", self.prompt_file.header["dataset_description"]), logger=logger, payload_config=self.candidate_payload_config, **endpoint_kwargs)
+        
+        # ICL images are shared across many prompts, only encode each of them once
+        self.image_cache = ImageCache(cache_dir=args.image_cache_dir, max_memory_mb=args.image_cache_mb, logger=self.logger)
+        
+        # How responses were parsed, counted across the generation threads
+        self.parse_stats = {"clean": 0, "local_fix": 0, "remote_fix": 0, "give_up": 0}
+        self.parse_stats_lock = threading.Lock()
+        
+        # One metrics record per prompt, in a file per process so queue workers never share one
+        metrics_path = os.path.join(self.output_folder, METRICS_FOLDER, f"{args.file_prefix}_{socket.gethostname()}_{os.getpid()}.metrics.jsonl")
+        self.metrics_writer = MetricsWriter(metrics_path)
+        
+        # Called periodically during generation, returns False once the prompt range should be abandoned
+        self.heartbeat = None
+        self.heartbeat_interval_sec = 0
+        
+        # Queue workers set their range per leased chunk of prompts
+        if not args.queue_db:
+            self.set_range(args.start_idx, args.num_prompts, args.file_prefix, args.resume)
+    
+    def set_range(self, start_idx, num_prompts, file_prefix, resume=False, checkpoint_prefix=None):
+        """
+        Point the generator at the prompts [start_idx, start_idx + num_prompts), with outputs under file_prefix.
+        The checkpoint is under checkpoint_prefix, file_prefix by default.
+        """
+        self.start_idx = start_idx
+        self.num_prompts = num_prompts
+        self.file_prefix = file_prefix
         
         # DT string to associate examples with time of run
         self.dt_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.gen_data_path = os.path.join(args.output_folder, SAVE_PATH, f"{args.file_prefix}_{self.dt_str}.json")
-        os.makedirs(os.path.join(args.output_folder, SAVE_PATH), exist_ok=True)
+        self.gen_data_path = os.path.join(self.output_folder, SAVE_PATH, f"{file_prefix}_{self.dt_str}.json")
+        os.makedirs(os.path.join(self.output_folder, SAVE_PATH), exist_ok=True)
+        
+        # Samples are streamed to disk as they are parsed, see GenerationCheckpoint
+        self.checkpoint = GenerationCheckpoint(os.path.join(self.output_folder, SAVE_PATH), checkpoint_prefix or file_prefix, resume=resume, logger=self.logger)
+        self.last_heartbeat = time.time()
+    
+    def check_heartbeat(self):
+        if self.heartbeat is None or time.time() - self.last_heartbeat < self.heartbeat_interval_sec:
+            return
+        self.last_heartbeat = time.time()
+        if not self.heartbeat():
+            raise LeaseLostError("Lease on prompt range lost, stopping.")
+    
+    def num_done(self):
+        return sum(1 for idx in range(self.start_idx, self.start_idx + self.num_prompts) if self.checkpoint.is_done(idx))
 
     def generate_questions(self):
         """
@@ -399,267 +512,507 @@ class MultimodalDataGenerator:
         :return: None
         """
         self.logger.info("Generating questions based on skill description and sample questions.")
-        self.gen_image_paths = []
-        self.gen_text = []
-        self.gen_icl_indices = []
-        self.gen_keywords = []
         
         # Compute per candidate generation count 
         self.total_gen = self.min_gen_per_candidate * self.num_prompts
         self.logger.info(f"Will be generating {self.total_gen} examples.")
         
+        # Skip prompts completed by a previous (interrupted) run
+        prompt_objects = self.prompt_file.slice(self.start_idx, self.num_prompts)
+        todo_offsets = [offset for offset in range(len(prompt_objects)) if not self.checkpoint.is_done(self.start_idx + offset)]
+        if len(todo_offsets) < len(prompt_objects):
+            self.logger.info(f"Skipping {len(prompt_objects) - len(todo_offsets)} prompts that are already done.")
+        if self.prefix_order:
+            todo_offsets = order_by_prefix(prompt_objects, todo_offsets)
+            num_groups = len(set(prefix_group_key(prompt_objects[offset]) for offset in todo_offsets))
+            self.logger.info(f"Ordered {len(todo_offsets)} prompts into {num_groups} groups sharing a request prefix.")
+        
+        if self.concurrency > 1:
+            self.logger.info(f"Running async generation with {self.concurrency} requests in flight.")
+            try:
+                with self.create_prefetcher(prompt_objects, todo_offsets) as prefetcher:
+                    asyncio.run(self.generate_questions_async(prompt_objects, todo_offsets, prefetcher))
+            # Ctrl-C is raised out of the event loop rather than inside the coroutine
+            except Exception as e:
+                self.logger.error(f"Gracefully handling exception: {e}")
+            self.log_run_stats()
+            self.logger.info(f"Completed generation")
+            return
+        
         try:
             ##################################################################
             #                     Try Generate & Parse                       #
             ##################################################################
-            for prompt_object in tqdm(self.prompt_file["prompts"][self.start_idx:self.start_idx + self.num_prompts]):
-                # Parse prompt object
-                prompt = prompt_object["prompt"]
-                keyword = prompt_object["keyword"]
-                icl_indices = prompt_object["icl_indices"]
-
-                # Extract candidate image path 
-                candidate_image_path = os.path.join(self.input_folder, prompt[-1])
-                self.logger.debug(f"Processing candidate image: {candidate_image_path}")
-                
-                # Load all images in prompts
-                for i in range(len(prompt)):
-                    if self.model_name == "mock":
-                        prompt[i] = os.path.join(self.input_folder, prompt[i])
-                        continue
-                    if is_image_file(prompt[i]):
-                        prompt[i] = Image.open(os.path.join(self.input_folder, prompt[i]))
+            with self.create_prefetcher(prompt_objects, todo_offsets) as prefetcher:
+                for offset in tqdm(todo_offsets):
+                    self.check_heartbeat()
+                    prompt_object = prompt_objects[offset]
+                    metrics = self.new_prompt_metrics(offset)
+                    try:
+                        # Images of the next prompts are loaded while this request is in flight
+                        contents = prefetcher.get(offset)
+                        
+                        # Get response from model
+                        response = self.model.generate(self.request_contents(contents), cache_tag=str(self.start_idx + offset), metrics=metrics["generate"])
+                    except Exception as e:
+                        self.stop_clock(metrics)
+                        self.write_metrics(metrics, error=e)
+                        raise
+                    # Release the encoded images before parsing, which may take more model calls
+                    del contents
                         
-                # Get response from model
-                response = self.model.generate(prompt + [self.generation_prompt])
+                    # Remove all special token tags (these are specific to LLava style models)
+                    response = re.sub("<.*>", "", response)
                     
-                # Remove all special token tags (these are specific to LLava style models)
-                response = re.sub("<.*>", "", response)
+                    # Try parse, else retry
+                    try:
+                        json_response = self.parse_response(response, metrics)
+                    except:
+                        self.logger.error("Failing due to invalid format. Skipping ahead.")
+                        json_response = None
+                    self.stop_clock(metrics)
+                            
+                    self.record_result(offset, prompt_object, json_response, metrics)
                 
-                if self.model_name == "mock":
-                    self.logger.debug("Mock model: tests complete.")
-                    exit(0)
-                    
-                # Try parse, else retry
-                try:
-                    json_response = self.parse_response(response)
-                except:
-                    self.logger.error("Failing due to invalid format. Skipping ahead.")
-                    continue
-                        
-                self.logger.debug(f"Generated questions for prompt and image: {response}")
+        # Catch all to gracefully fail, everything done so far is already on disk
+        except Exception as e:
+            self.logger.error(f"Gracefully handling exception: {e}")
+        self.log_run_stats()
+        self.logger.info(f"Completed generation")
+    
+    async def generate_questions_async(self, prompt_objects, todo_offsets, prefetcher):
+        """
+        Async version of the generation loop. Keeps up to self.concurrency requests in flight
+        and records results in prompt order, together with their keyword and icl indices.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        max_outstanding = self.concurrency * ASYNC_REORDER_FACTOR
+        pending = {}
+        next_pos = 0
+        emit_pos = 0
+        pbar = tqdm(total=len(todo_offsets))
+        
+        try:
+            while emit_pos < len(todo_offsets):
+                self.check_heartbeat()
                 
-                if len(json_response) != self.min_gen_per_candidate:
-                    self.logger.error(f"Got {len(json_response)} examples, expected {self.min_gen_per_candidate}.")
-                    
-                self.gen_text.extend(json_response)
-                for _ in range(len(json_response)):
-                    self.gen_image_paths.append(candidate_image_path)
-                    self.gen_icl_indices.append(icl_indices)
-                    self.gen_keywords.append(keyword)
-                self.end_idx = self.start_idx + i
+                # Top up the window of scheduled prompts
+                while next_pos < len(todo_offsets) and next_pos - emit_pos < max_outstanding:
+                    offset = todo_offsets[next_pos]
+                    pending[offset] = asyncio.create_task(
+                        self.process_prompt_async(offset, prefetcher, semaphore, self.new_prompt_metrics(offset))
+                    )
+                    next_pos += 1
+                
+                # Wait on the oldest prompt, later ones keep running in the meantime
+                offset = todo_offsets[emit_pos]
+                json_response, metrics = await pending.pop(offset)
+                self.record_result(offset, prompt_objects[offset], json_response, metrics)
+                emit_pos += 1
+                pbar.update(1)
                 
         # Catch all to gracefully fail and save what is done so far
         except Exception as e:
             self.logger.error(f"Gracefully handling exception: {e}")
-            min_len = min(len(self.gen_text), len(self.gen_image_paths), len(self.gen_icl_indices))
-            self.gen_text = self.gen_text[:min_len]
-            self.gen_image_paths = self.gen_image_paths[:min_len]
-            self.gen_icl_indices = self.gen_icl_indices[:min_len]
-            self.gen_keywords = self.gen_keywords[:min_len]
-            self.end_idx = self.start_idx + i
-        self.logger.info(f"Completed generation")
+            # Keep prompts that already finished, we paid for them
+            for offset in sorted(pending):
+                task = pending[offset]
+                if task.done() and not task.cancelled() and task.exception() is None:
+                    self.record_result(offset, prompt_objects[offset], *task.result())
+        finally:
+            for task in pending.values():
+                task.cancel()
+            pbar.close()
     
-    def extract_json_part(self, input_string):
-        # Use regex to find the JSON part within the input string
-        json_match = re.search(r'\[.*\]', input_string, re.DOTALL)
-        if json_match:
-            json_part = json_match.group(0)
-            json_part = re.sub(r'\\', r'\\\\', json_part)
+    async def process_prompt_async(self, offset, prefetcher, semaphore, metrics):
+        async with semaphore:
+            metrics["queue_sec"] = time.time() - metrics["start_time"]
             try:
-                # Parse the JSON to ensure it's valid
-                json_data = json.loads(json_part)
-                return json.dumps(json_data, indent=3)  # Return the formatted JSON string
-            except json.JSONDecodeError:
-                return "Invalid JSON found."
-        else:
-            return "No JSON part found."
+                contents = await prefetcher.get_async(offset)
+                response = await self.model.generate_async(self.request_contents(contents), cache_tag=str(self.start_idx + offset), metrics=metrics["generate"])
+            except Exception as e:
+                self.stop_clock(metrics)
+                self.write_metrics(metrics, error=e)
+                raise
+            del contents
+        
+        # Remove all special token tags (these are specific to LLava style models)
+        response = re.sub("<.*>", "", response)
+        
+        # Format fixing agent is synchronous, run it on a worker thread
+        try:
+            json_response = await asyncio.to_thread(self.parse_response, response, metrics)
+        except:
+            self.logger.error("Failing due to invalid format. Skipping ahead.")
+            json_response = None
+        # Stopped here, not when recorded: results are recorded in prompt order, after earlier prompts
+        self.stop_clock(metrics)
+        return json_response, metrics
+    
+    def create_prefetcher(self, prompt_objects, offsets):
+        """
+        Prefetcher loading the contents of the prompts at offsets, in that order.
+        """
+        return ImagePrefetcher(
+            self.build_contents,
+            [(offset, prompt_objects[offset]) for offset in offsets],
+            num_workers=self.prefetch_workers,
+            depth=self.prefetch_depth,
+            logger=self.logger
+        )
+    
+    def build_contents(self, prompt_object):
+        """
+        Load all images in the prompt, returning the contents to send to the model.
+        """
+        contents = []
+        prompt = self.prompt_file.contents(prompt_object)
+        for i, content in enumerate(prompt):
+            if self.model_name == "mock":
+                contents.append(os.path.join(self.input_folder, content))
+            elif is_image_file(content):
+                # Candidate image is always last, the rest are ICL examples
+                is_candidate = i == len(prompt) - 1 and self.mode != GenerationMode.TQA
+                payload_config = self.candidate_payload_config if is_candidate else self.icl_payload_config
+                contents.append(self.image_cache.get(os.path.join(self.input_folder, content), payload_config))
+            else:
+                contents.append(content)
+        self.logger.debug(f"Processing candidate image: {os.path.join(self.input_folder, self.prompt_file.candidate(prompt_object))}")
+        return contents
+    
+    def request_contents(self, contents):
+        """
+        Append the generation prompt to the prompt contents. With prefix ordering it goes before the
+        candidate image instead (it asks about "the following image"), so everything but the candidate
+        is byte-identical across a group of prompts and can be served from the provider's prompt cache.
+        """
+        if self.prefix_order and self.mode != GenerationMode.TQA:
+            return contents[:-1] + [self.generation_prompt, contents[-1]]
+        return contents + [self.generation_prompt]
+    
+    def new_prompt_metrics(self, offset):
+        """
+        Metrics record of a prompt, started when it is scheduled. GPTEndPoint fills in the calls.
+        """
+        return {
+            "prompt_idx": self.start_idx + offset,
+            "file_prefix": self.file_prefix,
+            "mode": self.mode.value,
+            "model_name": self.model_name,
+            "start_time": time.time(),
+            "queue_sec": 0.0,
+            "wall_sec": 0.0,
+            "parse": None,
+            "num_samples": 0,
+            "error": None,
+            "generate": new_call_metrics(),
+            "format_fix": new_call_metrics()
+        }
+    
+    def stop_clock(self, metrics):
+        """
+        Set the prompt's wall time, once its request and parsing are over.
+        """
+        metrics["wall_sec"] = time.time() - metrics["start_time"] - metrics["queue_sec"]
+    
+    def write_metrics(self, metrics, num_samples=0, error=None):
+        metrics["num_samples"] = num_samples
+        if error is not None:
+            metrics["error"] = type(error).__name__
+        self.metrics_writer.write(metrics)
     
-    def parse_response(self, response):
+    def record_result(self, offset, prompt_object, json_response, metrics=None):
+        """
+        Format the parsed response for the prompt at offset (relative to start_idx) and stream
+        it to the checkpoint. Prompts that failed to parse are recorded as done with no samples.
+        """
+        gen_objs = json_response if json_response is not None else []
+        if json_response is not None:
+            self.logger.debug(f"Generated questions for prompt and image: {json_response}")
+            if len(json_response) != self.min_gen_per_candidate:
+                self.logger.error(f"Got {len(json_response)} examples, expected {self.min_gen_per_candidate}.")
+        
+        candidate_image_path = os.path.join(self.input_folder, self.prompt_file.candidate(prompt_object))
+        formatted_samples = []
+        for i, gen_obj in enumerate(gen_objs):
+            formatted_samples.extend(self.format_gen_obj(
+                self.checkpoint.next_gen_id + i, gen_obj, candidate_image_path, prompt_object["icl_indices"], prompt_object["keyword"]
+            ))
+        self.checkpoint.append(self.start_idx + offset, len(gen_objs), formatted_samples)
+        if metrics is not None:
+            self.write_metrics(metrics, num_samples=len(formatted_samples))
+    
+    def export_batch_requests(self, folder, model_name):
+        """
+        Write the request for every prompt in range to batch API input files instead of sending it.
+        Prompts already completed in the checkpoint are left out, so failures can be re-exported.
+        """
+        self.logger.info(f"Exporting batch requests to {folder}.")
+        writer = BatchRequestWriter(folder, self.file_prefix, model_name)
+        prompt_objects = self.prompt_file.slice(self.start_idx, self.num_prompts)
+        todo_offsets = [offset for offset in range(len(prompt_objects)) if not self.checkpoint.is_done(self.start_idx + offset)]
+        with self.create_prefetcher(prompt_objects, todo_offsets) as prefetcher:
+            for offset in tqdm(todo_offsets):
+                contents = prefetcher.get(offset)
+                writer.write(self.start_idx + offset, self.model.create_request(self.request_contents(contents)))
+        num_exported = len(todo_offsets)
+        writer.close()
+        self.logger.info(f"Exported {num_exported} requests to {len(writer.shard_paths)} shards: {writer.shard_paths}")
+        return writer.shard_paths
+    
+    def ingest_batch_results(self, paths):
+        """
+        Parse and record batch API output files, as if the responses had come back from the endpoint.
+        """
+        self.logger.info(f"Ingesting batch results from {len(paths)} files.")
+        stats = {"ingested": 0, "skipped": 0, "failed": 0}
+        for prompt_idx, response, error in tqdm(iter_batch_results(paths)):
+            offset = prompt_idx - self.start_idx
+            if offset < 0 or offset >= self.num_prompts or self.checkpoint.is_done(prompt_idx):
+                stats["skipped"] += 1
+                continue
+            if response is None:
+                self.logger.error(f"Request for prompt {prompt_idx} failed: {error}")
+                stats["failed"] += 1
+                continue
+            
+            # Remove all special token tags (these are specific to LLava style models)
+            response = re.sub("<.*>", "", response)
+            try:
+                json_response = self.parse_response(response)
+            except:
+                self.logger.error("Failing due to invalid format. Skipping ahead.")
+                json_response = None
+            self.record_result(offset, self.prompt_file.slice(prompt_idx, 1)[0], json_response)
+            stats["ingested"] += 1
+        self.logger.info(f"Batch results: {stats}")
+        self.log_run_stats()
+    
+    def log_run_stats(self):
+        self.image_cache.log_stats()
+        if self.response_cache is not None:
+            self.response_cache.log_stats()
+        self.model.log_stats()
+        self.logger.info(f"Response parsing: {self.parse_stats}")
+    
+    def extract_json_part(self, input_string):
+        """
+        Parse the JSON in a response, repairing it locally if needed. Returns the parsed JSON and
+        whether a repair was needed, raises ValueError if the response could not be parsed.
+        """
+        try:
+            return loads_strict(input_string), False
+        except ValueError:
+            return loads_repaired(input_string), True
+
+    def validate_response(self, json_response):
+        if isinstance(json_response, dict):
+            json_response = [json_response]
+        self.logger.debug(json_response)
+        for datum in json_response:
+            assert "A" in datum 
+            if self.mode == GenerationMode.VQA:
+                assert "Q" in datum
+                assert "R" in datum
+            elif self.mode == GenerationMode.VQA_NR or self.mode == GenerationMode.VQA_TASK_DESC:
+                assert "Q" in datum
+            elif self.mode == GenerationMode.TQA:
+                assert "Q" in datum
+                assert "I" in datum
+                assert "R" in datum
+            for key in datum:
+                datum[key] = str(datum[key])
+        return json_response
+
+    def count_parse(self, outcome, metrics=None):
+        with self.parse_stats_lock:
+            self.parse_stats[outcome] += 1
+        if metrics is not None:
+            metrics["parse"] = outcome
+
+    def parse_response(self, response, metrics=None):
+        """
+        Parse a response, first as is, then with local repairs and only then by asking the format
+        fixing agent (up to 3 times), since each fix is a full extra model call.
+        """
+        fix_metrics = metrics["format_fix"] if metrics is not None else None
+        try:
+            json_response, repaired = self.extract_json_part(response)
+            json_response = self.validate_response(json_response)
+            self.count_parse("local_fix" if repaired else "clean", metrics)
+            return json_response
+        except:
+            pass
         num_tries = 0
         while num_tries < 3:
+            num_tries += 1
+            self.logger.warning("Incorrect formatting: using format fixing agent.")
+            self.logger.warning(response)
+            response = self.format_fix_agent.generate([FIX_FORMAT_QA_GEN_PROMPT, response], metrics=fix_metrics)
+            self.logger.warning(response)
             try:
-                json_response = json.loads(self.extract_json_part(response))
-                self.logger.debug(json_response)
-                for datum in json_response:
-                    assert "A" in datum 
-                    if self.mode == GenerationMode.VQA:
-                        assert "Q" in datum
-                        assert "R" in datum
-                    elif self.mode == GenerationMode.VQA_NR or self.mode == GenerationMode.VQA_TASK_DESC:
-                        assert "Q" in datum
-                    elif self.mode == GenerationMode.TQA:
-                        assert "Q" in datum
-                        assert "I" in datum
-                        assert "R" in datum
-                    for key in datum:
-                        datum[key] = str(datum[key])
+                json_response = self.validate_response(self.extract_json_part(response)[0])
+                self.count_parse("remote_fix", metrics)
                 return json_response
             except:
-                num_tries += 1
-                self.logger.warning("Incorrect formatting: using format fixing agent.")
-                self.logger.warning(response)
-                response = self.format_fix_agent.generate([FIX_FORMAT_QA_GEN_PROMPT, response])
-                self.logger.warning(response)
+                pass
+        self.count_parse("give_up", metrics)
         raise ValueError("Unable to parse")
             
-    def save_gen_text(self):
-        # Formatting gen qa into desired json format
-        formatted_gen_text = [] 
-        
-        for i, (gen_obj, image_path, indices, keyword) in tqdm(enumerate(zip(self.gen_text, self.gen_image_paths, self.gen_icl_indices, self.gen_keywords))):
-            self.logger.debug(f"Question and Answer: {gen_obj}")
-            choices = ""
-            for key in gen_obj:
-                if str(key).lower() == "choices":
-                    choices = str(gen_obj[key])
-                    choices = " " + choices + " "
-                    
-            if self.mode == GenerationMode.VQA:
-                formatted_gen_text.append(
-                    {
-                        "id": i,
-                        "image_1": image_path, 
-                        "conversations":
-                            [
-                                {
-                                    "from": "human",
-                                    "value": "<image> " + gen_obj["Q"] + choices + "\n" + REASONING_PROMPT
-                                }, 
-                                {
-                                    "from": "gpt",
-                                    "value": gen_obj["R"] + "\n" + gen_obj["A"]
-                                }
-                            ],
-                        "icl_indices": indices,
-                        "keyword": keyword
-                    }
-                )
-                
-                formatted_gen_text.append(
-                    {
-                        "id": i, 
-                        "image_1": image_path, 
-                        "conversations":
-                            [
-                                {
-                                    "from": "human",
-                                    "value": "<image> " + gen_obj["Q"] + choices + "\n" + ONLY_ANS_PROMPT
-                                }, 
-                                {
-                                    "from": "gpt",
-                                    "value": gen_obj["A"]
-                                }
-                            ],
-                        "icl_indices": indices,
-                        "keyword": keyword
-                    }
-                )
-            elif self.mode == GenerationMode.VQA_NR or self.mode == GenerationMode.VQA_TASK_DESC:
-                formatted_gen_text.append(
-                    {
-                        "id": i, 
-                        "image_1": image_path, 
-                        "conversations":
-                            [
-                                {
-                                    "from": "human",
-                                    "value": "<image> " + gen_obj["Q"] + choices
-                                }, 
-                                {
-                                    "from": "gpt",
-                                    "value": gen_obj["A"]
-                                }
-                            ],
-                        "icl_indices": indices,
-                        "keyword": keyword
-                    }
-                )
-            elif self.mode == GenerationMode.TQA:
-                formatted_gen_text.append(
-                    {
-                        "id": i, 
-                        "conversations":
-                            [
-                                {
-                                    "from": "human",
-                                    "value":  gen_obj["I"] + "\n" + gen_obj["Q"] + choices + "\n" + REASONING_PROMPT
-                                }, 
-                                {
-                                    "from": "gpt",
-                                    "value": gen_obj["R"] + "\n" + gen_obj["A"]
-                                }
-                            ],
-                        "icl_indices": indices,
-                        "keyword": keyword
-                    }
-                )
-                
-                formatted_gen_text.append(
-                    {
-                        "id": i, 
-                        "image_1": image_path, 
-                        "conversations":
-                            [
-                                {
-                                    "from": "human",
-                                    "value":  gen_obj["I"] + "\n"  + gen_obj["Q"] + choices + "\n" + ONLY_ANS_PROMPT
-                                }, 
-                                {
-                                    "from": "gpt",
-                                    "value": gen_obj["A"]
-                                }
-                            ],
-                        "icl_indices": indices,
-                        "keyword": keyword
-                    }
-                )
-            else:
-                EXP_SYS_PROMPT = f"Describe the image as an expert in " + self.prompt_file["dataset_description"]
-                if GenerationMode.GENERIC:
-                    EXP_SYS_PROMPT = "Describe the image."
+    def format_gen_obj(self, gen_id, gen_obj, image_path, indices, keyword):
+        """
+        Format a single generated object into the samples of the desired json format.
+        """
+        formatted_gen_text = []
+        self.logger.debug(f"Question and Answer: {gen_obj}")
+        choices = ""
+        for key in gen_obj:
+            if str(key).lower() == "choices":
+                choices = str(gen_obj[key])
+                choices = " " + choices + " "
                 
-                formatted_gen_text.append(
-                    {
-                        "id": i, 
-                        "image_1": image_path, 
-                        "conversations":
-                            [
-                                {
-                                    "from": "human",
-                                    "value": "<image> " + EXP_SYS_PROMPT
-                                }, 
-                                {
-                                    "from": "gpt",
-                                    "value": gen_obj["A"]
-                                }
-                            ],
-                        "icl_indices": indices,
-                        "keyword": keyword
-                    }
-                )
+        if self.mode == GenerationMode.VQA:
+            formatted_gen_text.append(
+                {
+                    "id": gen_id,
+                    "image_1": image_path, 
+                    "conversations":
+                        [
+                            {
+                                "from": "human",
+                                "value": "<image> " + gen_obj["Q"] + choices + "\n" + REASONING_PROMPT
+                            }, 
+                            {
+                                "from": "gpt",
+                                "value": gen_obj["R"] + "\n" + gen_obj["A"]
+                            }
+                        ],
+                    "icl_indices": indices,
+                    "keyword": keyword
+                }
+            )
             
-        # Saving formatted qa
-        self.logger.info(f"Saving {len(formatted_gen_text)} generated examples.")
+            formatted_gen_text.append(
+                {
+                    "id": gen_id, 
+                    "image_1": image_path, 
+                    "conversations":
+                        [
+                            {
+                                "from": "human",
+                                "value": "<image> " + gen_obj["Q"] + choices + "\n" + ONLY_ANS_PROMPT
+                            }, 
+                            {
+                                "from": "gpt",
+                                "value": gen_obj["A"]
+                            }
+                        ],
+                    "icl_indices": indices,
+                    "keyword": keyword
+                }
+            )
+        elif self.mode == GenerationMode.VQA_NR or self.mode == GenerationMode.VQA_TASK_DESC:
+            formatted_gen_text.append(
+                {
+                    "id": gen_id, 
+                    "image_1": image_path, 
+                    "conversations":
+                        [
+                            {
+                                "from": "human",
+                                "value": "<image> " + gen_obj["Q"] + choices
+                            }, 
+                            {
+                                "from": "gpt",
+                                "value": gen_obj["A"]
+                            }
+                        ],
+                    "icl_indices": indices,
+                    "keyword": keyword
+                }
+            )
+        elif self.mode == GenerationMode.TQA:
+            formatted_gen_text.append(
+                {
+                    "id": gen_id, 
+                    "conversations":
+                        [
+                            {
+                                "from": "human",
+                                "value":  gen_obj["I"] + "\n" + gen_obj["Q"] + choices + "\n" + REASONING_PROMPT
+                            }, 
+                            {
+                                "from": "gpt",
+                                "value": gen_obj["R"] + "\n" + gen_obj["A"]
+                            }
+                        ],
+                    "icl_indices": indices,
+                    "keyword": keyword
+                }
+            )
+            
+            formatted_gen_text.append(
+                {
+                    "id": gen_id, 
+                    "image_1": image_path, 
+                    "conversations":
+                        [
+                            {
+                                "from": "human",
+                                "value":  gen_obj["I"] + "\n"  + gen_obj["Q"] + choices + "\n" + ONLY_ANS_PROMPT
+                            }, 
+                            {
+                                "from": "gpt",
+                                "value": gen_obj["A"]
+                            }
+                        ],
+                    "icl_indices": indices,
+                    "keyword": keyword
+                }
+            )
+        else:
+            EXP_SYS_PROMPT = f"Describe the image as an expert in " + self.prompt_file.header["dataset_description"]
+            if GenerationMode.GENERIC:
+                EXP_SYS_PROMPT = "Describe the image."
+            
+            formatted_gen_text.append(
+                {
+                    "id": gen_id, 
+                    "image_1": image_path, 
+                    "conversations":
+                        [
+                            {
+                                "from": "human",
+                                "value": "<image> " + EXP_SYS_PROMPT
+                            }, 
+                            {
+                                "from": "gpt",
+                                "value": gen_obj["A"]
+                            }
+                        ],
+                    "icl_indices": indices,
+                    "keyword": keyword
+                }
+            )
+        return formatted_gen_text
+    
+    def save_gen_text(self):
+        # Formatted samples were streamed to the checkpoint during generation, assemble final json
+        self.logger.info(f"Saving {self.checkpoint.num_samples} generated examples.")
+        header = {
+            "image_folder": "", # for backward compatibility
+            "len_samples": self.checkpoint.num_samples,
+            "start_idx": self.start_idx, 
+            "end_idx": self.checkpoint.end_idx(self.start_idx),
+            "num_prompts": self.num_prompts,
+        }
         with open(self.gen_data_path, 'w') as file:
-            json.dump({
-                "image_folder": "", # for backward compatibility
-                "len_samples": len(formatted_gen_text),
-                "start_idx": self.start_idx, 
-                "end_idx": self.end_idx,
-                "num_prompts": self.num_prompts,
-                "samples": formatted_gen_text,
-            }, file, indent=3)
+            # Write samples one by one rather than holding them all in memory
+            file.write(json.dumps(header, indent=3)[:-2] + ',\n   "samples": [')
+            for i, sample in enumerate(tqdm(self.checkpoint.iter_samples(), total=self.checkpoint.num_samples)):
+                file.write(("," if i > 0 else "") + "\n      " + json.dumps(sample))
+            file.write("\n   ]\n}")
+        self.checkpoint.close()
             
         self.logger.info(f"Saved generated questions to {self.gen_data_path}")
 
@@ -687,6 +1040,50 @@ def is_image_file(filename):
     image_extensions = ('.png', '.jpg', '.jpeg')
     return filename.lower().endswith(image_extensions)
 
+def run_queue_worker(args, generator):
+    """
+    Lease prompt ranges from the work queue and generate them until the queue is drained.
+    """
+    queue = WorkQueue(args.queue_db, lease_sec=args.lease_sec)
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    generator.heartbeat_interval_sec = args.lease_sec / 4
+    checkpoint_folder = os.path.join(generator.output_folder, SAVE_PATH)
+    
+    work = queue.lease(worker_id)
+    while work is not None:
+        logger.info(f"Leased prompts [{work['start_idx']}, {work['start_idx'] + work['num_prompts']}), attempt {work['attempt']}.")
+        file_prefix = f"{args.file_prefix}_{work['start_idx']}"
+        # Each attempt has its own checkpoint: the worker of an expired lease may still be appending to
+        # its checkpoint until it notices, so ranges are picked up from a copy of its completed prompts
+        checkpoint_prefix = f"{file_prefix}.attempt{work['attempt']}"
+        for attempt in range(work["attempt"] - 1, 0, -1):
+            previous_prefix = f"{file_prefix}.attempt{attempt}"
+            if os.path.exists(checkpoint_paths(checkpoint_folder, previous_prefix)[1]):
+                num_adopted = adopt_checkpoint(checkpoint_folder, previous_prefix, checkpoint_prefix)
+                logger.info(f"Adopted {num_adopted} prompts done by attempt {attempt}.")
+                break
+        generator.set_range(work["start_idx"], work["num_prompts"], file_prefix, resume=True, checkpoint_prefix=checkpoint_prefix)
+        generator.heartbeat = lambda: queue.renew(work["range_id"], worker_id, generator.num_done())
+        
+        generator.generate_questions()
+        
+        num_done = generator.num_done()
+        if num_done < work["num_prompts"]:
+            logger.error(f"Only {num_done} of {work['num_prompts']} prompts done, releasing range.")
+            queue.release(work["range_id"], worker_id, num_done)
+            generator.checkpoint.close()
+        elif queue.renew(work["range_id"], worker_id, num_done):
+            generator.save_gen_text()
+            queue.complete(work["range_id"], worker_id, num_done)
+            logger.info(f"Finished range. See generated data in {generator.gen_data_path}")
+        else:
+            logger.error("Lease on range lost to another worker, discarding.")
+            generator.checkpoint.close()
+        work = queue.lease(worker_id)
+    
+    logger.info(f"Work queue drained: {queue.progress()}")
+    queue.close()
+
 def main(args):
     # Set logging level
     logger.remove()
@@ -697,22 +1094,38 @@ def main(args):
 
     # Load data from JSON file
     args.prompt_file = os.path.join(args.input_folder, args.prompt_file)
-    args.prompt_file = load_json_file(args.prompt_file)
+    args.prompt_file = load_prompt_file(args.prompt_file)
+    if args.start_idx is None:
+        # Shards of a sharded prompt run start where the previous shard ends
+        args.start_idx = args.prompt_file.start_idx
     if args.num_prompts == -1:
-        args.num_prompts = len(args.prompt_file["prompts"])
+        args.num_prompts = len(args.prompt_file)
     
     # Initialize generator
     generator = MultimodalDataGenerator(args, logger)
     
-    logger.info("Generating questions and answers.")
-    generator.generate_questions()
+    if args.queue_db:
+        run_queue_worker(args, generator)
+        return
+    
+    if args.batch_export_folder:
+        generator.export_batch_requests(args.batch_export_folder, args.batch_model_name or args.model_name)
+        generator.checkpoint.close()
+        return
+    
+    if args.batch_results:
+        logger.info("Ingesting batch results.")
+        generator.ingest_batch_results(args.batch_results)
+    else:
+        logger.info("Generating questions and answers.")
+        generator.generate_questions()
     
     logger.info("Saving generated questions and answers.")
     generator.save_gen_text()
     
     logger.info(f"Finished. See generated data in {generator.gen_data_path}")
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser(description="Multimodal Data Generator")
     parser.add_argument("--model_name", type=str, default="gpt-4o-450K", help="Name of model to use with GPT4 endpoint")
     parser.add_argument("--azure_endpoint_url", type=str, default="", help="Endpoint to use")
@@ -720,9 +1133,44 @@ if __name__ == "__main__":
     parser.add_argument('--output_folder', type=str, default="", help='Output Folder')
     parser.add_argument("--prompt_file", type=str, required=True, help="Path to the JSON file containing the prompts")
     parser.add_argument("--file_prefix", type=str, required=True, help="Prefix for file with generated questions")
-    parser.add_argument("--start_idx", type=int, default=0, help="Index to start at in the list of the prompts.")
+    parser.add_argument("--start_idx", type=int, default=None, help="Index to start at in the list of the prompts, defaults to the first prompt of the file.")
     parser.add_argument("--num_prompts", type=int, default=-1, help="Number of prompts to process.")
+    parser.add_argument("--concurrency", type=int, default=1, help="Number of requests to keep in flight (> 1 enables async generation).")
+    parser.add_argument("--prefix_order", action='store_true', help="Send prompts sharing keyword and ICL examples back to back, with the candidate image last, so provider side prompt caching can hit.")
+    parser.add_argument("--base_url", type=str, default="", help="OpenAI compatible endpoint to use instead of Azure (e.g. a local server).")
+    parser.add_argument("--mock_latency_sec", type=float, default=0.0, help="Simulated mean latency per request for the mock model.")
+    parser.add_argument("--mock_latency_dist", type=str, default="fixed", choices=LATENCY_DISTRIBUTIONS, help="Distribution of the mock model's latency.")
+    parser.add_argument("--mock_throttle_rate", type=float, default=0.0, help="Share of mock requests answered with a 429.")
+    parser.add_argument("--mock_error_rate", type=float, default=0.0, help="Share of mock requests answered with a 500 or 503.")
+    parser.add_argument("--mock_malformed_rate", type=float, default=0.0, help="Share of mock responses with malformed JSON.")
+    parser.add_argument("--mock_seed", type=int, default=None, help="Random seed of the mock model.")
+    parser.add_argument("--rpm_limit", type=int, default=0, help="Requests/min quota of the deployment, shared by all processes on this host (0 disables).")
+    parser.add_argument("--tpm_limit", type=int, default=0, help="Tokens/min quota of the deployment, shared by all processes on this host (0 disables).")
+    parser.add_argument("--rate_limit_dir", type=str, default=DEFAULT_STATE_DIR, help="Folder holding the shared rate limiter state.")
+    parser.add_argument("--deployments", type=str, nargs="+", default=[], help="Deployments (model_name[@url]) to spread requests over, instead of the single model_name endpoint.")
+    parser.add_argument("--eject_sec", type=float, default=DEFAULT_EJECT_SEC, help="Base cooldown of a deployment ejected after throttling or repeated errors.")
+    parser.add_argument("--prefetch_workers", type=int, default=DEFAULT_PREFETCH_WORKERS, help="Threads loading and encoding the images of upcoming prompts while requests are in flight.")
+    parser.add_argument("--prefetch_depth", type=int, default=DEFAULT_PREFETCH_DEPTH, help="Upcoming prompts to keep loaded at most (raised to concurrency if lower).")
+    parser.add_argument("--image_cache_dir", type=str, default="", help="Folder for the on-disk encoded image cache, shared across processes and re-runs (empty disables).")
+    parser.add_argument("--image_cache_mb", type=int, default=DEFAULT_MEMORY_MB, help="Size of the in-memory encoded image cache in MB.")
+    parser.add_argument("--no_image_passthrough", action='store_true', help="Always re-encode images instead of sending acceptable JPEG/PNG files as is.")
+    parser.add_argument("--image_max_side", type=int, default=MAX_SIDE, help="Downscale images so their longest side is at most this many pixels.")
+    parser.add_argument("--image_format", type=str, default="JPEG", choices=["JPEG", "PNG"], help="Format used when re-encoding images.")
+    parser.add_argument("--image_quality", type=int, default=75, help="Quality used when re-encoding images as JPEG.")
+    parser.add_argument("--icl_image_detail", type=str, default=None, choices=["auto", "low", "high"], help="Detail for ICL images (defaults to the per mode policy).")
+    parser.add_argument("--candidate_image_detail", type=str, default=None, choices=["auto", "low", "high"], help="Detail for candidate images (defaults to the per mode policy).")
+    parser.add_argument("--resume", action='store_true', help="Resume from the checkpoint of a previous run with the same output folder and file prefix.")
+    parser.add_argument("--queue_db", type=str, default="", help="Work queue to lease prompt ranges from (see batch_data_generator.py), instead of start_idx/num_prompts.")
+    parser.add_argument("--lease_sec", type=float, default=DEFAULT_LEASE_SEC, help="Lease duration on a prompt range, renewed while working on it.")
+    parser.add_argument("--response_cache", type=str, default="", help="SQLite file caching raw responses, so re-runs re-parse instead of re-sending requests (empty disables).")
+    parser.add_argument("--response_cache_mb", type=int, default=DEFAULT_MAX_MB, help="Size above which least recently used responses are evicted from the cache.")
+    parser.add_argument("--batch_export_folder", type=str, default="", help="Write requests to batch API input files in this folder instead of sending them.")
+    parser.add_argument("--batch_model_name", type=str, default="", help="Model (deployment) name to put in exported batch requests, defaults to model_name.")
+    parser.add_argument("--batch_results", type=str, nargs="+", default=None, help="Batch API output files to parse and save instead of sending requests.")
     parser.add_argument("--debug", action='store_true', help="Enable debug logging")
 
-    args = parser.parse_args()
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
     main(args)
\ No newline at end of file
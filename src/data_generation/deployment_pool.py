@@ -0,0 +1,216 @@
+from azure.identity import get_bearer_token_provider, AzureCliCredential
+from openai import AzureOpenAI, AsyncAzureOpenAI, OpenAI, AsyncOpenAI
+from src.data_generation.rate_limiter import DEFAULT_STATE_DIR, RateLimiter
+from urllib.parse import urlparse
+import os
+import random
+import threading
+import time
+
+AZURE_API_VERSION = "2023-06-01-preview"
+
+# Cooldown of an ejected deployment, doubled on every ejection in a row up to MAX_EJECT_SEC
+DEFAULT_EJECT_SEC = 30
+MAX_EJECT_SEC = 600
+
+# Server errors in a row before a deployment is ejected. A 429 ejects it right away.
+MAX_CONSECUTIVE_ERRORS = 3
+
+# Weight of the latest observation in the latency and throttle rate moving averages
+EWMA_ALPHA = 0.2
+
+# Latency assumed for deployments that have not answered yet, so they get tried
+INITIAL_LATENCY_SEC = 1.0
+
+# Lower bound on the weight factors, so no healthy deployment starves entirely
+MIN_FACTOR = 0.02
+
+def default_azure_endpoint_url(model_name):
+    if "australia" in model_name:
+        return "https://openai-models-australia-east.openai.azure.com/"
+    return "https://openai-models-west-us3.openai.azure.com/"
+
+def parse_deployment(spec):
+    """
+    Split a deployment spec of the form model_name[@url] into its model name and url.
+    """
+    model_name, _, url = spec.partition("@")
+    return model_name, url
+
+def is_azure_url(url):
+    return (urlparse(url).hostname or "").endswith(".azure.com")
+
+def header_fraction(headers, remaining_header, limit_header):
+    try:
+        return float(headers[remaining_header]) / float(headers[limit_header])
+    except (KeyError, TypeError, ValueError, ZeroDivisionError):
+        return None
+
+class Deployment:
+    """
+    A single model deployment: its clients, rate limiter and observed health.
+    """
+    def __init__(self, model_name, url, rpm_limit=0, tpm_limit=0, rate_limit_dir=DEFAULT_STATE_DIR, azure=None, logger=None):
+        self.model_name = model_name
+        self.url = url
+        self.azure = azure if azure is not None else is_azure_url(url)
+        self.key = f"{model_name}@{url}"
+        self.logger = logger
+
+        # Shared by every process on this host talking to the same deployment
+        self.rate_limiter = RateLimiter(self.key, rpm_limit=rpm_limit, tpm_limit=tpm_limit, state_dir=rate_limit_dir, logger=logger)
+
+        self.client = None
+        self.async_client = None
+        self.latency_sec = None
+        self.throttle_rate = 0.0
+        self.quota_fraction = None
+        self.in_flight = 0
+        self.consecutive_errors = 0
+        self.consecutive_ejections = 0
+        self.ejected_until = 0.0
+        self.stats = {"requests": 0, "succeeded": 0, "throttled": 0, "errors": 0, "ejections": 0}
+
+    def create_clients(self):
+        # Retries are ours to make, so a 429 or server error can be routed to another deployment
+        if self.azure:
+            token_provider = get_bearer_token_provider(
+                AzureCliCredential(), "https://cognitiveservices.azure.com/.default"
+            )
+            self.client = AzureOpenAI(api_version=AZURE_API_VERSION, azure_endpoint=self.url, azure_ad_token_provider=token_provider, max_retries=0)
+            self.async_client = AsyncAzureOpenAI(api_version=AZURE_API_VERSION, azure_endpoint=self.url, azure_ad_token_provider=token_provider, max_retries=0)
+        else:
+            # OpenAI compatible stand-in, e.g. a local server
+            api_key = os.environ.get("OPENAI_API_KEY", "EMPTY")
+            self.client = OpenAI(base_url=self.url, api_key=api_key, max_retries=0)
+            self.async_client = AsyncOpenAI(base_url=self.url, api_key=api_key, max_retries=0)
+
+    def remaining_quota(self):
+        """
+        Fraction of the quota left, from the service's rate limit headers if it sends them,
+        else from the client side rate limiter as of its last use. Does no file I/O, so it can
+        be called for every deployment on every pick.
+        """
+        if self.quota_fraction is not None:
+            return self.quota_fraction
+        if not self.rate_limiter.is_enabled():
+            return 1.0
+        return self.rate_limiter.cached_headroom()
+
+    def summary(self):
+        return {
+            **self.stats,
+            "latency_sec": round(self.latency_sec, 3) if self.latency_sec is not None else None,
+            "throttle_rate": round(self.throttle_rate, 3)
+        }
+
+class DeploymentPool:
+    """
+    Spreads requests over a set of deployments of the model, weighted by how fast they answer,
+    how often they throttle and how much quota they have left. Deployments that throttle or keep
+    failing are ejected for a cooldown, so requests go to the healthy ones in the meantime.
+
+    Safe to share between threads and between the endpoints (e.g. generation and format fixing)
+    of a process.
+    """
+    def __init__(self, deployments, eject_sec=DEFAULT_EJECT_SEC, logger=None):
+        assert len(deployments) > 0, "Deployment pool needs at least one deployment"
+        self.deployments = deployments
+        self.eject_sec = eject_sec
+        self.logger = logger
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.deployments)
+
+    def weight(self, deployment):
+        latency_sec = deployment.latency_sec if deployment.latency_sec is not None else INITIAL_LATENCY_SEC
+        # Expected wait grows with the requests already in flight on the deployment
+        expected_sec = latency_sec * (1 + deployment.in_flight)
+        health = max(MIN_FACTOR, 1 - deployment.throttle_rate) ** 2
+        quota = max(MIN_FACTOR, deployment.remaining_quota())
+        return health * quota / expected_sec
+
+    def choose(self):
+        """
+        Pick a deployment for the next request. If every deployment is ejected, the one that
+        comes back first is returned; callers wait on its ejected_until.
+        """
+        now = time.time()
+        with self.lock:
+            healthy = [deployment for deployment in self.deployments if deployment.ejected_until <= now]
+            if healthy:
+                deployment = random.choices(healthy, weights=[self.weight(deployment) for deployment in healthy])[0]
+            else:
+                deployment = min(self.deployments, key=lambda deployment: deployment.ejected_until)
+            deployment.in_flight += 1
+            deployment.stats["requests"] += 1
+        return deployment
+
+    def release(self, deployment):
+        """
+        Called once a request chosen for the deployment is over, whatever its outcome.
+        """
+        with self.lock:
+            deployment.in_flight -= 1
+
+    def report_success(self, deployment, latency_sec, headers=None):
+        with self.lock:
+            deployment.stats["succeeded"] += 1
+            if deployment.latency_sec is None:
+                deployment.latency_sec = latency_sec
+            else:
+                deployment.latency_sec += EWMA_ALPHA * (latency_sec - deployment.latency_sec)
+            deployment.throttle_rate *= 1 - EWMA_ALPHA
+            deployment.consecutive_errors = 0
+            deployment.consecutive_ejections = 0
+            if headers is not None:
+                fractions = [
+                    header_fraction(headers, "x-ratelimit-remaining-requests", "x-ratelimit-limit-requests"),
+                    header_fraction(headers, "x-ratelimit-remaining-tokens", "x-ratelimit-limit-tokens")
+                ]
+                fractions = [fraction for fraction in fractions if fraction is not None]
+                if fractions:
+                    deployment.quota_fraction = min(fractions)
+
+    def report_throttle(self, deployment, retry_after_sec=None):
+        with self.lock:
+            deployment.stats["throttled"] += 1
+            deployment.throttle_rate += EWMA_ALPHA * (1 - deployment.throttle_rate)
+            # Stale once throttled, re-read from the next successful response
+            deployment.quota_fraction = None
+            self.eject(deployment, retry_after_sec)
+
+    def report_error(self, deployment):
+        with self.lock:
+            deployment.stats["errors"] += 1
+            deployment.consecutive_errors += 1
+            if deployment.consecutive_errors >= MAX_CONSECUTIVE_ERRORS:
+                deployment.consecutive_errors = 0
+                self.eject(deployment)
+
+    def eject(self, deployment, cooldown_sec=None):
+        if cooldown_sec is None:
+            cooldown_sec = min(MAX_EJECT_SEC, self.eject_sec * 2 ** deployment.consecutive_ejections)
+        deployment.consecutive_ejections += 1
+        deployment.ejected_until = max(deployment.ejected_until, time.time() + cooldown_sec)
+        deployment.stats["ejections"] += 1
+        if self.logger is not None and len(self.deployments) > 1:
+            self.logger.warning(f"Deployment {deployment.key} ejected for {cooldown_sec:.1f} seconds.")
+
+    def summary(self):
+        with self.lock:
+            return {deployment.key: deployment.summary() for deployment in self.deployments}
+
+def create_pool(specs, rpm_limit=0, tpm_limit=0, rate_limit_dir=DEFAULT_STATE_DIR, eject_sec=DEFAULT_EJECT_SEC, logger=None):
+    """
+    Build a pool from deployment specs (model_name[@url]). Deployments without a url use the
+    default Azure endpoint for their model. Quota limits apply to each deployment separately.
+    """
+    deployments = []
+    for spec in specs:
+        model_name, url = parse_deployment(spec)
+        deployment = Deployment(model_name, url or default_azure_endpoint_url(model_name), rpm_limit, tpm_limit, rate_limit_dir, logger=logger)
+        deployment.create_clients()
+        deployments.append(deployment)
+    return DeploymentPool(deployments, eject_sec=eject_sec, logger=logger)
@@ -0,0 +1,100 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.data_generation.simulated_backend import LATENCY_DISTRIBUTIONS, SimulatedBackend
+import argparse
+import json
+import threading
+import time
+
+class FakeOpenAIServer:
+    """
+    Serves a SimulatedBackend as a local OpenAI compatible chat completions endpoint.
+    """
+    def __init__(self, backend=None, host="127.0.0.1", port=0):
+        self.backend = backend if backend is not None else SimulatedBackend()
+        self.server = ThreadingHTTPServer((host, port), self.make_handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_handler(self):
+        backend = self.backend
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_json(self, status, body, headers):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for header, value in headers.items():
+                    self.send_header(header, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not self.path.endswith("/chat/completions"):
+                    self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}}, {})
+                    return
+                status, body, headers, delay_sec = backend.respond(request)
+                time.sleep(delay_sec)
+                self.send_json(status, body, headers)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated OpenAI compatible chat completions server")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="Port to listen on")
+    parser.add_argument("--latency_sec", type=float, default=0.2, help="Mean seconds before each response")
+    parser.add_argument("--latency_dist", type=str, default="lognormal", choices=LATENCY_DISTRIBUTIONS, help="Distribution of the response latency")
+    parser.add_argument("--latency_sigma", type=float, default=0.5, help="Sigma of the lognormal latency distribution")
+    parser.add_argument("--sec_per_token", type=float, default=0.0, help="Extra latency per completion token")
+    parser.add_argument("--throttle_rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--rpm_limit", type=int, default=0, help="Requests/min over which requests are answered with a 429 (0 disables)")
+    parser.add_argument("--tpm_limit", type=int, default=0, help="Tokens/min over which requests are answered with a 429 (0 disables)")
+    parser.add_argument("--retry_after_sec", type=float, default=1.0, help="Retry-After sent with 429s")
+    parser.add_argument("--error_rate", type=float, default=0.0, help="Share of requests answered with a 500 or 503")
+    parser.add_argument("--malformed_rate", type=float, default=0.0, help="Share of responses with malformed JSON")
+    parser.add_argument("--answer_words", type=int, default=30, help="Approximate words per generated reasoning/answer")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed")
+    parser.add_argument("--stats_interval_sec", type=float, default=60, help="Seconds between printing request stats")
+    args = parser.parse_args()
+
+    backend = SimulatedBackend(
+        latency_sec=args.latency_sec,
+        latency_dist=args.latency_dist,
+        latency_sigma=args.latency_sigma,
+        sec_per_token=args.sec_per_token,
+        throttle_rate=args.throttle_rate,
+        rpm_limit=args.rpm_limit,
+        tpm_limit=args.tpm_limit,
+        retry_after_sec=args.retry_after_sec,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        answer_words=args.answer_words,
+        seed=args.seed
+    )
+    server = FakeOpenAIServer(backend, args.host, args.port).start()
+    print(f"Serving on {server.url}", flush=True)
+    try:
+        while True:
+            time.sleep(args.stats_interval_sec)
+            print(json.dumps(backend.stats), flush=True)
+    except KeyboardInterrupt:
+        server.stop()
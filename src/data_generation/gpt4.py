@@ -1,7 +1,15 @@
 from PIL import Image
-from azure.identity import get_bearer_token_provider, AzureCliCredential
 from io import BytesIO
-from openai import AzureOpenAI, RateLimitError, AuthenticationError
+from openai import APIConnectionError, AuthenticationError, InternalServerError, RateLimitError
+from src.data_generation.deployment_pool import Deployment, DeploymentPool, default_azure_endpoint_url
+from src.data_generation.image_payload import EncodedImage, PayloadConfig, PayloadStats, encode_pil_image
+from src.data_generation.metrics import new_call_metrics, request_payload_bytes
+from src.data_generation.minimal_dep_utils import is_image_file
+from src.data_generation.prefix_cache import PrefixCacheStats
+from src.data_generation.response_cache import request_key
+from src.data_generation.rate_limiter import DEFAULT_STATE_DIR, estimate_content_tokens, estimate_request_tokens, get_retry_after_sec
+from src.data_generation.simulated_backend import SimulatedBackend
+import asyncio
 import base64
 import subprocess 
 import time 
@@ -37,7 +45,16 @@ class GPTEndPoint:
         max_retries=5,
         retry_delay_sec=2,
         pim_retry_delay_sec=120,
-        azure_endpoint_url=""
+        azure_endpoint_url="",
+        base_url="",
+        mock_latency_sec=0.0,
+        rpm_limit=0,
+        tpm_limit=0,
+        rate_limit_dir=DEFAULT_STATE_DIR,
+        payload_config=None,
+        response_cache=None,
+        pool=None,
+        mock_backend=None
     ):
         
         supported_model_names = ['gpt-4o', 'gpt-4o-450K', 'gpt-4-july', 'gpt-4o-australia-east', 'gpt-4o-australia-east-2', 'mock']
@@ -45,9 +62,7 @@ class GPTEndPoint:
         self.model_name = model_name
         
         if azure_endpoint_url is "":
-            self.azure_endpoint_url = "https://openai-models-west-us3.openai.azure.com/"
-            if "australia" in self.model_name:
-                self.azure_endpoint_url = "https://openai-models-australia-east.openai.azure.com/"
+            self.azure_endpoint_url = default_azure_endpoint_url(self.model_name)
         else:
             self.azure_endpoint_url = azure_endpoint_url
         
@@ -56,27 +71,43 @@ class GPTEndPoint:
         self.max_retries = max_retries
         self.retry_delay_sec = retry_delay_sec
         self.pim_retry_delay_sec = pim_retry_delay_sec
+        self.base_url = base_url
+        self.mock_latency_sec = mock_latency_sec
+        self.payload_config = payload_config if payload_config is not None else PayloadConfig()
+        self.payload_stats = PayloadStats()
+        self.prefix_cache_stats = PrefixCacheStats()
+        self.response_cache = response_cache
         
         if model_name == "mock":
+            # Answers in the requested format, pass a backend to share it or simulate errors
+            self.mock_backend = mock_backend if mock_backend is not None else SimulatedBackend(latency_sec=mock_latency_sec, latency_dist="fixed")
             self.logger.debug("Mocking GPT4 API")
             for attr, value in self.__dict__.items():
                 self.logger.debug(f"{attr} = {value}")
             return
-        token_provider = get_bearer_token_provider(
-            AzureCliCredential(), "https://cognitiveservices.azure.com/.default"
-        )
         
-        self.client = AzureOpenAI(
-            api_version="2023-06-01-preview",
-            azure_endpoint=self.azure_endpoint_url,
-            azure_ad_token_provider=token_provider
-        )
+        # Requests are routed over a pool of deployments, by default just the one we were given.
+        # Pass a pool to share deployments (and their health) with other endpoints.
+        self.pool = pool
+        if self.pool is None:
+            deployment = Deployment(
+                self.model_name,
+                self.base_url or self.azure_endpoint_url,
+                rpm_limit=rpm_limit,
+                tpm_limit=tpm_limit,
+                rate_limit_dir=rate_limit_dir,
+                # OpenAI compatible stand-in (e.g. a local server) instead of Azure
+                azure=not self.base_url,
+                logger=self.logger
+            )
+            deployment.create_clients()
+            self.pool = DeploymentPool([deployment], logger=self.logger)
         
         self.logger.debug(f"GPTEndPoint created with model_name: {self.model_name}")
         self.logger.debug(f"System prompt: {self.sys_prompt}")
         self.logger.debug("Debug Mode On")
 
-    def create_request(self, contents, is_base64=False):      
+    def create_request(self, contents, is_base64=False, metrics=None):      
         messages = []
         if self.sys_prompt:
             messages.append({"role": "system", "content": self.sys_prompt})
@@ -91,17 +122,30 @@ class GPTEndPoint:
                         "text": content
                     }
                 )
+            elif is_base64:
+                self.logger.debug(f"GPT4 Content {i}: type=image (base64)")
+                user_content["content"].append(
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                        "url": f"data:image/jpg;base64,{content}",
+                        },  
+                    }
+                )
+                if metrics is not None:
+                    metrics["image_tokens"] += estimate_content_tokens(user_content["content"][-1])
             else:
                 self.logger.debug(f"GPT4 Content {i}: type=image")
                 encoded_image = content
-                if not is_base64:
-                    encoded_image = base64encode(content)
+                if not isinstance(content, EncodedImage):
+                    encoded_image = encode_pil_image(content, self.payload_config)
+                self.payload_stats.record(encoded_image)
+                if metrics is not None:
+                    metrics["image_tokens"] += encoded_image.tokens if encoded_image.tokens is not None else estimate_content_tokens({"type": "image_url", "image_url": encoded_image.image_url()})
                 user_content["content"].append(
                     {
                         "type": "image_url",
-                        "image_url": {
-                        "url": f"data:image/jpg;base64,{encoded_image}",
-                        },  
+                        "image_url": encoded_image.image_url(),
                     }
                 )
         
@@ -109,6 +153,8 @@ class GPTEndPoint:
         messages.append(user_content)
         
         request = {"messages": messages}
+        if metrics is not None:
+            metrics["payload_bytes"] += request_payload_bytes(request)
         
         self.logger.debug(f"Created request")
         
@@ -124,42 +170,204 @@ class GPTEndPoint:
 
         return request
 
-    def get_response(self, request):
+    def log_stats(self):
+        self.logger.info(f"Image payload: {self.payload_stats.summary()}")
+        self.logger.info(f"Prompt prefix cache: {self.prefix_cache_stats.summary()}")
+        if self.model_name == "mock":
+            self.logger.info(f"Mock backend: {self.mock_backend.stats}")
+        else:
+            self.logger.info(f"Deployments: {self.pool.summary()}")
+
+    def handle_error(self, error, deployment, attempt):
+        """
+        Record a failed attempt against its deployment. Returns how long to wait before the
+        next attempt, or raises the error once out of attempts.
+        """
+        if isinstance(error, RateLimitError):
+            # Prefer the service's Retry-After hint over our own backoff
+            wait_sec = get_retry_after_sec(error)
+            if wait_sec is None:
+                wait_sec = self.retry_delay_sec * (attempt + 1)
+            # Ejecting the deployment holds off this process, the rate limiter every other worker on this host
+            self.pool.report_throttle(deployment, wait_sec)
+            if deployment.rate_limiter.is_enabled():
+                deployment.rate_limiter.penalize(wait_sec)
+            message = f"Rate limit hit on {deployment.key}: {error}."
+        else:
+            self.pool.report_error(deployment)
+            wait_sec = self.pim_retry_delay_sec if isinstance(error, AuthenticationError) else self.retry_delay_sec * (attempt + 1)
+            message = f"{type(error).__name__} on {deployment.key}: {error}."
+        
+        if attempt + 1 >= self.max_retries:
+            self.logger.error(f"Max retries reached. Raising {type(error).__name__}.")
+            raise error
+        if len(self.pool) > 1:
+            # Other deployments in the pool can take the next attempt right away
+            self.logger.warning(f"{message} Attempt {attempt + 1} of {self.max_retries}. Retrying on the next available deployment...")
+            return 0.0
+        self.logger.warning(f"{message} Attempt {attempt + 1} of {self.max_retries}. Retrying in {wait_sec} seconds...")
+        # A throttled deployment is waited on through its ejection
+        return 0.0 if isinstance(error, RateLimitError) else wait_sec
+
+    def record_response(self, deployment, raw_response, request, estimated_tokens, latency_sec, metrics):
+        openai_response = raw_response.parse().model_dump()
+        self.logger.debug(f"Received response from {deployment.key}: {openai_response}")
+        usage = openai_response.get("usage") or {}
+        metrics["api_sec"] += latency_sec
+        metrics["prompt_tokens"] += usage.get("prompt_tokens") or 0
+        metrics["completion_tokens"] += usage.get("completion_tokens") or 0
+        metrics["cached_tokens"] += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        self.pool.report_success(deployment, latency_sec, raw_response.headers)
+        deployment.rate_limiter.reconcile(estimated_tokens, usage.get("total_tokens"))
+        self.prefix_cache_stats.record(request, usage)
+        return openai_response["choices"][0]["message"]["content"]
+
+    def get_response(self, request, metrics=None):
+        if metrics is None:
+            metrics = new_call_metrics()
+        estimated_tokens = estimate_request_tokens(request)
         for attempt in range(self.max_retries):
+            metrics["attempts"] += 1
+            deployment = self.pool.choose()
             try:
-                completion = self.client.chat.completions.create(
-                    model=self.model_name,
+                # Every deployment is cooling down, wait for the first one to come back
+                time.sleep(max(0.0, deployment.ejected_until - time.time()))
+                metrics["rate_limit_wait_sec"] += deployment.rate_limiter.acquire(estimated_tokens)
+                start_time = time.time()
+                raw_response = deployment.client.chat.completions.with_raw_response.create(
+                    model=deployment.model_name,
                     **request,
                 )
-                openai_response = completion.model_dump()
-                
-                self.logger.debug(f"Received response: {openai_response}")
-                
-                return openai_response["choices"][0]["message"]["content"]
-            
-            except RateLimitError as e:
-                if attempt + 1 < self.max_retries:
-                    self.logger.warning(f"Rate limit hit: {e}. Attempt {attempt + 1} of {self.max_retries}. Retrying in {self.retry_delay_sec} seconds...")
-                    time.sleep(self.retry_delay_sec * (attempt + 1))
-                else:
-                    self.logger.error("Max retries reached. Raising RateLimitError.")
-                    raise e
-            except AuthenticationError as e:
-                if attempt + 1 < self.max_retries:
-                    self.logger.warning(f"Authentication Error Hit: {e}. Attempt {attempt + 1} of {self.max_retries}.")
-                    time.sleep(self.pim_retry_delay_sec)
-                    self.logger.warning(f"Retrying in {self.pim_retry_delay_sec} seconds...")
-                else:
-                    self.logger.error("Max retries reached. Raising AuthenticationError.")
-                    raise e
+                return self.record_response(deployment, raw_response, request, estimated_tokens, time.time() - start_time, metrics)
+            except (RateLimitError, AuthenticationError, APIConnectionError, InternalServerError) as e:
+                metrics["errors"] += 1
+                metrics["error"] = type(e).__name__
+                wait_sec = self.handle_error(e, deployment, attempt)
+            finally:
+                self.pool.release(deployment)
+            time.sleep(wait_sec)
+    
+    async def get_response_async(self, request, metrics=None):
+        if metrics is None:
+            metrics = new_call_metrics()
+        estimated_tokens = estimate_request_tokens(request)
+        for attempt in range(self.max_retries):
+            metrics["attempts"] += 1
+            deployment = self.pool.choose()
+            try:
+                # Every deployment is cooling down, wait for the first one to come back
+                await asyncio.sleep(max(0.0, deployment.ejected_until - time.time()))
+                metrics["rate_limit_wait_sec"] += await deployment.rate_limiter.acquire_async(estimated_tokens)
+                start_time = time.time()
+                raw_response = await deployment.async_client.chat.completions.with_raw_response.create(
+                    model=deployment.model_name,
+                    **request,
+                )
+                latency_sec = time.time() - start_time
+                # Reconciling and penalizing lock the rate limiter's shared state, keep them off the event loop
+                return await asyncio.to_thread(self.record_response, deployment, raw_response, request, estimated_tokens, latency_sec, metrics)
+            except (RateLimitError, AuthenticationError, APIConnectionError, InternalServerError) as e:
+                metrics["errors"] += 1
+                metrics["error"] = type(e).__name__
+                wait_sec = await asyncio.to_thread(self.handle_error, e, deployment, attempt)
+            finally:
+                self.pool.release(deployment)
+            await asyncio.sleep(wait_sec)
+    
+    def create_mock_request(self, contents, metrics):
+        """
+        The mock is given image paths instead of images, send them as image parts so token
+        accounting matches a real request.
+        """
+        request = self.create_request([])
+        for content in contents:
+            if is_image_file(content):
+                part = {"type": "image_url", "image_url": {"url": content}}
+                metrics["image_tokens"] += estimate_content_tokens(part)
+            else:
+                part = {"type": "text", "text": content}
+            request["messages"][-1]["content"].append(part)
+        metrics["payload_bytes"] += request_payload_bytes(request)
+        return request
+
+    def mock_attempt(self, request, metrics):
+        """
+        One attempt against the simulated backend. Returns (content, seconds to wait), content is
+        None if the attempt failed.
+        """
+        metrics["attempts"] += 1
+        status, body, headers, delay_sec = self.mock_backend.respond(request)
+        if status != 200:
+            metrics["errors"] += 1
+            metrics["error"] = "RateLimitError" if status == 429 else "InternalServerError"
+            self.logger.warning(f"Mock {metrics['error']} ({status}): {body['error']['message']}")
+            wait_sec = float(headers["retry-after"]) if "retry-after" in headers else self.retry_delay_sec
+            return None, delay_sec + wait_sec
+        usage = body["usage"]
+        metrics["api_sec"] += delay_sec
+        metrics["prompt_tokens"] += usage["prompt_tokens"]
+        metrics["completion_tokens"] += usage["completion_tokens"]
+        metrics["cached_tokens"] += usage["prompt_tokens_details"]["cached_tokens"]
+        self.prefix_cache_stats.record(request, usage)
+        return body["choices"][0]["message"]["content"], delay_sec
+
+    def mock_generate(self, contents, metrics):
+        self.logger.debug("Mock Request")
+        request = self.create_mock_request(contents, metrics)
+        for attempt in range(self.max_retries):
+            response, wait_sec = self.mock_attempt(request, metrics)
+            time.sleep(wait_sec)
+            if response is not None:
+                return response
+        raise RuntimeError(f"Mock request failed after {self.max_retries} attempts: {metrics['error']}")
+
+    async def mock_generate_async(self, contents, metrics):
+        self.logger.debug("Mock Request")
+        request = self.create_mock_request(contents, metrics)
+        for attempt in range(self.max_retries):
+            response, wait_sec = self.mock_attempt(request, metrics)
+            await asyncio.sleep(wait_sec)
+            if response is not None:
+                return response
+        raise RuntimeError(f"Mock request failed after {self.max_retries} attempts: {metrics['error']}")
+
+    def generate(self, contents, is_base64:bool=False, cache_tag:str="", metrics=None):
+        if metrics is None:
+            metrics = new_call_metrics()
+        metrics["calls"] += 1
+        if self.model_name == "mock":
+            return self.mock_generate(contents, metrics)
+        msgs = self.create_request(contents, is_base64, metrics)
+        if self.response_cache is not None:
+            key = request_key(self.model_name, msgs, cache_tag)
+            response = self.response_cache.get(key)
+            if response is not None:
+                self.logger.debug(f"Cached response: {response}")
+                metrics["response_cache_hits"] += 1
+                return response
+        response = self.get_response(msgs, metrics)
+        if self.response_cache is not None and response is not None:
+            self.response_cache.put(key, self.model_name, response)
+        self.logger.debug(f"Generated response: {response}")
+        return response
     
-    def generate(self, contents, is_base64:bool=False):
+    async def generate_async(self, contents, is_base64:bool=False, cache_tag:str="", metrics=None):
+        if metrics is None:
+            metrics = new_call_metrics()
+        metrics["calls"] += 1
         if self.model_name == "mock":
-            self.logger.debug("Mock Request")
-            for i, content in enumerate(contents):
-                self.logger.debug(f"Content {i}: {content}")
-            return "Mock Response"
-        msgs = self.create_request(contents, is_base64)
-        response = self.get_response(msgs)
+            return await self.mock_generate_async(contents, metrics)
+        # Encoding images is CPU bound, keep it off the event loop
+        msgs = await asyncio.to_thread(self.create_request, contents, is_base64, metrics)
+        if self.response_cache is not None:
+            key = await asyncio.to_thread(request_key, self.model_name, msgs, cache_tag)
+            response = await asyncio.to_thread(self.response_cache.get, key)
+            if response is not None:
+                self.logger.debug(f"Cached response: {response}")
+                metrics["response_cache_hits"] += 1
+                return response
+        response = await self.get_response_async(msgs, metrics)
+        if self.response_cache is not None and response is not None:
+            await asyncio.to_thread(self.response_cache.put, key, self.model_name, response)
         self.logger.debug(f"Generated response: {response}")
         return response
@@ -0,0 +1,98 @@
+from collections import OrderedDict
+from src.data_generation.image_payload import EncodedImage, PayloadConfig, encode_image_file
+import hashlib
+import json
+import os
+import threading
+
+DEFAULT_MEMORY_MB = 512
+
+class ImageCache:
+    """
+    Cache of encoded images keyed by file path, mtime, size and payload settings.
+
+    Lookups go to an in-memory LRU first, then to an optional on-disk tier shared by all worker
+    processes (and re-runs) pointing at the same cache_dir, and only then decode and encode the file.
+    """
+    def __init__(self, cache_dir="", max_memory_mb=DEFAULT_MEMORY_MB, logger=None):
+        self.cache_dir = cache_dir
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024
+        self.logger = logger
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def cache_key(self, path, config):
+        stat = os.stat(path)
+        key = json.dumps([os.path.abspath(path), stat.st_mtime_ns, stat.st_size, config.as_dict()], sort_keys=True)
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, path, config=None):
+        if config is None:
+            config = PayloadConfig()
+        key = self.cache_key(path, config)
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.memory[key]
+
+        encoded_image = self.read_disk(key)
+        if encoded_image is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            encoded_image = encode_image_file(path, config)
+            self.write_disk(key, encoded_image)
+
+        self.put_memory(key, encoded_image)
+        return encoded_image
+
+    def put_memory(self, key, encoded_image):
+        with self.lock:
+            if key in self.memory:
+                return
+            self.memory[key] = encoded_image
+            self.memory_bytes += len(encoded_image)
+            while self.memory_bytes > self.max_memory_bytes and len(self.memory) > 1:
+                _, evicted = self.memory.popitem(last=False)
+                self.memory_bytes -= len(evicted)
+
+    def disk_path(self, key):
+        # Two level fan out to keep directories small
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def read_disk(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self.disk_path(key), "r") as file:
+                header, data = file.read().split("\n", 1)
+            return EncodedImage(data, **json.loads(header))
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def write_disk(self, key, encoded_image):
+        if not self.cache_dir:
+            return
+        path = self.disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent workers never see a partial entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as file:
+            header = {attr: value for attr, value in encoded_image.__dict__.items() if attr != "data"}
+            file.write(json.dumps(header) + "\n" + encoded_image.data)
+        os.replace(tmp_path, path)
+
+    def hit_rate(self):
+        total = sum(self.stats.values())
+        if total == 0:
+            return 0.0
+        return (self.stats["memory_hits"] + self.stats["disk_hits"]) / total
+
+    def log_stats(self):
+        if self.logger is not None:
+            self.logger.info(f"Image cache: {self.stats}, hit rate {self.hit_rate():.2%}")
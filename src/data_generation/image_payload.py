@@ -0,0 +1,176 @@
+from PIL import Image
+from io import BytesIO
+from src.data_generation.minimal_dep_utils import GenerationMode
+import base64
+import math
+import os
+
+# Tiling limits of the vision models: high detail images are scaled to fit in a 2048 x 2048
+# square, then scaled so the shortest side is 768, then cut into 512 x 512 tiles.
+MAX_SIDE = 2048
+SHORT_SIDE = 768
+TILE_SIZE = 512
+TOKENS_PER_TILE = 170
+BASE_IMAGE_TOKENS = 85
+LOW_DETAIL_SIDE = 512
+
+PASSTHROUGH_FORMATS = ["JPEG", "PNG"]
+
+# Detail used for ICL example images and for the candidate image, per generation mode.
+# ICL images of description modes only convey the style of the description, so low detail suffices.
+DETAIL_POLICY = {
+    GenerationMode.VQA: {"icl": "auto", "candidate": "auto"},
+    GenerationMode.VQA_NR: {"icl": "auto", "candidate": "auto"},
+    GenerationMode.TQA: {"icl": "auto", "candidate": "auto"},
+    GenerationMode.DESCRIPT: {"icl": "low", "candidate": "auto"},
+    GenerationMode.GENERIC: {"icl": "low", "candidate": "auto"},
+    GenerationMode.VQA_TASK_DESC: {"icl": "auto", "candidate": "auto"},
+    GenerationMode.DESCRIPT_TASK_DESC: {"icl": "low", "candidate": "auto"},
+}
+
+class EncodedImage:
+    """
+    An image that is already base64 encoded and ready to be placed in a request.
+    """
+    def __init__(self, data, media_type="image/jpeg", detail="auto", source_bytes=None, source_tokens=None, tokens=None):
+        self.data = data
+        self.media_type = media_type
+        self.detail = detail
+        self.source_bytes = source_bytes
+        self.source_tokens = source_tokens
+        self.tokens = tokens
+
+    def url(self):
+        return f"data:{self.media_type};base64,{self.data}"
+
+    def image_url(self):
+        image_url = {"url": self.url()}
+        if self.detail != "auto":
+            image_url["detail"] = self.detail
+        return image_url
+
+    def payload_bytes(self):
+        # Size of the decoded payload, comparable to the size of the source file
+        return len(self.data) * 3 // 4
+
+    def __len__(self):
+        return len(self.data)
+
+class PayloadConfig:
+    """
+    Settings for turning an image into a request payload.
+    """
+    def __init__(self, passthrough=True, max_side=MAX_SIDE, short_side=SHORT_SIDE, format="JPEG", quality=75, detail="auto"):
+        self.passthrough = passthrough
+        self.max_side = max_side
+        self.short_side = short_side
+        self.format = format.upper()
+        self.quality = quality
+        self.detail = detail
+
+    def with_detail(self, detail):
+        return PayloadConfig(self.passthrough, self.max_side, self.short_side, self.format, self.quality, detail)
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+def estimate_image_tokens(width, height, detail="auto"):
+    """
+    Estimate the number of prompt tokens an image of the given size costs.
+    """
+    if detail == "low":
+        return BASE_IMAGE_TOKENS
+    scale = min(1.0, MAX_SIDE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, SHORT_SIDE / min(width, height))
+    width, height = width * scale, height * scale
+    return TOKENS_PER_TILE * math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE) + BASE_IMAGE_TOKENS
+
+def target_size(width, height, config):
+    """
+    Size the image is reduced to before upload, the service would downscale it to this anyway.
+    """
+    max_side = config.max_side
+    if config.detail == "low":
+        max_side = min(max_side, LOW_DETAIL_SIDE)
+    scale = min(1.0, max_side / max(width, height))
+    if config.short_side > 0:
+        scale = min(scale, config.short_side / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def encode_pil_image(image, config, source_bytes=None):
+    """
+    Resize and re-encode a PIL image according to config.
+    """
+    source_tokens = estimate_image_tokens(*image.size)
+    size = target_size(*image.size, config)
+    original = image
+    try:
+        if size != image.size:
+            image = image.resize(size, Image.LANCZOS)
+        if config.format == "JPEG" and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        buffered = BytesIO()
+        image.save(buffered, format=config.format, quality=config.quality)
+    finally:
+        # Free the resized bitmap right away, the caller owns the original
+        if image is not original:
+            image.close()
+    return EncodedImage(
+        base64.b64encode(buffered.getvalue()).decode("utf-8"),
+        media_type=f"image/{config.format.lower()}",
+        detail=config.detail,
+        source_bytes=source_bytes,
+        source_tokens=source_tokens,
+        tokens=estimate_image_tokens(*size, config.detail)
+    )
+
+def encode_image_file(path, config):
+    """
+    Build the payload for the image at path. Files that are already an acceptable JPEG or PNG
+    within the size limits are sent as is, without decoding and re-encoding them.
+    """
+    source_bytes = os.path.getsize(path)
+    # Opening only reads the header, pixels are decoded on first access
+    with Image.open(path) as image:
+        if config.passthrough and image.format in PASSTHROUGH_FORMATS and target_size(*image.size, config) == image.size:
+            with open(path, "rb") as file:
+                data = base64.b64encode(file.read()).decode("utf-8")
+            return EncodedImage(
+                data,
+                media_type=f"image/{image.format.lower()}",
+                detail=config.detail,
+                source_bytes=source_bytes,
+                source_tokens=estimate_image_tokens(*image.size),
+                tokens=estimate_image_tokens(*image.size, config.detail)
+            )
+        return encode_pil_image(image, config, source_bytes=source_bytes)
+
+class PayloadStats:
+    """
+    Running totals of what the payload stage saved over a run.
+    """
+    def __init__(self):
+        self.num_images = 0
+        self.source_bytes = 0
+        self.payload_bytes = 0
+        self.source_tokens = 0
+        self.payload_tokens = 0
+
+    def record(self, encoded_image):
+        self.num_images += 1
+        if encoded_image.source_bytes is not None:
+            self.source_bytes += encoded_image.source_bytes
+            self.payload_bytes += encoded_image.payload_bytes()
+        if encoded_image.source_tokens is not None:
+            self.source_tokens += encoded_image.source_tokens
+            self.payload_tokens += encoded_image.tokens
+
+    def summary(self):
+        return {
+            "num_images": self.num_images,
+            "bytes_saved": self.source_bytes - self.payload_bytes,
+            "image_tokens_saved": self.source_tokens - self.payload_tokens,
+            "payload_bytes": self.payload_bytes,
+            "payload_image_tokens": self.payload_tokens
+        }
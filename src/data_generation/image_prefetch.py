@@ -0,0 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+
+DEFAULT_PREFETCH_WORKERS = 4
+DEFAULT_PREFETCH_DEPTH = 16
+
+class ImagePrefetcher:
+    """
+    Loads and encodes the images of upcoming prompts on a thread pool while earlier requests are
+    in flight, so file I/O and encoding stay off the critical path between API calls.
+
+    Prompts are prefetched in the order they will be processed, with at most depth of them loaded
+    and not yet taken. Taking a prompt hands its contents over to the caller, the prefetcher keeps
+    no reference to them, so encoded images are freed as soon as the request is done. close()
+    cancels whatever has not started and waits for the workers, use it as a context manager.
+    """
+    def __init__(self, load_contents, items, num_workers=DEFAULT_PREFETCH_WORKERS, depth=DEFAULT_PREFETCH_DEPTH, logger=None):
+        """
+        :param load_contents: Called with an item, returns the request contents for it.
+        :param items: (key, item) pairs in processing order.
+        """
+        self.load_contents = load_contents
+        self.items = items
+        self.depth = max(1, depth)
+        self.logger = logger
+        self.executor = ThreadPoolExecutor(max_workers=max(1, num_workers), thread_name_prefix="prefetch")
+        self.futures = {}
+        self.next_pos = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.stats = {"taken": 0, "ready": 0, "waited": 0}
+        self.top_up()
+
+    def top_up(self):
+        with self.lock:
+            while not self.closed and self.next_pos < len(self.items) and len(self.futures) < self.depth:
+                key, item = self.items[self.next_pos]
+                self.futures[key] = self.executor.submit(self.load_contents, item)
+                self.next_pos += 1
+
+    def take(self, key):
+        """
+        Future of the contents for key, no longer tracked by the prefetcher.
+        """
+        with self.lock:
+            future = self.futures.pop(key, None)
+            if future is None:
+                # Not (yet) in the window, e.g. processed out of order
+                item = next(item for item_key, item in self.items if item_key == key)
+                future = self.executor.submit(self.load_contents, item)
+            self.stats["taken"] += 1
+            self.stats["ready" if future.done() else "waited"] += 1
+        self.top_up()
+        return future
+
+    def get(self, key):
+        """
+        Contents for key, waiting for them if they are still being loaded. Raises what loading raised.
+        """
+        return self.take(key).result()
+
+    async def get_async(self, key):
+        return await asyncio.wrap_future(self.take(key))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        if self.logger is not None:
+            self.logger.info(f"Image prefetch: {self.stats}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
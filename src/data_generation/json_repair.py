@@ -0,0 +1,171 @@
+import ast
+import json
+import re
+
+FENCE_PATTERN = re.compile(r"```(?:json|JSON)?\s*(.*?)(?:```|$)", re.DOTALL)
+
+# Curly quotes used as JSON delimiters, i.e. next to structural characters
+SMART_OPEN_QUOTE_PATTERN = re.compile(r"([\[\{,:]\s*)[“”]")
+SMART_CLOSE_QUOTE_PATTERN = re.compile(r"[“”](\s*[\]\},:])")
+
+DANGLING_KEY_PATTERN = re.compile(r',?\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+
+VALID_ESCAPES = '"\\/bfnrtu'
+
+# LaTeX commands that happen to start with a valid JSON escape, e.g. \frac, \theta or \underline
+LATEX_ESCAPE_PATTERN = re.compile(r'(?<!\\)\\(?:[bfrt][a-zA-Z]|u(?![0-9a-fA-F]{4}))')
+
+CLOSERS = {"[": "]", "{": "}"}
+
+def extract_candidates(text):
+    """
+    Substrings of a model response that may hold the JSON, most specific first.
+    """
+    candidates = [match.group(1) for match in FENCE_PATTERN.finditer(text) if match.group(1).strip()]
+    starts = [idx for idx in [text.find("["), text.find("{")] if idx >= 0]
+    if starts:
+        start = min(starts)
+        end = max(text.rfind("]"), text.rfind("}"))
+        if end > start:
+            candidates.append(text[start:end + 1])
+        candidates.append(text[start:])
+    return candidates
+
+def loads_strict(text):
+    """
+    Parse the JSON in a model response without altering it. Raises ValueError on failure.
+    """
+    for candidate in extract_candidates(text):
+        if LATEX_ESCAPE_PATTERN.search(candidate):
+            continue
+        try:
+            return json.loads(candidate)
+        except json.JSONDecodeError:
+            continue
+    raise ValueError("No valid JSON found.")
+
+def loads_repaired(text):
+    """
+    Parse the JSON in a model response after repairing common defects. Raises ValueError on failure.
+    """
+    for candidate in extract_candidates(text):
+        try:
+            return json.loads(repair(candidate))
+        except json.JSONDecodeError:
+            pass
+        # Python literals, e.g. single quoted keys and strings
+        try:
+            return ast.literal_eval(candidate.strip())
+        except (ValueError, SyntaxError, MemoryError, RecursionError):
+            pass
+    raise ValueError("Unable to repair JSON.")
+
+def last_non_space(out):
+    for ch in reversed(out):
+        if not ch.isspace():
+            return ch
+    return ""
+
+def drop_trailing_comma(out):
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+def next_non_space(text, idx):
+    while idx < len(text) and text[idx].isspace():
+        idx += 1
+    return text[idx] if idx < len(text) else ""
+
+def repair(text):
+    """
+    Rewrite almost-JSON into valid JSON. Handles trailing and missing commas, curly delimiter quotes,
+    unescaped quotes, backslashes and newlines inside strings, and truncated output. Truncated arrays
+    are cut back to their last complete element, truncated objects are closed.
+    """
+    text = SMART_OPEN_QUOTE_PATTERN.sub(r'\1"', text)
+    text = SMART_CLOSE_QUOTE_PATTERN.sub(r'"\1', text)
+    starts = [idx for idx in [text.find("["), text.find("{")] if idx >= 0]
+    if not starts:
+        return text
+
+    out = []
+    stack = []
+    in_string = False
+    last_complete = None
+    idx = min(starts)
+    while idx < len(text):
+        ch = text[idx]
+        if in_string:
+            if ch == "\\":
+                next_ch = text[idx + 1] if idx + 1 < len(text) else ""
+                if next_ch and next_ch in VALID_ESCAPES and not LATEX_ESCAPE_PATTERN.match(text, idx):
+                    out.extend([ch, next_ch])
+                    idx += 1
+                else:
+                    # Lone backslash, e.g. LaTeX in a question
+                    out.append("\\\\")
+            elif ch == '"':
+                # Only a quote followed by a structural character ends the string
+                if next_non_space(text, idx + 1) in ("", ",", ":", "]", "}"):
+                    out.append(ch)
+                    in_string = False
+                else:
+                    out.append('\\"')
+            elif ch == "\n":
+                out.append("\\n")
+            elif ch == "\r":
+                out.append("\\r")
+            elif ch == "\t":
+                out.append("\\t")
+            else:
+                out.append(ch)
+        elif ch in '"[{':
+            if last_non_space(out) in ('"', "]", "}"):
+                out.append(",")
+            if ch == '"':
+                in_string = True
+            else:
+                stack.append(ch)
+            out.append(ch)
+        elif ch in "]}":
+            if not stack:
+                break
+            drop_trailing_comma(out)
+            out.append(CLOSERS[stack.pop()])
+            if stack == ["["]:
+                last_complete = len(out)
+            if not stack:
+                break
+        else:
+            out.append(ch)
+        idx += 1
+
+    if not stack:
+        return "".join(out)
+
+    # Truncated output
+    if last_complete is not None:
+        return "".join(out[:last_complete]) + "]"
+    if in_string:
+        out.append('"')
+    repaired = close(out, stack)
+    if stack[-1] == "{" and not is_valid(repaired):
+        # Drop a dangling key that never got its value
+        out = list(DANGLING_KEY_PATTERN.sub("", "".join(out)))
+        repaired = close(out, stack)
+    return repaired
+
+def close(out, stack):
+    out = list(out)
+    for opener in reversed(stack):
+        drop_trailing_comma(out)
+        out.append(CLOSERS[opener])
+    return "".join(out)
+
+def is_valid(text):
+    try:
+        json.loads(text)
+        return True
+    except json.JSONDecodeError:
+        return False
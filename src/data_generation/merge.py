@@ -1,52 +1,238 @@
+from concurrent.futures import ProcessPoolExecutor
 import argparse
 import os
 import json
+import re
+import shutil
+import tempfile
 from glob import glob
 
-def merge_json_files(folder_path, run_id, output_folder):
+# Absolute prefix of the image folders of earlier runs, stripped from the merged image_folder
+STRIP_PREFIX = "/home/vivineet/projects/siddharth/data/"
+
+READ_CHUNK_CHARS = 1 << 20
+COMPACT_SEPARATORS = (",", ":")
+WHITESPACE = re.compile(r"\s*")
+DEFAULT_NUM_WORKERS = min(8, os.cpu_count() or 1)
+
+class ShardReader:
+    """
+    Streams a generated data file: top level fields are collected in header, while the samples
+    are decoded one at a time, so memory is bounded by the largest sample rather than the file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "r")
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.header = {}
+
+    def close(self):
+        self.file.close()
+
+    def fill(self):
+        if self.eof:
+            return False
+        chunk = self.file.read(READ_CHUNK_CHARS)
+        if not chunk:
+            self.eof = True
+            return False
+        # Drop what was consumed so the buffer stays small
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Next non whitespace character, without consuming it.
+        """
+        while True:
+            self.pos = WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                raise ValueError(f"Unexpected end of {self.path}")
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise ValueError(f"Expected '{char}' at character {self.pos} of the buffer in {self.path}")
+        self.pos += 1
+
+    def decode(self):
+        while True:
+            self.peek()
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                # A number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill()
+
+    def iter_samples(self):
+        """
+        Yield the samples in order. Fields before and after them end up in header.
+        """
+        self.expect("{")
+        while self.peek() != "}":
+            if self.peek() == ",":
+                self.pos += 1
+            key = self.decode()
+            self.expect(":")
+            if key != "samples":
+                self.header[key] = self.decode()
+                continue
+            self.expect("[")
+            while self.peek() != "]":
+                if self.peek() == ",":
+                    self.pos += 1
+                yield self.decode()
+            self.pos += 1
+        self.pos += 1
+
+def shard_index(path, run_id):
+    return int(path.split(f"{run_id}_")[-1].split("_")[0])
+
+def first_image_path(path):
+    reader = ShardReader(path)
+    try:
+        for sample in reader.iter_samples():
+            return sample["image_1"]
+    finally:
+        reader.close()
+    return None
+
+def relative_image_path(image_path, image_folder):
+    if os.path.dirname(image_path) == image_folder:
+        return os.path.basename(image_path)
+    # Samples outside the first sample's folder keep the path relative to it
+    return os.path.relpath(image_path, image_folder) if image_folder else image_path
+
+def convert_shard(path, image_folder, output_path):
+    """
+    Write the samples of a shard as compact JSON lines without their ids, each prefixed by its id in
+    the shard and a space, with image_1 made relative to image_folder. Samples without an id get
+    their position. Runs in a worker process. Returns the shard's header, number of samples and
+    number of ids (its largest id + 1).
+    """
+    reader = ShardReader(path)
+    encoder = json.JSONEncoder(separators=COMPACT_SEPARATORS)
+    num_samples = 0
+    num_ids = 0
+    try:
+        with open(output_path, "w") as file:
+            for sample in reader.iter_samples():
+                sample_id = sample.pop("id", num_samples)
+                if "image_1" in sample:
+                    sample["image_1"] = relative_image_path(sample["image_1"], image_folder)
+                file.write(f"{sample_id} {encoder.encode(sample)}\n")
+                num_samples += 1
+                num_ids = max(num_ids, sample_id + 1)
+    finally:
+        reader.close()
+    return reader.header, num_samples, num_ids
+
+def with_id(line, sample_id):
+    """
+    Prepend the id to a compact JSON object line, without decoding it again.
+    """
+    line = line.rstrip("\n")
+    return f'{{"id":{sample_id}' + ("}" if line == "{}" else "," + line[1:])
+
+def merge_json_files(folder_path, run_id, output_folder, output_format="json", num_workers=DEFAULT_NUM_WORKERS, strip_prefix=STRIP_PREFIX):
+    """
+    Merge the generated data files of a run into one file with globally unique sample ids.
+
+    Shards are converted in parallel to temporary JSON lines files, which are then concatenated in
+    shard order while their ids are offset past those of the previous shards, so memory stays bounded whatever the number of samples.
+    The output is compact JSON ({run_id}.json) or JSON lines ({run_id}.jsonl, with the header in
+    {run_id}.meta.json). Returns the output file.
+    """
     # Find all JSON files in the directory with the run_id in their name
-    json_files = sorted(glob(os.path.join(folder_path, f"*{run_id}*.json")), key=lambda x: int(x.split(f"{run_id}_")[-1].split("_")[0]))
+    json_files = glob(os.path.join(folder_path, f"*{run_id}*.json"))
+    # Skip the output of an earlier merge into the same folder
+    json_files = sorted([path for path in json_files if os.path.basename(path) not in [f"{run_id}.json", f"{run_id}.meta.json"]], key=lambda x: shard_index(x, run_id))
     if not json_files:
         print(f"No JSON files found with run_id {run_id} in {folder_path}")
-        return
-
-    # Load the first JSON file
-    with open(json_files[0], 'r') as f:
-        merged_data = json.load(f)
-
-    # Merge the 'samples' list from each subsequent JSON file into the first one
-    start_idx = merged_data["num_prompts"]
-    for json_file in json_files[1:]:
-        with open(json_file, 'r') as f:
-            data = json.load(f)
-            print(data["start_idx"], start_idx)
-            #assert data["start_idx"] == start_idx
-            start_idx += data["num_prompts"]
-            # assert len(data["samples"]) > int(0.9 * data["num_prompts"])
-            merged_data['samples'].extend(data.get('samples', []))
-
-    # Process samples
-    merged_data["image_folder"] = os.path.dirname(merged_data["samples"][0]["image_1"])
-    for sample in merged_data["samples"]:
-        sample["image_1"] = os.path.basename(sample["image_1"])
-        
-    # Save the merged data to a new JSON file
-    merged_data["len_samples"] = len(merged_data["samples"])
-    output_file = os.path.join(output_folder, f"{run_id}.json")
-    merged_data["image_folder"] = merged_data["image_folder"].replace("/home/vivineet/projects/siddharth/data/","")
-        
-    with open(output_file, 'w') as f:
-        json.dump(merged_data, f, indent=3)
-        
-    print("CHECK IMAGE FOLDER PATH", merged_data["image_folder"])
-
-    print(f"Merged JSON file saved as {output_file}")
+        return None
+
+    # Images are stored relative to the folder of the first sample
+    image_path = next((path for path in map(first_image_path, json_files) if path is not None), None)
+    image_folder = os.path.dirname(image_path) if image_path is not None else ""
+
+    os.makedirs(output_folder, exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix=f".{run_id}_merge_", dir=output_folder)
+    try:
+        tmp_paths = [os.path.join(tmp_folder, f"{idx}.jsonl") for idx in range(len(json_files))]
+        if num_workers > 1 and len(json_files) > 1:
+            with ProcessPoolExecutor(max_workers=min(num_workers, len(json_files))) as executor:
+                results = list(executor.map(convert_shard, json_files, [image_folder] * len(json_files), tmp_paths))
+        else:
+            results = [convert_shard(path, image_folder, tmp_path) for path, tmp_path in zip(json_files, tmp_paths)]
+
+        # Header of the first shard, spanning all of them
+        headers = [header for header, _, _ in results]
+        merged_header = dict(headers[0])
+        merged_header["image_folder"] = image_folder.replace(strip_prefix, "") if strip_prefix else image_folder
+        merged_header["num_prompts"] = sum(header.get("num_prompts", 0) for header in headers)
+        start_idx = headers[0].get("start_idx", 0)
+        for path, header in zip(json_files, headers):
+            if header.get("start_idx", start_idx) != start_idx:
+                print(f"Prompt range of {path} starts at {header.get('start_idx')}, expected {start_idx}")
+            start_idx = header.get("start_idx", start_idx) + header.get("num_prompts", 0)
+        if "end_idx" in merged_header:
+            merged_header["end_idx"] = headers[-1].get("end_idx", start_idx)
+        len_samples = sum(num_samples for _, num_samples, _ in results)
+        merged_header["len_samples"] = len_samples
+
+        output_file = os.path.join(output_folder, f"{run_id}.{output_format}")
+        tmp_output_file = os.path.join(tmp_folder, os.path.basename(output_file))
+        with open(tmp_output_file, "w") as output:
+            if output_format == "json":
+                header_json = json.dumps(merged_header, separators=COMPACT_SEPARATORS)
+                output.write(header_json[:-1] + ',"samples":[')
+            # Shard ids are offset by the ids of the shards before, so samples generated from the same
+            # object (e.g. the reasoning and short answer samples of VQA) keep sharing their id
+            id_offset = 0
+            num_written = 0
+            for tmp_path, (_, _, num_ids) in zip(tmp_paths, results):
+                with open(tmp_path, "r") as file:
+                    for line in file:
+                        shard_id, line = line.split(" ", 1)
+                        sample = with_id(line, id_offset + int(shard_id))
+                        if output_format == "json":
+                            output.write(("," if num_written > 0 else "") + "\n" + sample)
+                        else:
+                            output.write(sample + "\n")
+                        num_written += 1
+                id_offset += num_ids
+            if output_format == "json":
+                output.write("\n]}\n")
+        os.replace(tmp_output_file, output_file)
+        if output_format == "jsonl":
+            with open(os.path.join(output_folder, f"{run_id}.meta.json"), "w") as file:
+                json.dump(merged_header, file, indent=3)
+    finally:
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+
+    print("CHECK IMAGE FOLDER PATH", merged_header["image_folder"])
+
+    print(f"Merged {len_samples} samples from {len(json_files)} files, saved as {output_file}")
+    return output_file
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge JSON files based on run_id")
     parser.add_argument("--folder_path", type=str, help="Path to the folder containing JSON files")
     parser.add_argument("--output_folder", type=str, default="generated_data", help="Path to the folder to save the merged JSON file")
     parser.add_argument("--run_id", type=str, help="Run ID to filter JSON files")
+    parser.add_argument("--format", type=str, default="json", choices=["json", "jsonl"], help="Compact JSON file, or JSON lines with a separate .meta.json header")
+    parser.add_argument("--num_workers", type=int, default=DEFAULT_NUM_WORKERS, help="Processes reading shards in parallel")
+    parser.add_argument("--strip_prefix", type=str, default=STRIP_PREFIX, help="Prefix removed from the merged image_folder")
 
     args = parser.parse_args()
-    merge_json_files(args.folder_path, args.run_id, args.output_folder)
\ No newline at end of file
+    merge_json_files(args.folder_path, args.run_id, args.output_folder, args.format, args.num_workers, args.strip_prefix)
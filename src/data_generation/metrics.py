@@ -0,0 +1,181 @@
+import argparse
+import glob
+import json
+import math
+import os
+import threading
+
+METRICS_FOLDER = "metrics"
+
+# USD per 1M tokens, gpt-4o (2024-08-06) list prices
+DEFAULT_PROMPT_PRICE = 2.50
+DEFAULT_CACHED_PRICE = 1.25
+DEFAULT_COMPLETION_PRICE = 10.00
+
+def new_call_metrics():
+    """
+    Counters GPTEndPoint fills in for the calls made on behalf of one prompt.
+    """
+    return {
+        "calls": 0,
+        "attempts": 0,
+        "errors": 0,
+        "error": None,
+        "response_cache_hits": 0,
+        "api_sec": 0.0,
+        "rate_limit_wait_sec": 0.0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "image_tokens": 0,
+        "payload_bytes": 0
+    }
+
+def request_payload_bytes(request):
+    """
+    Approximate size of a request on the wire: its texts and (base64) image urls.
+    """
+    num_bytes = 0
+    for message in request["messages"]:
+        if type(message["content"]) == str:
+            num_bytes += len(message["content"])
+            continue
+        for content in message["content"]:
+            num_bytes += len(content["text"]) if content["type"] == "text" else len(content["image_url"]["url"])
+    return num_bytes
+
+class MetricsWriter:
+    """
+    Appends one JSON record per prompt to a JSONL file. Safe to share between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, "a")
+
+    def write(self, record):
+        line = json.dumps(record) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def iter_records(paths):
+    for path in paths:
+        with open(path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # Half written line of a killed process
+                    continue
+
+def percentile(sorted_values, q):
+    """
+    Nearest rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(q / 100 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+def call_cost(call, prices):
+    uncached_tokens = call["prompt_tokens"] - call["cached_tokens"]
+    return (
+        uncached_tokens * prices["prompt"]
+        + call["cached_tokens"] * prices["cached"]
+        + call["completion_tokens"] * prices["completion"]
+    ) / 1e6
+
+def summarize(records, prices):
+    """
+    Aggregate prompt records into throughput, latency percentiles, token totals and cost.
+    """
+    summary = {
+        "prompts": 0,
+        "failed_prompts": 0,
+        "accepted_samples": 0,
+        "attempts": 0,
+        "response_cache_hits": 0,
+        "format_fix_prompts": 0,
+        "prompt_tokens": 0,
+        "completion_tokens": 0,
+        "cached_tokens": 0,
+        "image_tokens": 0,
+        "payload_bytes": 0,
+        "cost_usd": 0.0,
+        "parse": {},
+        "errors": {}
+    }
+    latencies = []
+    start_time = None
+    end_time = None
+    for record in records:
+        summary["prompts"] += 1
+        summary["accepted_samples"] += record.get("num_samples", 0)
+        if record.get("error") is not None:
+            summary["failed_prompts"] += 1
+            summary["errors"][record["error"]] = summary["errors"].get(record["error"], 0) + 1
+        if record.get("parse") is not None:
+            summary["parse"][record["parse"]] = summary["parse"].get(record["parse"], 0) + 1
+        if record["format_fix"]["calls"] > 0:
+            summary["format_fix_prompts"] += 1
+        for call in [record["generate"], record["format_fix"]]:
+            summary["attempts"] += call["attempts"]
+            summary["response_cache_hits"] += call["response_cache_hits"]
+            for key in ["prompt_tokens", "completion_tokens", "cached_tokens", "image_tokens", "payload_bytes"]:
+                summary[key] += call[key]
+            summary["cost_usd"] += call_cost(call, prices)
+        latencies.append(record["wall_sec"])
+        record_end_time = record["start_time"] + record["queue_sec"] + record["wall_sec"]
+        start_time = record["start_time"] if start_time is None else min(start_time, record["start_time"])
+        end_time = record_end_time if end_time is None else max(end_time, record_end_time)
+
+    latencies.sort()
+    elapsed_sec = (end_time - start_time) if summary["prompts"] > 0 else 0.0
+    summary["elapsed_sec"] = round(elapsed_sec, 2)
+    summary["prompts_per_sec"] = round(summary["prompts"] / elapsed_sec, 3) if elapsed_sec > 0 else None
+    summary["samples_per_sec"] = round(summary["accepted_samples"] / elapsed_sec, 3) if elapsed_sec > 0 else None
+    summary["latency_sec"] = {f"p{q}": round(percentile(latencies, q), 3) if latencies else None for q in [50, 95, 99]}
+    summary["image_token_share"] = round(summary["image_tokens"] / summary["prompt_tokens"], 4) if summary["prompt_tokens"] else None
+    summary["cost_usd"] = round(summary["cost_usd"], 4)
+    summary["cost_per_sample_usd"] = round(summary["cost_usd"] / summary["accepted_samples"], 6) if summary["accepted_samples"] else None
+    return summary
+
+def main(args):
+    paths = sorted(glob.glob(os.path.join(args.metrics_folder, "**", "*.metrics.jsonl"), recursive=True))
+    if not paths:
+        print(f"No metrics files found in {args.metrics_folder}")
+        return
+    prices = {"prompt": args.prompt_price, "cached": args.cached_price, "completion": args.completion_price}
+
+    # Overall, and per generation mode
+    records = list(iter_records(paths))
+    report = {"files": len(paths), "all": summarize(records, prices)}
+    modes = sorted(set(record.get("mode") for record in records))
+    if len(modes) > 1:
+        report["by_mode"] = {mode: summarize([record for record in records if record.get("mode") == mode], prices) for mode in modes}
+
+    output = json.dumps(report, indent=3)
+    print(output)
+    if args.output_file:
+        with open(args.output_file, "w") as file:
+            file.write(output)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize per prompt metrics of generation runs")
+    parser.add_argument("--metrics_folder", type=str, required=True, help="Folder searched recursively for *.metrics.jsonl files, e.g. <output_folder>/metrics")
+    parser.add_argument("--prompt_price", type=float, default=DEFAULT_PROMPT_PRICE, help="USD per 1M uncached prompt tokens")
+    parser.add_argument("--cached_price", type=float, default=DEFAULT_CACHED_PRICE, help="USD per 1M cached prompt tokens")
+    parser.add_argument("--completion_price", type=float, default=DEFAULT_COMPLETION_PRICE, help="USD per 1M completion tokens")
+    parser.add_argument("--output_file", type=str, default="", help="Also write the report to this JSON file")
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import threading
+import time
+from src.data_generation.rate_limiter import estimate_content_tokens
+
+# Provider side prompt caching only kicks in for prompts of at least this many tokens, and
+# matches prefixes in increments of CACHE_INCREMENT_TOKENS beyond that
+MIN_CACHED_TOKENS = 1024
+CACHE_INCREMENT_TOKENS = 128
+
+# Cached prefixes are evicted after a few minutes without use
+CACHE_TTL_SEC = 300
+
+def prefix_group_key(prompt_object):
+    """
+    Prompts with the same key share the system prompt and ICL examples, i.e. all of the request but
+    the candidate image and generation prompt.
+    """
+    return (prompt_object["keyword"], tuple(prompt_object["icl_indices"]))
+
+def order_by_prefix(prompt_objects, offsets):
+    """
+    Order the offsets so that prompts sharing a request prefix are sent back to back, while the
+    cached prefix is still warm. Generation order is kept within a group.
+    """
+    return sorted(offsets, key=lambda offset: (prefix_group_key(prompt_objects[offset]), offset))
+
+def iter_request_parts(request):
+    for message in request["messages"]:
+        if type(message["content"]) == str:
+            yield message["role"], message["content"]
+            continue
+        for content in message["content"]:
+            yield message["role"], content
+
+class PrefixCacheStats:
+    """
+    Estimates how many prompt tokens a provider side prompt cache could serve, by remembering the
+    prefixes (system prompt plus leading content parts) of recently sent requests. Also totals the
+    cached tokens the service reports, where it does.
+    """
+    def __init__(self, ttl_sec=CACHE_TTL_SEC):
+        self.ttl_sec = ttl_sec
+        self.last_sent = {}
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.prompt_tokens = 0
+        self.estimated_cached_tokens = 0
+        self.reported_prompt_tokens = 0
+        self.reported_cached_tokens = 0
+
+    def record(self, request, usage=None):
+        """
+        Record a sent request, returns the number of its prompt tokens estimated to be cached.
+        """
+        now = time.time()
+        hasher = hashlib.sha256()
+        prefix_hashes = []
+        num_tokens = 0
+        cached_prefix_tokens = 0
+        with self.lock:
+            for role, content in iter_request_parts(request):
+                hasher.update(json.dumps([role, content], sort_keys=True).encode("utf-8") + b"\0")
+                num_tokens += estimate_content_tokens(content)
+                prefix_hash = hasher.hexdigest()
+                prefix_hashes.append(prefix_hash)
+                if now - self.last_sent.get(prefix_hash, -self.ttl_sec) < self.ttl_sec:
+                    cached_prefix_tokens = num_tokens
+            for prefix_hash in prefix_hashes:
+                self.last_sent[prefix_hash] = now
+
+            cached_tokens = 0
+            if cached_prefix_tokens >= MIN_CACHED_TOKENS:
+                cached_tokens = cached_prefix_tokens // CACHE_INCREMENT_TOKENS * CACHE_INCREMENT_TOKENS
+            self.num_requests += 1
+            self.prompt_tokens += num_tokens
+            self.estimated_cached_tokens += cached_tokens
+            if usage:
+                self.reported_prompt_tokens += usage.get("prompt_tokens") or 0
+                self.reported_cached_tokens += (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+
+            # Forget expired prefixes every so often, so memory stays bounded on long runs
+            if self.num_requests % 1000 == 0:
+                self.last_sent = {key: sent for key, sent in self.last_sent.items() if now - sent < self.ttl_sec}
+        return cached_tokens
+
+    def summary(self):
+        summary = {
+            "num_requests": self.num_requests,
+            "prompt_tokens": self.prompt_tokens,
+            "estimated_cached_tokens": self.estimated_cached_tokens,
+            "estimated_cached_share": round(self.estimated_cached_tokens / self.prompt_tokens, 4) if self.prompt_tokens else 0.0
+        }
+        if self.reported_prompt_tokens:
+            summary["reported_cached_tokens"] = self.reported_cached_tokens
+            summary["reported_cached_share"] = round(self.reported_cached_tokens / self.reported_prompt_tokens, 4)
+        return summary
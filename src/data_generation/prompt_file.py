@@ -0,0 +1,220 @@
+from array import array
+from src.data_generation.minimal_dep_utils import GenerationMode, should_include_icl
+import json
+import mmap
+import os
+import re
+
+# Prompt files written since the normalized format carry this, older ones inline every prompt
+NORMALIZED_FORMAT = "normalized"
+
+# JSON lines prompt files have a sidecar index of the byte offset of every prompt line, plus the
+# end of the last one, as native uint64
+INDEX_SUFFIX = ".idx"
+COMPACT_SEPARATORS = (",", ":")
+
+# Sharded prompt generation writes its shards and this manifest into one folder
+MANIFEST_NAME = "manifest.json"
+
+ORDINALS = ["first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth", "ninth", "tenth"]
+
+def number_to_ordinal(n):
+    if 1 <= n <= 10:
+        return ORDINALS[n - 1]
+    else:
+        raise ValueError("Number out of range. Only numbers from 1 to 10 are supported.")
+
+def icl_example(sample, example_num, image_folder):
+    """
+    The image and Q/A text showing a reference sample as the example_num-th ICL example.
+    """
+    image = os.path.join(image_folder, sample["image_1"])
+    query = sample["conversations"][0]["value"]
+    answer = sample["conversations"][1]["value"]
+    query = re.sub("<image.?.?.?>", f"Refer to the {number_to_ordinal(example_num)} image.", query)
+    query = re.sub("<.*>", "", query)
+    return image, f"Q: {query}\n A: {answer}"
+
+def icl_sample(sample):
+    """
+    The fields of a task file sample that ICL examples are built from.
+    """
+    return {"image_1": sample["image_1"], "conversations": sample["conversations"][:2]}
+
+class IndexedPrompts:
+    """
+    Prompts of a JSON lines prompt file, read through its offset index. Slicing memory maps the
+    file and only decodes the lines in the range, so loading a worker's range costs the same
+    wherever it starts and however large the file is.
+    """
+    def __init__(self, path, index_path):
+        self.file = open(path, "rb")
+        self.index_file = open(index_path, "rb")
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.index_data = mmap.mmap(self.index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.offsets = memoryview(self.index_data).cast("Q")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice):
+            return self[item:item + 1][0]
+        start_idx, end_idx, _ = item.indices(len(self))
+        if start_idx >= end_idx:
+            return []
+        lines = self.data[self.offsets[start_idx]:self.offsets[end_idx]].splitlines()
+        return [json.loads(line) for line in lines]
+
+    def close(self):
+        self.offsets.release()
+        self.index_data.close()
+        self.data.close()
+        self.index_file.close()
+        self.file.close()
+
+class PromptFile:
+    """
+    A prompt file, in either format:
+
+    - normalized: each prompt only holds its keyword, icl_indices and candidate image, and the
+      reference samples they point to are stored once, under "samples". ICL contents are built
+      when a prompt is sent, the rewritten Q/A text once per sample and example position.
+    - inline (older files): each prompt holds its full "prompt" contents.
+
+    A shard of a sharded run holds the prompts [start_idx, start_idx + len) of the run, and is
+    sliced with those indices.
+    """
+    def __init__(self, data, prompts=None):
+        """
+        :param data: Header, with the prompts under "prompts" unless passed separately.
+        :param prompts: List of prompts or IndexedPrompts.
+        """
+        self.prompts = data.pop("prompts") if prompts is None else prompts
+        self.samples = data.pop("samples", {})
+        self.header = data
+        self.normalized = data.get("format") == NORMALIZED_FORMAT
+        mode = GenerationMode(data["mode"])
+        self.include_icl = should_include_icl(mode)
+        self.include_candidate = mode != GenerationMode.TQA
+        self.image_folder = data.get("image_folder", "")
+        self.start_idx = data.get("start_idx", 0)
+        self.examples = {}
+
+    def __len__(self):
+        return len(self.prompts)
+
+    def slice(self, start_idx, num_prompts):
+        local_idx = start_idx - self.start_idx
+        if local_idx < 0:
+            raise ValueError(f"Prompt {start_idx} is not in this shard, which starts at prompt {self.start_idx}")
+        return self.prompts[local_idx:local_idx + num_prompts]
+
+    def example(self, sample_idx, example_num):
+        key = (sample_idx, example_num)
+        if key not in self.examples:
+            self.examples[key] = icl_example(self.samples[str(sample_idx)], example_num, self.image_folder)
+        return self.examples[key]
+
+    def contents(self, prompt_object):
+        """
+        Contents of a prompt: ICL examples ("Example N", image, Q/A text) then the candidate image.
+        """
+        if not self.normalized:
+            return prompt_object["prompt"]
+        contents = []
+        if self.include_icl:
+            for i, sample_idx in enumerate(prompt_object["icl_indices"]):
+                image, text = self.example(sample_idx, i + 1)
+                contents.extend([f"Example {i + 1}", image, text])
+        if self.include_candidate:
+            contents.append(prompt_object["candidate"])
+        return contents
+
+    def candidate(self, prompt_object):
+        if not self.normalized:
+            return prompt_object["prompt"][-1]
+        return prompt_object["candidate"]
+
+def is_jsonl(path):
+    return path.endswith(".jsonl")
+
+def write_index(index_path, offsets):
+    # Write then rename, workers may be reading the previous index
+    tmp_path = f"{index_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as file:
+        offsets.tofile(file)
+    os.replace(tmp_path, index_path)
+
+def build_index(path, index_path):
+    """
+    Index an existing JSON lines prompt file, e.g. one copied without its index.
+    """
+    offsets = array("Q")
+    with open(path, "rb") as file:
+        file.readline()
+        offset = file.tell()
+        for line in file:
+            if line.strip():
+                offsets.append(offset)
+            offset += len(line)
+    offsets.append(offset)
+    write_index(index_path, offsets)
+
+def write_prompt_file(path, header, samples, prompts):
+    """
+    Write a normalized prompt file. samples maps the reference sample indices used by the prompts
+    to their ICL fields. Paths ending in .jsonl get a header line, then one line per prompt, and an
+    offset index next to them, other paths a single JSON object.
+    """
+    header = {**header, "format": NORMALIZED_FORMAT, "samples": {str(idx): sample for idx, sample in samples.items()}}
+    encoder = json.JSONEncoder(separators=COMPACT_SEPARATORS)
+    if not is_jsonl(path):
+        with open(path, 'w') as file:
+            # Compact, the file is read by every worker
+            file.write(encoder.encode({**header, "prompts": prompts}))
+        return
+
+    offsets = array("Q")
+    with open(path, 'wb') as file:
+        file.write(encoder.encode(header).encode("utf-8") + b"\n")
+        for prompt_object in prompts:
+            offsets.append(file.tell())
+            file.write(encoder.encode(prompt_object).encode("utf-8") + b"\n")
+        offsets.append(file.tell())
+    write_index(path + INDEX_SUFFIX, offsets)
+
+def load_prompt_file(path):
+    """
+    Load a prompt file. JSON lines files are only indexed here, prompts are read when sliced.
+    """
+    if not is_jsonl(path):
+        with open(path, 'r') as file:
+            return PromptFile(json.load(file))
+
+    index_path = path + INDEX_SUFFIX
+    if not os.path.exists(index_path) or os.path.getmtime(index_path) < os.path.getmtime(path):
+        build_index(path, index_path)
+    with open(path, 'r') as file:
+        header = json.loads(file.readline())
+    return PromptFile(header, IndexedPrompts(path, index_path))
+
+
+def write_prompt_manifest(folder, manifest):
+    path = os.path.join(folder, MANIFEST_NAME)
+    with open(path, 'w') as file:
+        json.dump(manifest, file, indent=3)
+    return path
+
+def is_prompt_manifest(path):
+    return os.path.basename(path) == MANIFEST_NAME
+
+def load_prompt_manifest(path):
+    """
+    Manifest of a sharded run, with the path of each shard resolved against the manifest's folder.
+    """
+    with open(path, 'r') as file:
+        manifest = json.load(file)
+    for shard in manifest["shards"]:
+        shard["path"] = os.path.join(os.path.dirname(path), shard["path"])
+    return manifest
@@ -1,32 +1,40 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
 from enum import Enum
+from functools import lru_cache
 from loguru import logger
 from tqdm import tqdm 
 import argparse
 import json
 import math
+import numpy as np
 import os
-import random
-import re
 import sys
 from src.data_generation.minimal_dep_utils import GenerationMode, should_include_icl
+from src.data_generation.prompt_file import icl_sample, MANIFEST_NAME, write_prompt_file, write_prompt_manifest
     
 SAVE_PATH = "generated_prompts"
 
 class SubsetBatchSampler:
-    def __init__(self, samples, batch_size, subset_idx=None, include_indices=False):
+    """
+    Draws batches from a subset of samples, reshuffling the subset every epoch. The last batch of an
+    epoch holds what is left of it, so it may be smaller than batch_size.
+
+    Works on index arrays: the samples are neither copied nor touched until a batch is returned.
+    """
+    def __init__(self, samples, batch_size, subset_idx=None, include_indices=False, rng=None):
         if subset_idx is None:
-            subset_idx = list(range(len(samples)))
-        self.samples = [samples[i] for i in subset_idx]
+            subset_idx = np.arange(len(samples))
+        self.samples = samples
         self.batch_size = batch_size
-        self.original_indices = subset_idx
-        self.indices = range(len(self.samples))
+        self.original_indices = np.asarray(subset_idx, dtype=np.int64)
         self.include_indices = include_indices
+        self.rng = rng if rng is not None else np.random.default_rng()
         self.reset()
 
     def reset(self):
         # Shuffle the indices at the start of each epoch
-        self.shuffled_indices = random.sample(self.indices, len(self.indices))
+        self.shuffled_indices = self.rng.permutation(len(self.original_indices))
         self.index = 0
 
     def get_batch(self):
@@ -42,15 +50,36 @@ class SubsetBatchSampler:
         self.index = end_index
 
         # Retrieve the corresponding samples
-        batch_samples = [self.samples[i] for i in batch_indices]
+        original_indices = self.convert_to_original_indices(batch_indices)
+        batch_samples = [self.samples[i] for i in original_indices]
         
         if self.include_indices: 
-            return self.convert_to_original_indices(batch_indices), batch_samples
+            return original_indices, batch_samples
         else:
             return batch_samples
     
     def convert_to_original_indices(self, batch_indices):
-        return [self.original_indices[i] for i in batch_indices]
+        return self.original_indices[batch_indices].tolist()
+
+    def draw_indices(self, num_batches):
+        """
+        Original indices of the next num_batches batches, drawn from fresh epochs at once.
+
+        :return: Array of shape (num_batches, batch_size). Rows of batches cut short at the end of
+            an epoch are padded with -1.
+        """
+        subset_size = len(self.original_indices)
+        if subset_size == 0 or self.batch_size == 0:
+            # Nothing to draw from (e.g. a subgroup without reference samples) or no ICL samples
+            return np.full((num_batches, self.batch_size), -1, dtype=np.int64)
+        batches_per_epoch = math.ceil(subset_size / self.batch_size)
+        num_epochs = math.ceil(num_batches / batches_per_epoch)
+        # One independent shuffle of the subset per epoch (row)
+        epochs = self.rng.permuted(np.broadcast_to(self.original_indices, (num_epochs, subset_size)), axis=1)
+        padding = batches_per_epoch * self.batch_size - subset_size
+        if padding:
+            epochs = np.pad(epochs, ((0, 0), (0, padding)), constant_values=-1)
+        return epochs.reshape(-1, self.batch_size)[:num_batches]
 
     def __iter__(self):
         return self
@@ -58,6 +87,75 @@ class SubsetBatchSampler:
     def __next__(self):
         return self.get_batch()
 
+def split_sizes(total, num_parts):
+    """
+    Split total into num_parts sizes that differ by at most one.
+    """
+    return [total // num_parts + (1 if part < total % num_parts else 0) for part in range(num_parts)]
+
+@lru_cache(maxsize=1)
+def load_task_desc(task_desc_path):
+    # Loaded once per shard worker process
+    with open(task_desc_path, 'r') as file:
+        return json.load(file)
+
+def generate_shard(task_desc, subgroup_sizes, num_icl_samples, mode, seed_seq, logger=None):
+    """
+    Prompts for subgroup_sizes[i] candidates of each subgroup i, in subgroup order, drawn from a
+    generator seeded by seed_seq. Returns them with the indices of the reference samples they use.
+    """
+    rng = np.random.default_rng(seed_seq)
+    prompt_objects = []
+    used_sample_indices = set()
+    for subgroup, subgroup_size in zip(task_desc["subgroups"], subgroup_sizes):
+        # Create a sampler for the subgroup candidates
+        candidate_paths = subgroup["candidate_image_paths"]
+        candidate_sampler = SubsetBatchSampler(candidate_paths, 1, rng=rng)
+        
+        # Create a batch sampler for the reference samples
+        ref_sampler = SubsetBatchSampler(
+            task_desc["samples"], 
+            num_icl_samples, 
+            subset_idx=subgroup["reference_sample_idx"], 
+            include_indices=True,
+            rng=rng
+        )
+        
+        ##################################################################
+        #                    Generate Prompts                            #
+        ##################################################################
+        # Candidate and ICL samples of every prompt of the subgroup at once
+        candidate_indices = candidate_sampler.draw_indices(subgroup_size)[:, 0]
+        ref_indices = ref_sampler.draw_indices(subgroup_size)
+        if logger is not None:
+            logger.debug(f"Subgroup {subgroup['keyword']}: {subgroup_size} prompts over {len(candidate_paths)} candidate images")
+
+        # ICL samples of the prompts, only referenced here
+        ref_lists = ref_indices.tolist()
+        if (ref_indices < 0).any():
+            # Drop the padding of batches cut short at the end of an epoch
+            ref_lists = [[idx for idx in indices if idx >= 0] for indices in ref_lists]
+        if should_include_icl(mode):
+            used_sample_indices.update(np.unique(ref_indices[ref_indices >= 0]).tolist())
+
+        keyword = subgroup["keyword"]
+        prompt_objects.extend(
+            {"keyword": keyword, "candidate": candidate_paths[candidate_idx], "icl_indices": icl_indices}
+            for candidate_idx, icl_indices in zip(candidate_indices.tolist(), ref_lists)
+        )
+    return prompt_objects, used_sample_indices
+
+def write_shard(task_desc_path, path, header, subgroup_sizes, num_icl_samples, mode, seed_seq):
+    """
+    Generate and write one shard of a sharded run. Runs in a worker process, returns the number of
+    prompts written.
+    """
+    task_desc = load_task_desc(task_desc_path)
+    prompt_objects, used_sample_indices = generate_shard(task_desc, subgroup_sizes, num_icl_samples, mode, seed_seq)
+    samples = {idx: icl_sample(task_desc["samples"][idx]) for idx in sorted(used_sample_indices)}
+    write_prompt_file(path, header, samples, prompt_objects)
+    return len(prompt_objects)
+
 class PromptGenerator:
     def __init__(self, args, logger):
         """
@@ -70,92 +168,98 @@ class PromptGenerator:
         self.total_gen = args.total_gen
         self.num_icl_samples = args.num_icl_samples
         self.mode = args.mode
+        # Without a seed, fresh entropy is drawn and recorded so the run can be reproduced
+        self.seed_seq = np.random.SeedSequence(args.seed)
+        self.num_shards = args.num_shards
+        self.num_workers = args.num_workers
         self.logger = logger
         self.logger.info(f"Generation Mode: {self.mode}")
                     
         # DT string to associate examples with time of run
         self.dt_str = datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.output_file = os.path.join(args.output_folder, SAVE_PATH, f"{args.file_prefix}_prompts_{self.dt_str}.json")
-        os.makedirs(os.path.join(args.output_folder, SAVE_PATH), exist_ok=True)
-
-    def number_to_ordinal(self, n):
-        ordinals = ["first", "second", "third", "fourth", "fifth", "sixth", "seventh", "eighth", "ninth", "tenth"]
-        if 1 <= n <= 10:
-            return ordinals[n - 1]
+        if self.num_shards > 1:
+            # Folder of shards, output_file is their manifest
+            self.shard_folder = os.path.join(args.output_folder, SAVE_PATH, f"{args.file_prefix}_prompts_{self.dt_str}")
+            self.output_file = os.path.join(self.shard_folder, MANIFEST_NAME)
+            os.makedirs(self.shard_folder, exist_ok=True)
         else:
-            raise ValueError("Number out of range. Only numbers from 1 to 10 are supported.")
+            self.output_file = os.path.join(args.output_folder, SAVE_PATH, f"{args.file_prefix}_prompts_{self.dt_str}.jsonl")
+            os.makedirs(os.path.join(args.output_folder, SAVE_PATH), exist_ok=True)
+
+    def header(self, gen_subgroup_sizes):
+        return {
+            "task_desc_path": self.task_desc_path,
+            "dataset_description": self.task_desc["dataset_description"],
+            "num_icl_samples": self.num_icl_samples,
+            "mode": self.mode.value,
+            "min_gen_per_candidate": self.min_gen_per_candidate,
+            "total_gen": sum(gen_subgroup_sizes),
+            "image_folder": self.task_desc["image_folder"],
+            "seed": self.seed_seq.entropy
+        }
         
     def generate_prompts(self):
         """
         This method processes candidate images, constructs prompts.
+        Prompts reference their ICL samples by index, the samples are stored once in the prompt file
+        (see prompt_file.py) and turned into ICL contents by the data generator.
+
+        With num_shards > 1 the prompts are split into shards generated in parallel processes, see
+        generate_shards. Returns the number of prompts.
         """
         self.logger.info("Generating prompts.")
-        self.prompt_objects = []
         
         # Compute number of samples to generate per subgroup
         ref_subgroup_sizes = [len(subgroup["reference_sample_idx"]) for subgroup in self.task_desc["subgroups"]]
         total_samples = sum(ref_subgroup_sizes)
         subgroup_proportions = [size / total_samples for size in ref_subgroup_sizes]
         gen_subgroup_sizes = [math.ceil(self.total_gen * prop / self.min_gen_per_candidate) for prop in subgroup_proportions]
+        if self.num_shards > 1:
+            return self.generate_shards(gen_subgroup_sizes)
         
-        pbar = tqdm(total=sum(gen_subgroup_sizes), desc="Generating Prompts")
-        for subgroup, subgroup_size in zip(self.task_desc["subgroups"], gen_subgroup_sizes):
-            # Create a sampler for the subgroup candidates
-            candidate_sampler = SubsetBatchSampler(subgroup["candidate_image_paths"], 1)
-            
-            # Create a batch sampler for the reference samples
-            ref_sampler = SubsetBatchSampler(
-                self.task_desc["samples"], 
-                self.num_icl_samples, 
-                subset_idx=subgroup["reference_sample_idx"], 
-                include_indices=True
-            )
-            
-            for _ in range(subgroup_size):
-                
-                ##################################################################
-                #                    Generate Prompts                            #
-                ##################################################################
-                candidate_image_path = candidate_sampler.get_batch()[0]
-                
-                # Load candidate image
-                self.logger.debug(f"Processing candidate image: {candidate_image_path}")
-
-                # Construct ICL Prompt
-                ref_indices, ref_batch = ref_sampler.get_batch()
-                prompt = []
-                if should_include_icl(self.mode):
-                    for i, sample in enumerate(ref_batch):
-                        example_num = i + 1
-                        image = os.path.join(self.task_desc["image_folder"], sample["image_1"])
-                        query = sample["conversations"][0]["value"]
-                        answer = sample["conversations"][1]["value"]
-                        query = re.sub("<image.?.?.?>", f"Refer to the {self.number_to_ordinal(example_num)} image.", query)
-                        query = re.sub("<.*>", "", query)
-                        prompt.extend([f"Example {example_num}", image, f"Q: {query}\n A: {answer}"])
-                
-                if self.mode != GenerationMode.TQA:
-                    prompt.append(candidate_image_path)
-
-                self.prompt_objects.append({
-                    "keyword": subgroup["keyword"],
-                    "prompt": prompt, 
-                    "icl_indices": ref_indices
-                })
-                pbar.update(1)
+        self.prompt_objects, used_sample_indices = generate_shard(self.task_desc, gen_subgroup_sizes, self.num_icl_samples, self.mode, self.seed_seq, self.logger)
+        samples = {idx: icl_sample(self.task_desc["samples"][idx]) for idx in sorted(used_sample_indices)}
+        write_prompt_file(self.output_file, self.header(gen_subgroup_sizes), samples, self.prompt_objects)
+        return len(self.prompt_objects)
+
+    def generate_shards(self, gen_subgroup_sizes):
+        """
+        Write num_shards prompt files and their manifest. Each shard holds an even share of every
+        subgroup, drawn with its own seed spawned from the run's seed, so the prompts only depend on
+        the seed and num_shards, not on how many processes generate them. Shard i holds the prompts
+        [start_idx, start_idx + num_prompts) of the run, and is a complete prompt file a
+        data_generator worker can be pointed at.
+        """
+        # Rows are shards, columns subgroups
+        shard_subgroup_sizes = np.array([split_sizes(size, self.num_shards) for size in gen_subgroup_sizes]).T.tolist()
+        shard_sizes = [sum(sizes) for sizes in shard_subgroup_sizes]
+        start_indices = np.concatenate([[0], np.cumsum(shard_sizes)[:-1]]).tolist()
+        seed_seqs = self.seed_seq.spawn(self.num_shards)
+        header = self.header(gen_subgroup_sizes)
+
+        shards = []
+        for shard_id in range(self.num_shards):
+            shards.append({"path": f"shard_{shard_id:05d}.jsonl", "shard_id": shard_id, "start_idx": start_indices[shard_id], "num_prompts": shard_sizes[shard_id]})
+        shard_args = [
+            (self.task_desc_path, os.path.join(self.shard_folder, shard["path"]), {**header, "shard_id": shard["shard_id"], "num_shards": self.num_shards, "start_idx": shard["start_idx"]}, shard_subgroup_sizes[shard["shard_id"]], self.num_icl_samples, self.mode, seed_seqs[shard["shard_id"]])
+            for shard in shards
+        ]
+
+        num_workers = min(self.num_workers, self.num_shards)
+        self.logger.info(f"Generating {sum(shard_sizes)} prompts in {self.num_shards} shards with {num_workers} processes.")
+        pbar = tqdm(total=sum(shard_sizes), desc="Generating Prompts")
+        if num_workers > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                futures = [executor.submit(write_shard, *args) for args in shard_args]
+                for future in as_completed(futures):
+                    pbar.update(future.result())
+        else:
+            for args in shard_args:
+                pbar.update(write_shard(*args))
         pbar.close()
-        
-        with open(self.output_file, 'w') as file:
-            prompt_file = {
-                "task_desc_path": self.task_desc_path,
-                "dataset_description": self.task_desc["dataset_description"],
-                "num_icl_samples": self.num_icl_samples,
-                "mode": self.mode.value,
-                "min_gen_per_candidate": self.min_gen_per_candidate,
-                "total_gen": sum(gen_subgroup_sizes),
-                "prompts": self.prompt_objects
-            }
-            json.dump(prompt_file, file, indent=3)
+
+        write_prompt_manifest(self.shard_folder, {**header, "num_shards": self.num_shards, "shards": shards})
+        return sum(shard_sizes)
             
 def load_json_file(skill_desc):
     """
@@ -197,6 +301,9 @@ if __name__ == "__main__":
     parser.add_argument("--min_gen_per_candidate", type=int, default=1, help="Number of generated data points per candidate.")
     parser.add_argument("--num_icl_samples", type=int, default=1, help="Number of in context samples provided per generation.")
     parser.add_argument("--mode", choices=[mode.value for mode in GenerationMode], default=GenerationMode.VQA_NR, help="Mode to generate data")
+    parser.add_argument("--seed", type=int, default=None, help="Random seed for candidate and ICL sample assignment")
+    parser.add_argument("--num_shards", type=int, default=1, help="Write the prompts as this many shards, one per data generation worker, plus a manifest.")
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count() or 1, help="Processes generating shards in parallel.")
     parser.add_argument("--debug", action='store_true', help="Enable debug logging")
 
     args = parser.parse_args()
@@ -0,0 +1,236 @@
+from contextlib import contextmanager
+import asyncio
+import fcntl
+import json
+import os
+import random
+import re
+import tempfile
+import time
+
+DEFAULT_STATE_DIR = os.path.join(tempfile.gettempdir(), "mmgen_rate_limits")
+
+# Quotas are enforced by the service over short windows, so only allow bursts of this many
+# seconds worth of the per minute quota.
+DEFAULT_BURST_SEC = 10
+
+# Upper bound on a single sleep while waiting for the bucket, so we re-check shared state often
+MAX_POLL_SEC = 5.0
+
+# Rough token costs used to estimate a request before it is sent
+CHARS_PER_TOKEN = 4
+HIGH_DETAIL_IMAGE_TOKENS = 765
+LOW_DETAIL_IMAGE_TOKENS = 85
+DEFAULT_COMPLETION_TOKENS = 1000
+
+def estimate_content_tokens(content):
+    """
+    Estimate the prompt tokens of a message content, either a string or a text/image part.
+    """
+    if type(content) == str:
+        return len(content) // CHARS_PER_TOKEN
+    if content["type"] == "text":
+        return len(content["text"]) // CHARS_PER_TOKEN
+    if content["image_url"].get("detail") == "low":
+        return LOW_DETAIL_IMAGE_TOKENS
+    return HIGH_DETAIL_IMAGE_TOKENS
+
+def estimate_request_tokens(request, completion_tokens=DEFAULT_COMPLETION_TOKENS):
+    """
+    Estimate the number of tokens a chat completion request will consume.
+    """
+    num_tokens = completion_tokens
+    for message in request["messages"]:
+        if type(message["content"]) == str:
+            num_tokens += estimate_content_tokens(message["content"])
+            continue
+        for content in message["content"]:
+            num_tokens += estimate_content_tokens(content)
+    return num_tokens
+
+def get_retry_after_sec(error):
+    """
+    Read the Retry-After hint from an API error, returns None if there is none.
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header, scale in [("retry-after-ms", 1e-3), ("retry-after", 1.0)]:
+        value = headers.get(header)
+        if value is None:
+            continue
+        try:
+            return float(value) * scale
+        except ValueError:
+            continue
+    return None
+
+class RateLimiter:
+    """
+    Client side token bucket tracking requests/min and tokens/min for a single deployment.
+
+    The bucket state lives in a small JSON file guarded by an flock, so all worker processes
+    on a host that use the same key (and state_dir) share one budget.
+    """
+    def __init__(self, key, rpm_limit=0, tpm_limit=0, state_dir=DEFAULT_STATE_DIR, burst_sec=DEFAULT_BURST_SEC, logger=None):
+        self.key = key
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.request_capacity = max(1.0, rpm_limit * burst_sec / 60)
+        self.token_capacity = max(1.0, tpm_limit * burst_sec / 60)
+        self.logger = logger
+        # Bucket state as of the last time this process held the lock, see cached_headroom
+        self.last_state = None
+
+        os.makedirs(state_dir, exist_ok=True)
+        safe_key = re.sub(r"[^A-Za-z0-9_.-]", "_", key)
+        self.state_path = os.path.join(state_dir, f"{safe_key}.json")
+        self.lock_path = self.state_path + ".lock"
+
+    def is_enabled(self):
+        return self.rpm_limit > 0 or self.tpm_limit > 0
+
+    @contextmanager
+    def locked_state(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                state = self.read_state()
+                yield state
+                self.write_state(state)
+                self.last_state = dict(state)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read_state(self):
+        now = time.time()
+        try:
+            with open(self.state_path, "r") as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {
+                "requests": self.request_capacity,
+                "tokens": self.token_capacity,
+                "updated_at": now,
+                "blocked_until": 0.0
+            }
+
+    def write_state(self, state):
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(state, file)
+        os.replace(tmp_path, self.state_path)
+
+    def refill(self, state, now):
+        elapsed = max(0.0, now - state["updated_at"])
+        state["requests"] = min(self.request_capacity, state["requests"] + elapsed * self.rpm_limit / 60)
+        state["tokens"] = min(self.token_capacity, state["tokens"] + elapsed * self.tpm_limit / 60)
+        state["updated_at"] = now
+
+    def reserve(self, num_tokens):
+        """
+        Take one request and num_tokens from the bucket if available.
+        Returns 0 on success, otherwise the number of seconds to wait before trying again.
+        """
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            wait_sec = max(0.0, state["blocked_until"] - now)
+            if self.rpm_limit > 0 and state["requests"] < 1:
+                wait_sec = max(wait_sec, (1 - state["requests"]) * 60 / self.rpm_limit)
+            # Requests larger than the bucket are let through once it is full, leaving it in debt
+            needed_tokens = min(num_tokens, self.token_capacity)
+            if self.tpm_limit > 0 and state["tokens"] < needed_tokens:
+                wait_sec = max(wait_sec, (needed_tokens - state["tokens"]) * 60 / self.tpm_limit)
+            if wait_sec > 0:
+                return wait_sec
+            if self.rpm_limit > 0:
+                state["requests"] -= 1
+            if self.tpm_limit > 0:
+                state["tokens"] -= num_tokens
+            return 0.0
+
+    def state_headroom(self, state, now):
+        if state["blocked_until"] > now:
+            return 0.0
+        fractions = []
+        if self.rpm_limit > 0:
+            fractions.append(state["requests"] / self.request_capacity)
+        if self.tpm_limit > 0:
+            fractions.append(state["tokens"] / self.token_capacity)
+        return max(0.0, min(fractions, default=1.0))
+
+    def headroom(self):
+        """
+        Fraction of the bucket currently available, 0 while blocked after a 429.
+        """
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            return self.state_headroom(state, now)
+
+    def cached_headroom(self):
+        """
+        headroom() without touching the shared state: from the bucket as this process last saw it
+        (on acquire, reconcile or penalize), refilled since. Misses what other processes took in
+        the meantime, which is fine for weighting deployments.
+        """
+        if self.last_state is None:
+            return 1.0
+        state = dict(self.last_state)
+        now = time.time()
+        self.refill(state, now)
+        return self.state_headroom(state, now)
+
+    def next_sleep_sec(self, wait_sec):
+        # Jitter so workers sharing the bucket do not wake up in lockstep
+        return min(wait_sec, MAX_POLL_SEC) * random.uniform(1.0, 1.2)
+
+    def acquire(self, num_tokens):
+        if not self.is_enabled():
+            return 0.0
+        waited_sec = 0.0
+        wait_sec = self.reserve(num_tokens)
+        while wait_sec > 0:
+            sleep_sec = self.next_sleep_sec(wait_sec)
+            time.sleep(sleep_sec)
+            waited_sec += sleep_sec
+            wait_sec = self.reserve(num_tokens)
+        if waited_sec > 0 and self.logger is not None:
+            self.logger.debug(f"Rate limiter {self.key}: waited {waited_sec:.2f} seconds.")
+        return waited_sec
+
+    async def acquire_async(self, num_tokens):
+        if not self.is_enabled():
+            return 0.0
+        waited_sec = 0.0
+        # The flock may be held by other processes, wait on it off the event loop
+        wait_sec = await asyncio.to_thread(self.reserve, num_tokens)
+        while wait_sec > 0:
+            sleep_sec = self.next_sleep_sec(wait_sec)
+            await asyncio.sleep(sleep_sec)
+            waited_sec += sleep_sec
+            wait_sec = await asyncio.to_thread(self.reserve, num_tokens)
+        if waited_sec > 0 and self.logger is not None:
+            self.logger.debug(f"Rate limiter {self.key}: waited {waited_sec:.2f} seconds.")
+        return waited_sec
+
+    def reconcile(self, estimated_tokens, actual_tokens):
+        """
+        Correct the token bucket once the actual usage of a request is known.
+        """
+        if self.tpm_limit <= 0 or actual_tokens is None:
+            return
+        with self.locked_state() as state:
+            self.refill(state, time.time())
+            state["tokens"] = min(self.token_capacity, state["tokens"] + estimated_tokens - actual_tokens)
+
+    def penalize(self, retry_after_sec):
+        """
+        Block every process sharing this bucket until the service says we may retry.
+        """
+        with self.locked_state() as state:
+            now = time.time()
+            self.refill(state, now)
+            state["blocked_until"] = max(state["blocked_until"], now + retry_after_sec)
+        if self.logger is not None:
+            self.logger.warning(f"Rate limiter {self.key}: blocked for {retry_after_sec:.2f} seconds.")
@@ -0,0 +1,107 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+DEFAULT_MAX_MB = 1024
+
+# Check the cache size every this many insertions
+EVICTION_CHECK_INTERVAL = 100
+
+def request_key(model_name, request, cache_tag=""):
+    """
+    Hash of everything that determines a response: the model, system prompt, texts and images.
+    Images are part of the request as base64 data, so they are hashed by content.
+
+    cache_tag separates otherwise identical requests that should get independent responses, e.g.
+    two prompts that happen to pair the same candidate image with the same ICL examples.
+    """
+    hasher = hashlib.sha256()
+    hasher.update(model_name.encode("utf-8") + b"\0")
+    hasher.update(cache_tag.encode("utf-8") + b"\0")
+    hasher.update(json.dumps(request, sort_keys=True).encode("utf-8"))
+    return hasher.hexdigest()
+
+class ResponseCache:
+    """
+    On-disk cache of raw model responses in a SQLite file, so re-runs over the same prompts
+    (including format fixing calls) are re-parsed locally instead of paid for again.
+
+    Safe to share between threads and between processes pointing at the same file. Once the cache
+    grows over max_mb, least recently used entries are evicted.
+    """
+    def __init__(self, db_path, max_mb=DEFAULT_MAX_MB, logger=None):
+        self.db_path = db_path
+        self.max_bytes = max_mb * 1024 * 1024
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self.num_puts = 0
+        self.conn = sqlite3.connect(db_path, timeout=120, isolation_level=None, check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model_name TEXT NOT NULL,
+                response TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats["misses"] += 1
+                return None
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.stats["hits"] += 1
+            return row[0]
+
+    def put(self, key, model_name, response):
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, model_name, response, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model_name, response, len(response.encode("utf-8")), now, now)
+            )
+            self.num_puts += 1
+            if self.num_puts % EVICTION_CHECK_INTERVAL == 0:
+                self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is below 90% of its maximum size.
+        """
+        total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        target_bytes = int(self.max_bytes * 0.9)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY last_access")
+            evict_keys = []
+            for key, size in rows:
+                if total_bytes <= target_bytes:
+                    break
+                evict_keys.append((key,))
+                total_bytes -= size
+            self.conn.executemany("DELETE FROM responses WHERE key = ?", evict_keys)
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.stats["evictions"] += len(evict_keys)
+
+    def hit_rate(self):
+        total = self.stats["hits"] + self.stats["misses"]
+        if total == 0:
+            return 0.0
+        return self.stats["hits"] / total
+
+    def log_stats(self):
+        if self.logger is not None:
+            self.logger.info(f"Response cache: {self.stats}, hit rate {self.hit_rate():.2%}")
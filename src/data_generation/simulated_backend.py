@@ -0,0 +1,185 @@
+from collections import deque
+from src.data_generation.prefix_cache import PrefixCacheStats
+from src.data_generation.rate_limiter import CHARS_PER_TOKEN, estimate_request_tokens
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+
+LATENCY_DISTRIBUTIONS = ["fixed", "exponential", "lognormal"]
+
+# Ways model output goes wrong, all but the last are repaired without the format fixing agent
+MALFORMED_KINDS = ["fence", "prose", "trailing_comma", "truncated", "refusal"]
+
+# Output keys in the order the prompts ask for them
+OUTPUT_KEYS = "IQRA"
+
+FILLER_WORDS = (
+    "the chart shows a steady increase across each category while the legend marks two series "
+    "and the axis labels indicate values measured over several years in the region"
+).split()
+
+class SimulatedBackend:
+    """
+    Behaves like a chat completions deployment for load testing the generation pipeline offline.
+    Answers with JSON in the format the request's system prompt asks for, after a sampled latency,
+    and injects throttling (429), server errors (5xx) and malformed output at configurable rates.
+    Usage reports prompt, completion and cached tokens, the latter from simulated prefix caching.
+    """
+    def __init__(
+        self,
+        latency_sec=0.2,
+        latency_dist="lognormal",
+        latency_sigma=0.5,
+        sec_per_token=0.0,
+        throttle_rate=0.0,
+        rpm_limit=0,
+        tpm_limit=0,
+        retry_after_sec=1.0,
+        error_rate=0.0,
+        malformed_rate=0.0,
+        answer_words=30,
+        seed=None
+    ):
+        assert latency_dist in LATENCY_DISTRIBUTIONS, "latency_dist must be in " + ", ".join(LATENCY_DISTRIBUTIONS)
+        self.latency_sec = latency_sec
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.sec_per_token = sec_per_token
+        self.throttle_rate = throttle_rate
+        self.rpm_limit = rpm_limit
+        self.tpm_limit = tpm_limit
+        self.retry_after_sec = retry_after_sec
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.answer_words = answer_words
+        self.random = random.Random(seed)
+        self.prefix_cache = PrefixCacheStats()
+        self.lock = threading.Lock()
+        # (time, tokens) of requests let through in the last minute
+        self.recent_requests = deque()
+        self.stats = {"requests": 0, "throttled": 0, "errors": 0, "malformed": 0, "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0}
+
+    def sample_latency(self, completion_tokens):
+        if self.latency_dist == "fixed":
+            latency_sec = self.latency_sec
+        elif self.latency_dist == "exponential":
+            latency_sec = self.random.expovariate(1 / self.latency_sec) if self.latency_sec > 0 else 0.0
+        else:
+            # Parameterized so the mean is latency_sec
+            mu = math.log(max(self.latency_sec, 1e-6)) - self.latency_sigma ** 2 / 2
+            latency_sec = self.random.lognormvariate(mu, self.latency_sigma)
+        return latency_sec + completion_tokens * self.sec_per_token
+
+    def quota_check(self, num_tokens, now):
+        """
+        Returns whether the request is over quota, and the rate limit headers to send.
+        """
+        while self.recent_requests and now - self.recent_requests[0][0] > 60:
+            self.recent_requests.popleft()
+        used_tokens = sum(tokens for _, tokens in self.recent_requests)
+        over_quota = (
+            (self.rpm_limit > 0 and len(self.recent_requests) >= self.rpm_limit)
+            or (self.tpm_limit > 0 and used_tokens + num_tokens > self.tpm_limit)
+        )
+        headers = {}
+        if self.rpm_limit > 0:
+            headers["x-ratelimit-limit-requests"] = str(self.rpm_limit)
+            headers["x-ratelimit-remaining-requests"] = str(max(0, self.rpm_limit - len(self.recent_requests) - 1))
+        if self.tpm_limit > 0:
+            headers["x-ratelimit-limit-tokens"] = str(self.tpm_limit)
+            headers["x-ratelimit-remaining-tokens"] = str(max(0, self.tpm_limit - used_tokens - num_tokens))
+        return over_quota, headers
+
+    def sentence(self, num_words):
+        return " ".join(self.random.choice(FILLER_WORDS) for _ in range(max(1, num_words))).capitalize() + "."
+
+    def generated_object(self, keys, idx):
+        values = {
+            "I": f"A bar chart comparing {idx + 2} categories. " + self.sentence(self.answer_words // 2),
+            "Q": f"Which category has the highest value in the image? A: first\nB: second\nC: third\nD: fourth",
+            "R": self.sentence(self.answer_words),
+            "A": self.random.choice("ABCD") if "Q" in keys else self.sentence(self.answer_words * 2)
+        }
+        return {key: values[key] for key in OUTPUT_KEYS if key in keys}
+
+    def malform(self, content, kind):
+        if kind == "fence":
+            return f"```json\n{content}\n```"
+        if kind == "prose":
+            return f"Here are the generated examples:\n{content}\nLet me know if you need more."
+        if kind == "trailing_comma":
+            return content[:-2] + "},]"
+        if kind == "truncated":
+            return content[:max(2, int(len(content) * self.random.uniform(0.5, 0.95)))]
+        return "I'm sorry, but I can't help with that request."
+
+    def completion_content(self, request):
+        """
+        JSON output in the format asked for by the request: keys from the example in the system
+        prompt, number of objects from "Generate exactly <NUM>" in the user message.
+        """
+        system_prompt = ""
+        user_text = ""
+        for message in request["messages"]:
+            if type(message["content"]) == str:
+                text = message["content"]
+            else:
+                text = " ".join(content["text"] for content in message["content"] if content["type"] == "text")
+            if message["role"] == "system":
+                system_prompt += text
+            else:
+                user_text += text
+        # Format fixing requests carry the format in the user message
+        keys = set(re.findall(r'"([A-Z])"\s*:', system_prompt)) or set(re.findall(r'"([A-Z])"\s*:', user_text)) or {"Q", "A"}
+        num_match = re.search(r"Generate exactly (\d+)", user_text)
+        num_objects = int(num_match.group(1)) if num_match else 1
+        return json.dumps([self.generated_object(keys, idx) for idx in range(num_objects)])
+
+    def respond(self, request):
+        """
+        Simulate one chat completion. Returns (status, body, headers, delay before answering).
+        """
+        now = time.time()
+        prompt_tokens = estimate_request_tokens(request, completion_tokens=0)
+        with self.lock:
+            self.stats["requests"] += 1
+            over_quota, headers = self.quota_check(prompt_tokens, now)
+            if over_quota or self.random.random() < self.throttle_rate:
+                self.stats["throttled"] += 1
+                headers["retry-after"] = str(self.retry_after_sec)
+                return 429, {"error": {"message": "Rate limit exceeded. Retry later.", "type": "rate_limit_exceeded", "code": "429"}}, headers, 0.0
+            if self.random.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return self.random.choice([500, 503]), {"error": {"message": "The server had an error processing the request.", "type": "server_error"}}, headers, self.sample_latency(0)
+
+            content = self.completion_content(request)
+            if self.random.random() < self.malformed_rate:
+                self.stats["malformed"] += 1
+                content = self.malform(content, self.random.choice(MALFORMED_KINDS))
+            completion_tokens = max(1, len(content) // CHARS_PER_TOKEN)
+            self.recent_requests.append((now, prompt_tokens + completion_tokens))
+            delay_sec = self.sample_latency(completion_tokens)
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+        cached_tokens = self.prefix_cache.record(request)
+        with self.lock:
+            self.stats["cached_tokens"] += cached_tokens
+
+        body = {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(now),
+            "model": request.get("model", ""),
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}
+            }
+        }
+        return 200, body, headers, delay_sec
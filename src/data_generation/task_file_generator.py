@@ -1,5 +1,6 @@
 from datetime import datetime
 from loguru import logger
+from src.image_retrieval.cpu_backend import CPU_PRECISIONS, CPUBackend
 from utils import CLIPZeroShotClassifier
 import argparse
 import json 
@@ -22,7 +23,10 @@ class TaskFileGenerator():
         
         self.task_file = self.initialize_task_file()
         self.device = torch.device(f"cuda:{args.gpu}" if torch.cuda.is_available() else "cpu")
-        self.zeroshot_classifier = CLIPZeroShotClassifier(self.model_name, self.batch_size, args.gpu, logger)
+        cpu_backend = None
+        if self.device.type == "cpu":
+            cpu_backend = CPUBackend(args.precision, args.num_threads, args.onnx_folder, self.model_name, logger)
+        self.zeroshot_classifier = CLIPZeroShotClassifier(self.model_name, self.batch_size, self.device, logger, cpu_backend=cpu_backend)
         self.DT_STR = datetime.now().strftime("%Y_%m_%d_%H:%M:%S")
         self.output_path = os.path.join(args.output_folder, f"{self.output_prefix}_{self.DT_STR}.json")
         logger.info("TaskFileGenerator initialized successfully.")
@@ -64,6 +68,9 @@ def main():
     parser.add_argument('--model_name', type=str, help='Path to the CLIP model', default="openai/clip-vit-large-patch14")
     parser.add_argument('--batch_size', type=int, help='Batch size', default=512)
     parser.add_argument('--gpu', type=int, help='GPU device to use', default=0)
+    parser.add_argument('--precision', type=str, choices=CPU_PRECISIONS, help='Precision of the CLIP encoders without a GPU', default="fp32")
+    parser.add_argument('--num_threads', type=int, help='Threads of the CLIP encoders without a GPU (0 for one per core)', default=0)
+    parser.add_argument('--onnx_folder', type=str, help='Without a GPU, export the CLIP encoders to ONNX under this folder and run them with ONNX Runtime', default="")
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
     args = parser.parse_args()
 
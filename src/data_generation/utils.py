@@ -1,14 +1,29 @@
-from PIL import Image
+from src.image_retrieval.image_loading import ImageDataset, collate_images, load_image
+from torch.utils.data import DataLoader
 from torchvision import transforms 
 from transformers import CLIPProcessor, CLIPModel
 import torch
 
 class CLIPZeroShotClassifier:
-    def __init__(self, model_name, batch_size, device, logger=None):
+    def __init__(self, model_name, batch_size, device, logger=None, num_workers=4, cpu_backend=None):
+        """
+        :param cpu_backend: CPUBackend running both encoders, when device is the CPU.
+        """
         self.device = device
         self.clip_model = CLIPModel.from_pretrained(model_name).to(self.device)
         self.clip_processor = CLIPProcessor.from_pretrained(model_name)
+        # Images are decoded at reduced size for the processor's resize
+        self.image_size = self.clip_processor.image_processor.size["shortest_edge"]
+        self.encode_image = self.clip_model.get_image_features
+        self.encode_text = self.clip_model.get_text_features
+        if cpu_backend is not None:
+            self.clip_model = cpu_backend.prepare(self.clip_model)
+            example_text = self.clip_processor(text=["a photo"], return_tensors="pt", padding=True)
+            self.encode_image = cpu_backend.encoder(self.clip_model, "get_image_features", [torch.zeros(1, 3, self.image_size, self.image_size)])
+            self.encode_text = cpu_backend.encoder(self.clip_model, "get_text_features", [example_text["input_ids"], example_text["attention_mask"]])
         self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.failed_image_paths = []
         self.logger = logger
         if self.logger is None:
             from loguru import logger
@@ -20,19 +35,26 @@ class CLIPZeroShotClassifier:
         text_embeddings = text_embeddings / text_embeddings.norm(dim=-1, keepdim=True)
 
         classification_map = {text: [] for text in texts}
-        batch_size = self.batch_size
 
-        for i in range(0, len(image_paths), batch_size):
-            batch_image_paths = image_paths[i:i + batch_size]
-            image_embeddings = self.compute_image_embeddings(batch_image_paths)
+        # Images are loaded in worker processes, those that fail to load are left out of every class
+        dataset = ImageDataset(image_paths, target_size=self.image_size, names=list(range(len(image_paths))))
+        dataloader = DataLoader(dataset, batch_size=self.batch_size, num_workers=self.num_workers, collate_fn=collate_images)
+        self.failed_image_paths = []
+        for images, image_indices, failed_indices in dataloader:
+            self.failed_image_paths.extend(image_paths[idx] for idx in failed_indices)
+            if images is None:
+                continue
+            image_embeddings = self.embed_images(images)
             image_embeddings = image_embeddings / image_embeddings.norm(dim=-1, keepdim=True)
 
             similarities = torch.matmul(image_embeddings, text_embeddings.T)
             image_to_text_indices = torch.argmax(similarities, dim=1)
 
-            for img_idx, text_idx in enumerate(image_to_text_indices):
-                classification_map[texts[text_idx.item()]].append(i + img_idx)
+            for img_idx, text_idx in zip(image_indices, image_to_text_indices):
+                classification_map[texts[text_idx.item()]].append(img_idx)
 
+        if self.failed_image_paths:
+            self.logger.warning(f"{len(self.failed_image_paths)} images failed to load and were not classified: {self.failed_image_paths[:10]}")
         self.logger.debug("Zero-shot classification completed.")
         return classification_map
     
@@ -42,18 +64,20 @@ class CLIPZeroShotClassifier:
         inputs = self.clip_processor(text=texts, return_tensors="pt", padding=True).to(self.device)
         
         with torch.no_grad():
-            text_embeddings = self.clip_model.get_text_features(**inputs)
+            text_embeddings = self.encode_text(inputs["input_ids"], inputs["attention_mask"])
         
         self.logger.debug("Text embeddings computed.")
         return text_embeddings
     
     def compute_image_embeddings(self, image_paths):
+        return self.embed_images([load_image(image_path, self.image_size) for image_path in image_paths])
+
+    def embed_images(self, images):
         self.logger.debug("Computing image embeddings.")
-        images = [Image.open(image_path) for image_path in image_paths]
         inputs = self.clip_processor(images=images, return_tensors="pt").to(self.device)
 
         with torch.no_grad():
-            image_embeddings = self.clip_model.get_image_features(**inputs)
+            image_embeddings = self.encode_image(inputs["pixel_values"])
         
         self.logger.debug("Image embeddings computed.")
         return image_embeddings
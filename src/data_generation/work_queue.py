@@ -0,0 +1,136 @@
+import sqlite3
+import time
+
+DEFAULT_RANGE_SIZE = 100
+DEFAULT_LEASE_SEC = 600
+DEFAULT_MAX_ATTEMPTS = 3
+
+class LeaseLostError(Exception):
+    pass
+
+class WorkQueue:
+    """
+    Lease based queue of prompt ranges backed by a SQLite file.
+
+    Workers on any node that can see the file lease one small range at a time and renew the lease
+    while they work on it. Leases that expire (dead or stuck worker) go back to the queue, so no
+    single worker can leave a long straggler tail. A range is marked failed after max_attempts leases.
+    """
+    def __init__(self, db_path, lease_sec=DEFAULT_LEASE_SEC, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.db_path = db_path
+        self.lease_sec = lease_sec
+        self.max_attempts = max_attempts
+        # Autocommit mode, transactions are started explicitly. Rollback journal rather than WAL,
+        # since WAL does not work on network filesystems.
+        self.conn = sqlite3.connect(db_path, timeout=120, isolation_level=None)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS ranges (
+                range_id INTEGER PRIMARY KEY,
+                start_idx INTEGER NOT NULL,
+                num_prompts INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                prompts_done INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+
+    def initialize(self, total_prompts, range_size=DEFAULT_RANGE_SIZE):
+        """
+        Split the prompts into ranges, unless the queue was already initialized (e.g. by another node).
+        """
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.conn.execute("SELECT COUNT(*) FROM ranges").fetchone()[0] == 0:
+                self.conn.executemany(
+                    "INSERT INTO ranges (start_idx, num_prompts) VALUES (?, ?)",
+                    [(start_idx, min(range_size, total_prompts - start_idx)) for start_idx in range(0, total_prompts, range_size)]
+                )
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def lease(self, worker_id):
+        """
+        Lease the next available range, returns None once there is nothing left to lease.
+        """
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Expired leases that used up all attempts will not be retried
+            self.conn.execute(
+                "UPDATE ranges SET status = 'failed' WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?",
+                (now, self.max_attempts)
+            )
+            row = self.conn.execute(
+                "SELECT range_id, start_idx, num_prompts, attempts FROM ranges "
+                "WHERE (status = 'pending' OR (status = 'leased' AND lease_expires < ?)) AND attempts < ? "
+                "ORDER BY range_id LIMIT 1",
+                (now, self.max_attempts)
+            ).fetchone()
+            if row is not None:
+                self.conn.execute(
+                    "UPDATE ranges SET status = 'leased', worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE range_id = ?",
+                    (worker_id, now + self.lease_sec, row[0])
+                )
+            self.conn.execute("COMMIT")
+        except:
+            self.conn.execute("ROLLBACK")
+            raise
+        if row is None:
+            return None
+        return {"range_id": row[0], "start_idx": row[1], "num_prompts": row[2], "attempt": row[3] + 1}
+
+    def renew(self, range_id, worker_id, prompts_done=None):
+        """
+        Extend the lease on a range, returns False if the lease was lost to another worker.
+        """
+        cursor = self.conn.execute(
+            "UPDATE ranges SET lease_expires = ?, prompts_done = COALESCE(?, prompts_done) "
+            "WHERE range_id = ? AND worker = ? AND status = 'leased'",
+            (time.time() + self.lease_sec, prompts_done, range_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, range_id, worker_id, prompts_done):
+        cursor = self.conn.execute(
+            "UPDATE ranges SET status = 'done', prompts_done = ? WHERE range_id = ? AND worker = ? AND status = 'leased'",
+            (prompts_done, range_id, worker_id)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, range_id, worker_id, prompts_done):
+        """
+        Give an unfinished range back to the queue so it can be resumed, or fail it if out of attempts.
+        """
+        self.conn.execute(
+            "UPDATE ranges SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, "
+            "worker = NULL, lease_expires = NULL, prompts_done = ? "
+            "WHERE range_id = ? AND worker = ? AND status = 'leased'",
+            (self.max_attempts, prompts_done, range_id, worker_id)
+        )
+
+    def progress(self):
+        """
+        Aggregate progress over all ranges, keyed by range status.
+        """
+        progress = {
+            "total_prompts": 0,
+            "prompts_done": 0,
+            "ranges": {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        }
+        rows = self.conn.execute("SELECT status, COUNT(*), SUM(num_prompts), SUM(prompts_done) FROM ranges GROUP BY status")
+        for status, num_ranges, num_prompts, prompts_done in rows:
+            progress["ranges"][status] = num_ranges
+            progress["total_prompts"] += num_prompts
+            progress["prompts_done"] += prompts_done
+        return progress
+
+    def is_finished(self):
+        progress = self.progress()
+        return progress["ranges"]["pending"] == 0 and progress["ranges"]["leased"] == 0
+
+    def close(self):
+        self.conn.close()
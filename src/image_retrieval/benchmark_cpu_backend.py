@@ -0,0 +1,140 @@
+from datetime import datetime
+from loguru import logger
+from PIL import Image
+from src.data_generation.benchmark_pipeline import RESULTS_FOLDER, git_revision
+from src.image_retrieval.cpu_backend import CPUBackend, cpu_supports_bf16
+import argparse
+import clip
+import json
+import numpy as np
+import os
+import platform
+import sys
+import tempfile
+import time
+import torch
+
+# Name: (precision, through ONNX Runtime)
+BACKENDS = {
+    "fp32": ("fp32", False),
+    "bf16": ("bf16", False),
+    "int8": ("int8", False),
+    "onnx_fp32": ("fp32", True),
+    "onnx_int8": ("int8", True),
+}
+
+CATEGORIES = ["bar chart", "line chart", "pie chart", "table", "diagram", "map", "photo", "screenshot", "dog", "car"]
+
+def make_images(num_images, seed, size=(640, 480)):
+    """
+    Synthetic images: upscaled coarse color patterns plus noise, so they are not all alike.
+    """
+    rng = np.random.default_rng(seed)
+    images = []
+    for _ in range(num_images):
+        coarse = rng.integers(0, 256, size=(rng.integers(2, 9), rng.integers(2, 9), 3), dtype=np.uint8)
+        image = np.asarray(Image.fromarray(coarse).resize(size, Image.BICUBIC), dtype=np.int16)
+        image += rng.integers(-20, 21, size=image.shape, dtype=np.int16)
+        images.append(Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)))
+    return images
+
+def run_encoder(encode, inputs, batch_size):
+    """
+    Encode inputs in batches after one warm-up batch. Returns (embeddings, seconds).
+    """
+    encode(inputs[:batch_size])
+    start = time.perf_counter()
+    embeddings = torch.cat([encode(inputs[idx:idx + batch_size]) for idx in range(0, len(inputs), batch_size)])
+    return embeddings, time.perf_counter() - start
+
+def accuracy(embeddings, reference):
+    """
+    Cosine similarity of each embedding to its fp32 reference.
+    """
+    similarity = torch.nn.functional.cosine_similarity(embeddings.float(), reference, dim=-1)
+    return {"mean_cosine": similarity.mean().item(), "min_cosine": similarity.min().item()}
+
+def top1(image_embeddings, text_embeddings):
+    image_embeddings = image_embeddings / image_embeddings.norm(dim=-1, keepdim=True)
+    text_embeddings = text_embeddings / text_embeddings.norm(dim=-1, keepdim=True)
+    return (image_embeddings @ text_embeddings.T).argmax(dim=-1)
+
+def benchmark_backend(name, model, images, tokens, reference, args, onnx_folder):
+    precision, use_onnx = BACKENDS[name]
+    backend = CPUBackend(precision, args.num_threads, onnx_folder if use_onnx else "", args.model_name, logger)
+    prepared = backend.prepare(model)
+    encode_image = backend.encoder(prepared, "encode_image", [images[:1]])
+    encode_text = backend.encoder(prepared, "encode_text", [tokens[:1]])
+
+    image_embeddings, image_seconds = run_encoder(encode_image, images, args.batch_size)
+    text_embeddings, text_seconds = run_encoder(encode_text, tokens, args.batch_size)
+    result = {
+        # After fallbacks, e.g. bf16 runs fp32 on CPUs without native support
+        "precision": backend.precision,
+        "onnx": use_onnx,
+        "images_per_sec": len(images) / image_seconds,
+        "texts_per_sec": len(tokens) / text_seconds,
+        "image": accuracy(image_embeddings, reference["image"]),
+        "text": accuracy(text_embeddings, reference["text"]),
+        "top1_agreement": (top1(image_embeddings, text_embeddings) == reference["top1"]).float().mean().item(),
+    }
+    logger.info(f"{name}: {result['images_per_sec']:.1f} images/s, {result['texts_per_sec']:.1f} texts/s, "
+                f"image cosine {result['image']['mean_cosine']:.4f} (min {result['image']['min_cosine']:.4f}), "
+                f"top-1 agreement {result['top1_agreement']:.3f}")
+    return result
+
+def main(args):
+    logger.remove()
+    logger.add(sys.stderr, level="DEBUG" if args.debug else "INFO")
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
+    model, preprocess = clip.load(args.model_name, device="cpu")
+    model = model.float().eval()
+    # Decoding and preprocessing are not timed, only the encoders
+    images = torch.stack([preprocess(image) for image in make_images(args.num_images, args.seed)])
+    tokens = clip.tokenize([f"a photo of a {category}." for category in CATEGORIES])
+
+    logger.info("Computing fp32 reference embeddings")
+    with torch.inference_mode():
+        reference_image, _ = run_encoder(model.encode_image, images, args.batch_size)
+        reference_text, _ = run_encoder(model.encode_text, tokens, args.batch_size)
+    reference = {"image": reference_image.float(), "text": reference_text.float(), "top1": top1(reference_image.float(), reference_text.float())}
+
+    report = {
+        "revision": git_revision(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch": torch.__version__,
+        "torch_threads": torch.get_num_threads(),
+        "cpu_bf16": cpu_supports_bf16(),
+        "config": vars(args),
+        "backends": {}
+    }
+    with tempfile.TemporaryDirectory() as temp_folder:
+        onnx_folder = args.onnx_folder or temp_folder
+        for name in args.backends:
+            report["backends"][name] = benchmark_backend(name, model, images, tokens, reference, args, onnx_folder)
+
+    output_file = args.output_file or os.path.join(RESULTS_FOLDER, f"cpu_backend_{report['revision']}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output_file) or ".", exist_ok=True)
+    with open(output_file, "w") as file:
+        json.dump(report, file, indent=3)
+    logger.info(f"Saved results to {output_file}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the throughput and accuracy of the CPU backends of the CLIP encoders against fp32")
+    parser.add_argument("--model_name", type=str, default="ViT-B/32", help="CLIP model to benchmark")
+    parser.add_argument("--backends", type=str, nargs="+", default=["fp32", "bf16", "int8"], choices=list(BACKENDS), help="Backends to benchmark, onnx_* need onnx and onnxruntime")
+    parser.add_argument("--num_images", type=int, default=512, help="Synthetic images to encode")
+    parser.add_argument("--batch_size", type=int, default=64, help="Batch size of the encoders")
+    parser.add_argument("--num_threads", type=int, default=0, help="Threads of the encoders (0 for one per core)")
+    parser.add_argument("--onnx_folder", type=str, default="", help="Folder to keep ONNX exports in (defaults to a temporary folder)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the synthetic images")
+    parser.add_argument("--output_file", type=str, default="", help=f"Results file (defaults to {RESULTS_FOLDER}/cpu_backend_<revision>_<time>.json)")
+    parser.add_argument("--debug", action='store_true', help="Enable debug logging")
+
+    args = parser.parse_args()
+    main(args)
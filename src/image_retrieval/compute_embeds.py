@@ -1,85 +1,149 @@
-from PIL import Image
 from loguru import logger
-from torch.utils.data import Dataset, DataLoader
+from src.image_retrieval.cpu_backend import CPU_PRECISIONS, CPUBackend
+from src.image_retrieval.embedding_store import CHANGE_DETECTION, DEFAULT_DTYPE, DTYPES, EmbeddingStore, hash_file, is_store, is_unchanged, shard_folder
+from src.image_retrieval.image_discovery import discover_images
+from src.image_retrieval.image_loading import ImageDataset, collate_images
+from torch.utils.data import DataLoader
 from tqdm import tqdm
 import argparse
 import clip
-import numpy as np
 import os
 import sys
 import torch
 
-class ImageFolderDataset(Dataset):
-    def __init__(self, folder, transform):
+# Images that failed to load in the last run, usable as --file_list to retry them
+FAILED_FILE = "failed.txt"
+
+class ImageFolderDataset(ImageDataset):
+    def __init__(self, folder, transform, filenames=None, target_size=None):
+        """
+        :param filenames: Images to load, relative to folder. Defaults to all images under folder.
+        :param target_size: Input resolution of the model, images are decoded at reduced size for it.
+        """
+        if filenames is None:
+            filenames = [filename for filename, _ in discover_images(folder)]
+        super().__init__([os.path.join(folder, f) for f in filenames], transform, target_size, names=filenames)
         self.folder = folder
-        self.transform = transform
-        self.image_filenames = [
-            os.path.join(folder, f) for f in os.listdir(folder)
-            if f.endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif'))
-        ]
-
-    def __len__(self):
-        return len(self.image_filenames)
-
-    def __getitem__(self, idx):
-        img_path = self.image_filenames[idx]
-        try:
-            img = Image.open(img_path).convert("RGB")
-            return self.transform(img), os.path.basename(img_path)
-        except Exception as e:
-            logger.error(f"Failed to load image {img_path}: {e}")
-            return None, None  # Skip this image
-
-def save_embeddings(output_folder, batch_embeddings, batch_filenames, batch_index):
-    save_path = os.path.join(output_folder, f'embeddings_batch_{batch_index}.npy')
-    np.save(save_path, {"filenames": batch_filenames, "embeddings": batch_embeddings.cpu().numpy()})
-    logger.debug(f"Saved embeddings for {len(batch_filenames)} images to {save_path}")
+
+def save_embeddings(store, batch_embeddings, batch_filenames, batch_file_stats):
+    # Flushed every batch, an interrupted run resumes after the last one
+    store.append(batch_embeddings.cpu().numpy(), batch_filenames, batch_file_stats)
+    store.flush()
+    logger.debug(f"Saved embeddings for {len(batch_filenames)} images to {store.folder} ({len(store)} rows)")
+
+def open_store(args, store_folder, dim, filenames, file_stats):
+    """
+    Open the store in store_folder and tombstone the rows of images that were deleted or changed
+    since they were embedded, or create it. Returns it with the images still to embed.
+    """
+    if not is_store(store_folder) or args.recompute:
+        store = EmbeddingStore.create(store_folder, args.model_name, dim, args.dtype, capacity=len(filenames))
+        store.manifest.update({"shard_id": args.shard_id, "num_shards": args.num_shards})
+        return store, filenames
+
+    store = EmbeddingStore(store_folder, writable=True)
+    if store.model_name != args.model_name:
+        raise ValueError(f"Store in {store_folder} was computed with {store.model_name}, pass --recompute or use another output folder")
+    live_files = store.live_files()
+    todo_filenames = []
+    moved_rows, moved_stats = [], []
+    for filename in filenames:
+        if filename not in live_files:
+            todo_filenames.append(filename)
+            continue
+        row, recorded = live_files[filename]
+        current = file_stats[filename]
+        if not is_unchanged(recorded, current, os.path.join(args.image_folder, filename), args.change_detection):
+            todo_filenames.append(filename)
+        elif recorded.get("mtime") != current["mtime"]:
+            # Same content under a new mtime, record it so the next run does not hash the file again
+            moved_rows.append(row)
+            moved_stats.append({**current, "sha1": recorded["sha1"]})
+    store.update_file_stats(moved_rows, moved_stats)
+    todo = set(todo_filenames)
+    stale_rows = [row for filename, (row, _) in live_files.items() if filename not in file_stats or filename in todo]
+    store.tombstone(stale_rows)
+    store.reserve(store.num_rows + len(todo_filenames))
+    store.flush()
+    logger.info(f"Store has {len(live_files)} embedded images, {len(stale_rows)} deleted or changed since, {len(moved_rows)} unchanged under a new mtime, {len(todo_filenames)} to embed")
+    return store, todo_filenames
 
 def process_images(args):
     logger.info(f"Using device: {'cuda:' + str(args.gpu) if torch.cuda.is_available() else 'cpu'}")
     device = f"cuda:{args.gpu}" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load("ViT-B/32", device=device)
+    model, preprocess = clip.load(args.model_name, device=device)
+    encode_image = model.encode_image
+    if device == "cpu":
+        backend = CPUBackend(args.precision, args.num_threads, args.onnx_folder, args.model_name, logger)
+        model = backend.prepare(model)
+        resolution = model.visual.input_resolution
+        encode_image = backend.encoder(model, "encode_image", [torch.zeros(1, 3, resolution, resolution)])
 
     if not os.path.exists(args.output_folder):
         os.makedirs(args.output_folder)
         logger.info(f"Created output directory: {args.output_folder}")
 
-    dataset = ImageFolderDataset(args.image_folder, preprocess)
-    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4)
+    # Each shard of a sharded run has its own store, merged with embedding_store.py
+    store_folder = shard_folder(args.output_folder, args.shard_id, args.num_shards) if args.num_shards > 1 else args.output_folder
+    file_stats = dict(discover_images(args.image_folder, args.file_list, not args.no_recursive, args.shard_id, args.num_shards))
+    filenames = list(file_stats)
+    logger.info(f"Found {len(filenames)} images for shard {args.shard_id} of {args.num_shards} in {args.image_folder}")
+
+    # Only new and changed images are embedded, rows are preallocated for them
+    store, todo_filenames = open_store(args, store_folder, model.visual.output_dim, filenames, file_stats)
+
+    dataset = ImageFolderDataset(args.image_folder, preprocess, todo_filenames, target_size=model.visual.input_resolution)
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=False, num_workers=4, collate_fn=collate_images)
 
-    batch_index = 0
     logger.info(f"Starting embedding computation in batches of size {args.batch_size}")
 
-    for batch_images, batch_fnames in tqdm(dataloader, desc="Computing embeddings"):
-        valid_batch_images = []
-        valid_filenames = []
-        for img, fname in zip(batch_images, batch_fnames):
-            if img is not None:
-                valid_batch_images.append(img)
-                valid_filenames.append(fname)
-        
-        if not valid_batch_images:
+    failed_filenames = []
+    for batch_images, valid_filenames, batch_failed in tqdm(dataloader, desc="Computing embeddings"):
+        failed_filenames.extend(batch_failed)
+        if batch_images is None:
             continue  # Skip if no valid images in the batch
 
-        batch_images_tensor = torch.stack(valid_batch_images).to(device)
+        batch_images_tensor = batch_images.to(device)
 
         with torch.no_grad():
-            batch_embeddings = model.encode_image(batch_images_tensor)
+            batch_embeddings = encode_image(batch_images_tensor)
         
-        save_embeddings(args.output_folder, batch_embeddings, valid_filenames, batch_index)
-        batch_index += 1
-
-    logger.info("Embedding computation completed.")
+        batch_file_stats = [file_stats[filename] for filename in valid_filenames]
+        if args.change_detection == "hash":
+            for filename, stats in zip(valid_filenames, batch_file_stats):
+                stats["sha1"] = hash_file(os.path.join(args.image_folder, filename))
+        save_embeddings(store, batch_embeddings, valid_filenames, batch_file_stats)
+
+    store.close()
+    # Failed images are not stored, the next run tries them again
+    with open(os.path.join(store_folder, FAILED_FILE), "w") as file:
+        file.writelines(f"{filename}\n" for filename in failed_filenames)
+    if failed_filenames:
+        logger.warning(f"{len(failed_filenames)} images failed to load, see {os.path.join(store_folder, FAILED_FILE)}")
+    logger.info(f"Embedding computation completed, {len(store)} embeddings in {store_folder}")
 
 def main():
     parser = argparse.ArgumentParser(description="Compute and save CLIP embeddings for a folder of images.")
-    parser.add_argument('--image_folder', type=str, required=True, help="Path to the folder containing images.")
-    parser.add_argument('--output_folder', type=str, required=True, help="Output Folderto save the embeddings.")
+    parser.add_argument('--image_folder', type=str, required=True, help="Path to the folder containing images, searched recursively.")
+    parser.add_argument('--file_list', type=str, default="", help="File listing the images to embed, one path relative to image_folder per line, instead of searching it.")
+    parser.add_argument('--no_recursive', action='store_true', help="Only embed the images directly in image_folder.")
+    parser.add_argument('--shard_id', type=int, default=0, help="Shard of the images to embed, from a hash of their path.")
+    parser.add_argument('--num_shards', type=int, default=1, help="Number of shards the images are split into. Each shard writes a store in output_folder/shard_<id>_of_<num>.")
+    parser.add_argument('--output_folder', type=str, required=True, help="Output Folder to save the embedding store to.")
+    parser.add_argument('--model_name', type=str, default="ViT-B/32", help="CLIP model to embed with, recorded in the store.")
+    parser.add_argument('--dtype', type=str, choices=DTYPES, default=DEFAULT_DTYPE, help="Dtype the embeddings are stored as.")
+    parser.add_argument('--change_detection', type=str, choices=CHANGE_DETECTION, default="mtime", help="Re-embed images whose size or mtime changed, or only those whose content hash changed.")
+    parser.add_argument('--recompute', action='store_true', help="Recompute all embeddings instead of updating the existing store.")
     parser.add_argument('--batch_size', type=int, default=4096, help="Batch size for computing embeddings and saving them.")
     parser.add_argument('--gpu', type=int, default=0, help="GPU to use for computation.")
+    parser.add_argument('--precision', type=str, choices=CPU_PRECISIONS, default="fp32", help="Precision of the image encoder without a GPU.")
+    parser.add_argument('--num_threads', type=int, default=0, help="Threads of the image encoder without a GPU (0 for one per core).")
+    parser.add_argument('--onnx_folder', type=str, default="", help="Without a GPU, export the image encoder to ONNX under this folder and run it with ONNX Runtime.")
     parser.add_argument('--debug', action='store_true', help="Enable debug mode with detailed logging.")
 
     args = parser.parse_args()
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error(f"--shard_id must be in [0, {args.num_shards})")
 
     # Set logging level
     logger.remove()
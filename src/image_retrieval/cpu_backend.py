@@ -0,0 +1,119 @@
+from contextlib import nullcontext
+from loguru import logger as default_logger
+import os
+import re
+import torch
+
+CPU_PRECISIONS = ["fp32", "bf16", "int8"]
+
+# Without one of these, autocast emulates bf16 and runs slower than fp32
+BF16_CPU_FLAGS = ["avx512_bf16", "amx_bf16"]
+ONNX_OPSET = 17
+
+def cpu_supports_bf16():
+    try:
+        with open("/proc/cpuinfo", "r") as file:
+            flags = set(file.read().split())
+    except OSError:
+        return False
+    return any(flag in flags for flag in BF16_CPU_FLAGS)
+
+class Tower(torch.nn.Module):
+    """
+    One encoder of a CLIP model as a module, e.g. Tower(model, "encode_image"), so it can be run,
+    quantized or exported on its own.
+    """
+    def __init__(self, model, method):
+        super().__init__()
+        self.model = model
+        self.method = method
+
+    def forward(self, *inputs):
+        return getattr(self.model, self.method)(*inputs)
+
+class CPUBackend:
+    """
+    Runs the image and text encoders of a CLIP model on CPU:
+
+    - num_threads: intra-op threads of torch or ONNX Runtime, 0 keeps the default (one per core).
+    - precision: fp32, bf16 (autocast, only when the CPU supports bf16 natively, fp32 otherwise)
+      or int8 (dynamic quantization of the linear layers, which hold most of the weights and
+      compute of both transformers).
+    - onnx_folder: export each encoder to ONNX under it and run it with ONNX Runtime (onnx and
+      onnxruntime need to be installed). int8 quantizes the exported model, bf16 runs fp32.
+
+    Encoders take the same inputs as the model's methods and return fp32 embeddings on CPU.
+    """
+    def __init__(self, precision="fp32", num_threads=0, onnx_folder="", model_name="", logger=None):
+        self.logger = logger or default_logger
+        if precision == "bf16" and not cpu_supports_bf16():
+            self.logger.warning("CPU has no native bf16 support, running fp32")
+            precision = "fp32"
+        if precision == "bf16" and onnx_folder:
+            self.logger.warning("bf16 is not supported with ONNX Runtime, running fp32")
+            precision = "fp32"
+        self.precision = precision
+        self.num_threads = num_threads
+        # One folder per model, exports are reused by later runs
+        self.onnx_folder = os.path.join(onnx_folder, re.sub(r"[^\w.-]", "_", model_name)) if onnx_folder else ""
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+    def prepare(self, model):
+        """
+        The model to take encoders from: fp32 in eval mode, with dynamically quantized linear layers
+        for int8 (ONNX exports are quantized after export instead).
+        """
+        model = model.float().eval()
+        if self.precision == "int8" and not self.onnx_folder:
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        return model
+
+    def encoder(self, model, method, example_inputs=None):
+        """
+        Callable running model.<method> (e.g. encode_image, or get_image_features of transformers
+        models) with this backend. example_inputs, a batch of inputs, are needed to export to ONNX.
+        """
+        if self.onnx_folder:
+            return self.onnx_encoder(model, method, example_inputs)
+        tower = Tower(model, method)
+
+        def encode(*inputs):
+            autocast = torch.autocast("cpu", dtype=torch.bfloat16) if self.precision == "bf16" else nullcontext()
+            with torch.inference_mode(), autocast:
+                return tower(*inputs).float()
+        return encode
+
+    def onnx_encoder(self, model, method, example_inputs):
+        import onnxruntime
+
+        os.makedirs(self.onnx_folder, exist_ok=True)
+        path = os.path.join(self.onnx_folder, f"{method}.onnx")
+        if not os.path.exists(path):
+            self.logger.info(f"Exporting {method} to {path}")
+            input_names = [f"input_{idx}" for idx in range(len(example_inputs))]
+            dynamic_axes = {name: {0: "batch"} for name in input_names + ["embeddings"]}
+            # Token ids and attention masks, padded to the longest text of each batch
+            for name, value in zip(input_names, example_inputs):
+                if value.dim() == 2:
+                    dynamic_axes[name][1] = "sequence"
+            with torch.no_grad():
+                torch.onnx.export(Tower(model, method), tuple(example_inputs), path, input_names=input_names, output_names=["embeddings"], dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET)
+        if self.precision == "int8":
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            int8_path = os.path.join(self.onnx_folder, f"{method}.int8.onnx")
+            if not os.path.exists(int8_path):
+                quantize_dynamic(path, int8_path, weight_type=QuantType.QInt8)
+            path = int8_path
+
+        options = onnxruntime.SessionOptions()
+        if self.num_threads:
+            options.intra_op_num_threads = self.num_threads
+        session = onnxruntime.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        input_names = [session_input.name for session_input in session.get_inputs()]
+
+        def encode(*inputs):
+            outputs = session.run(None, {name: value.cpu().numpy() for name, value in zip(input_names, inputs)})
+            return torch.from_numpy(outputs[0]).float()
+        return encode
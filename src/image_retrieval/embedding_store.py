@@ -0,0 +1,378 @@
+from glob import glob
+from loguru import logger
+import argparse
+import hashlib
+import json
+import numpy as np
+import os
+import re
+import sys
+
+# Files of a store folder
+EMBEDDINGS_FILE = "embeddings.npy"
+FILENAMES_FILE = "filenames.txt"
+FILES_FILE = "files.jsonl"
+TOMBSTONES_FILE = "tombstones.txt"
+STATS_UPDATES_FILE = "stats_updates.jsonl"
+MANIFEST_FILE = "manifest.json"
+
+DTYPES = ["float16", "float32"]
+DEFAULT_DTYPE = "float16"
+MIN_CAPACITY = 1024
+MERGE_CHUNK_ROWS = 65536
+
+# compute_embeds.py wrote one pickled {"filenames", "embeddings"} dict per batch before stores
+BATCH_FILE_PATTERN = re.compile(r"embeddings_batch_(\d+)\.npy$")
+BATCH_FILE_MODEL_NAME = "ViT-B/32"
+
+# How incremental runs decide a file changed since its row was written
+CHANGE_DETECTION = ["mtime", "hash"]
+HASH_CHUNK_BYTES = 1 << 20
+
+def shard_folder(output_folder, shard_id, num_shards):
+    return os.path.join(output_folder, f"shard_{shard_id:05d}_of_{num_shards:05d}")
+
+def is_store(folder):
+    return os.path.exists(os.path.join(folder, MANIFEST_FILE))
+
+def truncate_lines(path, num_lines, padding=None):
+    """
+    Cut a line based file after num_lines lines. Shorter files are padded with the padding line,
+    e.g. the files.jsonl of stores written before it existed.
+    """
+    size = 0
+    num_kept = 0
+    if os.path.exists(path):
+        with open(path, "rb") as file:
+            for line in file:
+                if num_kept == num_lines:
+                    break
+                size += len(line)
+                num_kept += 1
+        os.truncate(path, size)
+    if num_kept < num_lines and padding is not None:
+        with open(path, "ab") as file:
+            file.write(padding * (num_lines - num_kept))
+
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_BYTES), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def stat_file(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def is_unchanged(recorded, current, path, change_detection="mtime"):
+    """
+    Whether a file with current stats is the one its row was computed from. With hash change
+    detection, files whose mtime moved (e.g. copied pools) are hashed, and unchanged if the
+    content hash matches.
+    """
+    if recorded.get("size") != current["size"]:
+        return False
+    if recorded.get("mtime") == current["mtime"]:
+        return True
+    return change_detection == "hash" and "sha1" in recorded and recorded["sha1"] == hash_file(path)
+
+def write_json_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as file:
+        json.dump(data, file, indent=3)
+    os.replace(tmp_path, path)
+
+class EmbeddingStore:
+    """
+    Embeddings of a folder of images, stored as one preallocated .npy matrix that is memory mapped,
+    a filename index (row i of the matrix is line i of filenames.txt) and a manifest with the model
+    name, dimension, dtype and number of rows.
+
+    Only the first num_rows rows hold embeddings, the rest is preallocated space that appends fill.
+    The manifest is written last on flush(), so after a crash a store opens with the rows of its
+    last flush and ignores anything written after it.
+
+    Rows are never rewritten. Each row also records the size, mtime and optionally content hash of
+    its file (files.jsonl), so incremental runs can tell which files changed. The rows of files that
+    were deleted or changed are tombstoned (tombstones.txt) and skipped by batches(). Rows kept for
+    files that only moved (e.g. copied, with a new mtime but the same hash) get their new stats
+    appended to stats_updates.jsonl, which file_stats() applies over files.jsonl.
+
+    Opened read only, embeddings is a memory map: slicing it only reads the rows that are used, so
+    stores with millions of rows open instantly and are never copied in full.
+    """
+    def __init__(self, folder, writable=False):
+        self.folder = folder
+        self.writable = writable
+        with open(os.path.join(folder, MANIFEST_FILE), "r") as file:
+            self.manifest = json.load(file)
+        self.num_rows = self.manifest["num_rows"]
+        self.matrix = np.load(os.path.join(folder, EMBEDDINGS_FILE), mmap_mode="r+" if writable else "r")
+        with open(os.path.join(folder, FILENAMES_FILE), "r") as file:
+            # Lines after num_rows were appended after the last flush
+            self.filenames = file.read().splitlines()[:self.num_rows]
+        if len(self.filenames) < self.num_rows:
+            raise ValueError(f"{folder} has {self.num_rows} rows but only {len(self.filenames)} filenames")
+        num_tombstones = self.manifest.get("num_tombstones", 0)
+        tombstones_path = os.path.join(folder, TOMBSTONES_FILE)
+        self.tombstones = set()
+        if num_tombstones:
+            with open(tombstones_path, "r") as file:
+                self.tombstones = set(int(line) for line in file.read().split()[:num_tombstones])
+        self.num_stats_updates = self.manifest.get("num_stats_updates", 0)
+        self.stats = None
+        self.filenames_file = self.files_file = self.tombstones_file = self.stats_updates_file = None
+        if writable:
+            # Drop what was written after the last flush, so appends line up with the rows again
+            truncate_lines(os.path.join(folder, FILENAMES_FILE), self.num_rows)
+            truncate_lines(os.path.join(folder, FILES_FILE), self.num_rows, padding=b"{}\n")
+            truncate_lines(tombstones_path, num_tombstones)
+            truncate_lines(os.path.join(folder, STATS_UPDATES_FILE), self.num_stats_updates)
+            self.filenames_file = open(os.path.join(folder, FILENAMES_FILE), "a")
+            self.files_file = open(os.path.join(folder, FILES_FILE), "a")
+            self.tombstones_file = open(tombstones_path, "a")
+            self.stats_updates_file = open(os.path.join(folder, STATS_UPDATES_FILE), "a")
+
+    @classmethod
+    def create(cls, folder, model_name, dim, dtype=DEFAULT_DTYPE, capacity=MIN_CAPACITY):
+        """
+        Create an empty store with room for capacity rows, replacing any store in folder.
+        """
+        os.makedirs(folder, exist_ok=True)
+        matrix = np.lib.format.open_memmap(os.path.join(folder, EMBEDDINGS_FILE), mode="w+", dtype=dtype, shape=(max(capacity, 1), dim))
+        del matrix
+        for name in [FILENAMES_FILE, FILES_FILE, TOMBSTONES_FILE, STATS_UPDATES_FILE]:
+            open(os.path.join(folder, name), "w").close()
+        write_json_atomic(os.path.join(folder, MANIFEST_FILE), {"model_name": model_name, "dim": dim, "dtype": dtype, "num_rows": 0, "num_tombstones": 0})
+        return cls(folder, writable=True)
+
+    @property
+    def model_name(self):
+        return self.manifest["model_name"]
+
+    @property
+    def dim(self):
+        return self.manifest["dim"]
+
+    @property
+    def embeddings(self):
+        """
+        The (num_rows, dim) embeddings, a view on the memory map.
+        """
+        return self.matrix[:self.num_rows]
+
+    def __len__(self):
+        """
+        Number of live (not tombstoned) rows.
+        """
+        return self.num_rows - len(self.tombstones)
+
+    def live_rows(self):
+        if not self.tombstones:
+            return np.arange(self.num_rows)
+        live = np.ones(self.num_rows, dtype=bool)
+        live[np.fromiter(self.tombstones, dtype=np.int64)] = False
+        return np.flatnonzero(live)
+
+    def batches(self, batch_size):
+        """
+        Yield (embeddings, filenames) for the live rows in order, reading batch_size rows at a time.
+        """
+        if not self.tombstones:
+            for start_idx in range(0, self.num_rows, batch_size):
+                yield self.embeddings[start_idx:start_idx + batch_size], self.filenames[start_idx:start_idx + batch_size]
+            return
+        live_rows = self.live_rows()
+        for start_idx in range(0, len(live_rows), batch_size):
+            rows = live_rows[start_idx:start_idx + batch_size]
+            yield self.matrix[rows], [self.filenames[row] for row in rows.tolist()]
+
+    def file_stats(self):
+        """
+        Size, mtime and hash recorded for the file of each row, {} if unknown.
+        """
+        if self.stats is None:
+            self.stats = []
+            if self.writable:
+                self.files_file.flush()
+                self.stats_updates_file.flush()
+            if os.path.exists(os.path.join(self.folder, FILES_FILE)):
+                with open(os.path.join(self.folder, FILES_FILE), "r") as file:
+                    self.stats = [json.loads(line) for _, line in zip(range(self.num_rows), file)]
+            self.stats.extend({} for _ in range(self.num_rows - len(self.stats)))
+            if self.num_stats_updates:
+                with open(os.path.join(self.folder, STATS_UPDATES_FILE), "r") as file:
+                    for _, line in zip(range(self.num_stats_updates), file):
+                        update = json.loads(line)
+                        self.stats[update.pop("row")] = update
+        return self.stats
+
+    def update_file_stats(self, rows, file_stats):
+        """
+        Replace the recorded stats of the files of rows, e.g. after they were copied without
+        changing. Like appends, this is only persisted by flush().
+        """
+        if not self.writable:
+            raise ValueError(f"Store {self.folder} was opened read only")
+        stats = self.file_stats()
+        for row, row_stats in zip(rows, file_stats):
+            self.stats_updates_file.write(json.dumps({"row": row, **row_stats}, separators=(",", ":")) + "\n")
+            stats[row] = row_stats
+        self.num_stats_updates += len(rows)
+
+    def live_files(self):
+        """
+        Live row and recorded stats of each file, by filename.
+        """
+        stats = self.file_stats()
+        return {self.filenames[row]: (row, stats[row]) for row in self.live_rows().tolist()}
+
+    def tombstone(self, rows):
+        """
+        Mark rows as deleted. Like appends, this is only persisted by flush().
+        """
+        rows = [row for row in rows if row not in self.tombstones]
+        self.tombstones.update(rows)
+        self.tombstones_file.writelines(f"{row}\n" for row in rows)
+
+    def reserve(self, capacity):
+        """
+        Grow the preallocated matrix to at least capacity rows, doubling it to amortize copies.
+        """
+        if capacity <= len(self.matrix):
+            return
+        capacity = max(capacity, 2 * len(self.matrix), MIN_CAPACITY)
+        path = os.path.join(self.folder, EMBEDDINGS_FILE)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        matrix = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.matrix.dtype, shape=(capacity, self.dim))
+        matrix[:self.num_rows] = self.matrix[:self.num_rows]
+        matrix.flush()
+        del matrix
+        self.matrix = None
+        os.replace(tmp_path, path)
+        self.matrix = np.load(path, mmap_mode="r+")
+
+    def append(self, embeddings, filenames, file_stats=None):
+        """
+        Append rows, with the stats of their files if known. They are only part of the store once
+        flushed.
+        """
+        if not self.writable:
+            raise ValueError(f"Store {self.folder} was opened read only")
+        embeddings = np.asarray(embeddings)
+        if embeddings.shape != (len(filenames), self.dim):
+            raise ValueError(f"Expected embeddings of shape ({len(filenames)}, {self.dim}), got {embeddings.shape}")
+        self.reserve(self.num_rows + len(filenames))
+        self.matrix[self.num_rows:self.num_rows + len(filenames)] = embeddings
+        self.filenames_file.writelines(f"{filename}\n" for filename in filenames)
+        file_stats = file_stats or [{} for _ in filenames]
+        self.files_file.writelines(json.dumps(stats, separators=(",", ":")) + "\n" for stats in file_stats)
+        if self.stats is not None:
+            self.stats.extend(file_stats)
+        self.filenames.extend(filenames)
+        self.num_rows += len(filenames)
+
+    def flush(self):
+        self.matrix.flush()
+        for file in [self.filenames_file, self.files_file, self.tombstones_file, self.stats_updates_file]:
+            file.flush()
+            os.fsync(file.fileno())
+        self.manifest["num_rows"] = self.num_rows
+        self.manifest["num_tombstones"] = len(self.tombstones)
+        self.manifest["num_stats_updates"] = self.num_stats_updates
+        write_json_atomic(os.path.join(self.folder, MANIFEST_FILE), self.manifest)
+
+    def close(self):
+        if self.writable:
+            self.flush()
+            for file in [self.filenames_file, self.files_file, self.tombstones_file, self.stats_updates_file]:
+                file.close()
+        self.matrix = None
+
+def import_batch_files(folder, dtype=DEFAULT_DTYPE):
+    """
+    Build a store in folder from the embeddings_batch_<i>.npy files written by earlier versions of
+    compute_embeds.py, in batch order. Returns the store, open read only.
+    """
+    paths = sorted(glob(os.path.join(folder, "embeddings_batch_*.npy")), key=lambda path: int(BATCH_FILE_PATTERN.search(path).group(1)))
+    if not paths:
+        raise FileNotFoundError(f"No embedding store or batch files in {folder}")
+    store = None
+    for path in paths:
+        data = np.load(path, allow_pickle=True).item()
+        if store is None:
+            store = EmbeddingStore.create(folder, BATCH_FILE_MODEL_NAME, data["embeddings"].shape[1], dtype, capacity=len(paths) * len(data["filenames"]))
+        store.append(data["embeddings"], data["filenames"])
+    store.close()
+    return EmbeddingStore(folder)
+
+def merge_sources(folders, output_folder):
+    """
+    State of the stores merged into output_folder. Rows are only ever appended, tombstoned or given
+    new file stats, so these counts tell whether they changed since the merge.
+    """
+    sources = []
+    for folder in folders:
+        with open(os.path.join(folder, MANIFEST_FILE), "r") as file:
+            manifest = json.load(file)
+        sources.append({
+            "folder": os.path.relpath(folder, output_folder),
+            "model_name": manifest["model_name"],
+            "num_rows": manifest["num_rows"],
+            "num_tombstones": manifest.get("num_tombstones", 0),
+            "num_stats_updates": manifest.get("num_stats_updates", 0)
+        })
+    return sources
+
+def is_merge_current(output_folder, folders):
+    """
+    Whether output_folder holds a merge of folders that is up to date with them.
+    """
+    if not is_store(output_folder):
+        return False
+    with open(os.path.join(output_folder, MANIFEST_FILE), "r") as file:
+        manifest = json.load(file)
+    return manifest.get("merged_from") == merge_sources(folders, output_folder)
+
+def merge_stores(folders, output_folder):
+    """
+    Merge the live rows of stores, e.g. the shards of a sharded compute_embeds run, into a new
+    store in output_folder, in folder order. File stats are kept, so the merged store can be
+    updated incrementally. Returns the merged store, open read only.
+    """
+    # Recorded before reading the stores, so rows added during the merge make it stale
+    sources = merge_sources(folders, output_folder)
+    stores = [EmbeddingStore(folder) for folder in folders]
+    for store in stores[1:]:
+        for key in ["model_name", "dim", "dtype"]:
+            if store.manifest[key] != stores[0].manifest[key]:
+                raise ValueError(f"Cannot merge {store.folder} ({key} {store.manifest[key]}) with {stores[0].folder} ({key} {stores[0].manifest[key]})")
+
+    merged = EmbeddingStore.create(output_folder, stores[0].model_name, stores[0].dim, stores[0].manifest["dtype"], capacity=sum(len(store) for store in stores))
+    for store in stores:
+        stats = store.file_stats()
+        live_rows = store.live_rows()
+        # Chunks bound memory whatever the size of the shards
+        for start_idx in range(0, len(live_rows), MERGE_CHUNK_ROWS):
+            rows = live_rows[start_idx:start_idx + MERGE_CHUNK_ROWS]
+            merged.append(store.matrix[rows], [store.filenames[row] for row in rows.tolist()], [stats[row] for row in rows.tolist()])
+        merged.flush()
+        logger.info(f"Merged {len(live_rows)} rows from {store.folder}")
+    merged.manifest["merged_from"] = sources
+    merged.close()
+    return EmbeddingStore(output_folder)
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge embedding stores, e.g. the shards written by compute_embeds.py --num_shards.")
+    parser.add_argument('--stores', type=str, nargs='+', required=True, help="Store folders to merge, in order.")
+    parser.add_argument('--output_folder', type=str, required=True, help="Folder of the merged store.")
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="INFO")
+    merged = merge_stores(args.stores, args.output_folder)
+    logger.info(f"Merged {len(merged)} embeddings from {len(args.stores)} stores into {args.output_folder}")
+
+if __name__ == "__main__":
+    main()
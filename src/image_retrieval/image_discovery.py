@@ -0,0 +1,68 @@
+from loguru import logger
+import os
+import zlib
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+def is_image_filename(filename):
+    return filename.lower().endswith(IMAGE_EXTENSIONS)
+
+def entry_stats(stat):
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+
+def scan_images(folder, recursive=True):
+    """
+    Yield (path relative to folder, stats) of the images under folder, streaming one directory at
+    a time. Entries are visited in sorted order, so the order is the same on every run. Symlinked
+    directories are not followed.
+    """
+    pending = [""]
+    while pending:
+        relative_dir = pending.pop()
+        with os.scandir(os.path.join(folder, relative_dir)) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        subdirs = []
+        for entry in entries:
+            relative_path = os.path.join(relative_dir, entry.name)
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(relative_path)
+                elif is_image_filename(entry.name) and entry.is_file():
+                    yield relative_path, entry_stats(entry.stat())
+            except OSError as e:
+                logger.error(f"Failed to read {os.path.join(folder, relative_path)}: {e}")
+        if recursive:
+            # Depth first, in sorted order
+            pending.extend(reversed(subdirs))
+
+def read_file_list(folder, file_list):
+    """
+    Yield (path, stats) of the images listed in file_list, one path relative to folder per line.
+    Missing files are logged and skipped.
+    """
+    with open(file_list, "r") as file:
+        for line in file:
+            relative_path = line.strip()
+            if not relative_path:
+                continue
+            try:
+                yield relative_path, entry_stats(os.stat(os.path.join(folder, relative_path)))
+            except OSError as e:
+                logger.error(f"Skipping {relative_path} from {file_list}: {e}")
+
+def shard_of(relative_path, num_shards):
+    """
+    Shard of an image, from a hash of its relative path. Stable across runs, machines and changes
+    to the rest of the pool, so incremental runs of a shard see the same images.
+    """
+    return zlib.crc32(relative_path.encode("utf-8")) % num_shards
+
+def discover_images(folder, file_list=None, recursive=True, shard_id=0, num_shards=1):
+    """
+    Yield (path relative to folder, stats) of the images of shard_id, from file_list if given,
+    otherwise from scanning folder.
+    """
+    images = read_file_list(folder, file_list) if file_list else scan_images(folder, recursive)
+    for relative_path, stats in images:
+        if num_shards == 1 or shard_of(relative_path, num_shards) == shard_id:
+            yield relative_path, stats
@@ -0,0 +1,67 @@
+from PIL import Image
+from loguru import logger
+from torch.utils.data import Dataset
+import torch
+
+# Modes Image.reduce works on directly, and whose conversion to RGB commutes with it
+REDUCE_MODES = ("RGB", "L")
+
+def load_image(path, target_size=None):
+    """
+    Open an image as RGB. With target_size, large images are decoded at reduced size while keeping
+    their shorter side at least target_size, so a following resize to target_size gives nearly the
+    same pixels: JPEGs through draft mode, which scales by 1/2, 1/4 or 1/8 while decoding, other
+    formats with a box reduce by an integer factor right after decoding.
+    """
+    with Image.open(path) as img:
+        if target_size:
+            # No-op for formats other than JPEG
+            img.draft("RGB", (target_size, target_size))
+            factor = min(img.size) // target_size
+            if factor >= 2:
+                # reduce only supports some modes (not e.g. P, 1 or I;16)
+                if img.mode not in REDUCE_MODES:
+                    img = img.convert("RGB")
+                return img.reduce(factor).convert("RGB")
+        return img.convert("RGB")
+
+class ImageDataset(Dataset):
+    """
+    Images at paths, loaded at reduced size (see load_image) and transformed. Items are
+    (image, name), with image None when the file could not be loaded: use collate_images to drop
+    those from batches.
+    """
+    def __init__(self, paths, transform=None, target_size=None, names=None):
+        """
+        :param names: Identifies each image in batches, defaults to its path.
+        """
+        self.paths = paths
+        self.transform = transform
+        self.target_size = target_size
+        self.names = names if names is not None else paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        try:
+            img = load_image(self.paths[idx], self.target_size)
+            return (self.transform(img) if self.transform is not None else img), self.names[idx]
+        except Exception as e:
+            logger.error(f"Failed to load image {self.paths[idx]}: {e}")
+            return None, self.names[idx]
+
+def collate_images(batch):
+    """
+    Collate (image, name) items into (images, names, failed_names), dropping the images that
+    failed to load. Tensors are stacked, other images (e.g. PIL images) are returned as a list.
+    images is None if every image of the batch failed.
+    """
+    loaded = [(image, name) for image, name in batch if image is not None]
+    failed_names = [name for image, name in batch if image is None]
+    if not loaded:
+        return None, [], failed_names
+    images = [image for image, _ in loaded]
+    if isinstance(images[0], torch.Tensor):
+        images = torch.stack(images)
+    return images, [name for _, name in loaded], failed_names
@@ -1,7 +1,11 @@
 from loguru import logger
+from glob import glob
+from src.image_retrieval.cpu_backend import CPU_PRECISIONS, CPUBackend
+from src.image_retrieval.embedding_store import EmbeddingStore, import_batch_files, is_merge_current, is_store, merge_stores
 from tqdm import tqdm
 import clip
 import json
+import math
 import numpy as np
 import os
 import sys
@@ -29,27 +33,29 @@ IMAGENET_TEMPLATES = [
 ]
 
 def load_embeddings(embeddings_folder):
-    """Load precomputed embeddings from folder."""
-    embeddings = []
-    filenames = []
-
-    for file in os.listdir(embeddings_folder):
-        if file.endswith('.npy'):
-            data = np.load(os.path.join(embeddings_folder, file), allow_pickle=True).item()
-            embeddings.append(torch.tensor(data['embeddings']))
-            filenames.extend(data['filenames'])
+    """Open the embedding store in folder, memory mapped. Shard stores, whenever they changed since they were last merged, or per-batch files of older runs are merged into a store first."""
+    shard_folders = sorted(glob(os.path.join(embeddings_folder, "shard_*_of_*")))
+    if shard_folders and not is_merge_current(embeddings_folder, shard_folders):
+        logger.info(f"Merging {len(shard_folders)} shard stores in {embeddings_folder}")
+        store = merge_stores(shard_folders, embeddings_folder)
+    elif is_store(embeddings_folder):
+        store = EmbeddingStore(embeddings_folder)
+    else:
+        logger.warning(f"No embedding store in {embeddings_folder}, importing its embedding batch files")
+        store = import_batch_files(embeddings_folder)
 
-    logger.info(f"Loaded {len(filenames)} images from {embeddings_folder}")
-    return torch.cat(embeddings), filenames
+    logger.info(f"Loaded {len(store)} images from {embeddings_folder}")
+    return store
 
-def create_text_embeddings(model, categories, device):
+def create_text_embeddings(model, categories, device, encode_text=None):
     """Create text embeddings using CLIP templates and categories."""
+    encode_text = encode_text or model.encode_text
     text_embeddings = []
     for category in categories:
         texts = [template.format(category) for template in IMAGENET_TEMPLATES]
         text_tokens = clip.tokenize(texts).to(device)
         with torch.no_grad():
-            text_embedding = model.encode_text(text_tokens).mean(dim=0)
+            text_embedding = encode_text(text_tokens).mean(dim=0)
             text_embedding /= text_embedding.norm()
         text_embeddings.append(text_embedding)
     return torch.stack(text_embeddings)
@@ -63,10 +69,15 @@ def zero_shot_classification_batch(image_embeddings_batch, text_embeddings):
 
 def process_images(args):
     device = f"cuda:{args.gpu}" if torch.cuda.is_available() else "cpu"
-    model, _ = clip.load("ViT-B/32", device=device)
 
-    # Load embeddings
-    image_embeddings, filenames = load_embeddings(args.embeddings_folder)
+    # Load embeddings, and the model that computed them
+    store = load_embeddings(args.embeddings_folder)
+    model, _ = clip.load(store.model_name, device=device)
+    encode_text = model.encode_text
+    if device == "cpu":
+        backend = CPUBackend(args.precision, args.num_threads, args.onnx_folder, store.model_name, logger)
+        model = backend.prepare(model)
+        encode_text = backend.encoder(model, "encode_text", [clip.tokenize(IMAGENET_TEMPLATES[:1])])
 
     # Load keywords from JSON file
     with open(args.json_file, 'r') as f:
@@ -77,16 +88,16 @@ def process_images(args):
 
     # Create text embeddings
     logger.info("Creating text embeddings using CLIP templates...")
-    text_embeddings = create_text_embeddings(model, categories, device).to(device)
+    text_embeddings = create_text_embeddings(model, categories, device, encode_text).to(device)
 
     # Initialize classification results dictionary
     classification_results = {category: [] for category in categories}
 
     # Process in batches
     logger.info(f"Performing zero-shot classification in batches of size {args.batch_size}")
-    for i in tqdm(range(0, len(image_embeddings), args.batch_size), desc="Classifying images"):
-        batch_embeddings = image_embeddings[i:i + args.batch_size].to(device)
-        batch_filenames = filenames[i:i + args.batch_size]
+    for batch_embeddings, batch_filenames in tqdm(store.batches(args.batch_size), total=math.ceil(len(store) / args.batch_size), desc="Classifying images"):
+        # Only this batch is read from the memory map
+        batch_embeddings = torch.from_numpy(np.array(batch_embeddings)).to(device=device, dtype=text_embeddings.dtype)
 
         # Perform zero-shot classification
         probs = zero_shot_classification_batch(batch_embeddings, text_embeddings)
@@ -106,11 +117,14 @@ def process_images(args):
 def main():
     import argparse
     parser = argparse.ArgumentParser(description="Perform zero-shot classification on precomputed CLIP embeddings.")
-    parser.add_argument('--embeddings_folder', type=str, required=True, help="Folder containing precomputed image embeddings.")
+    parser.add_argument('--embeddings_folder', type=str, required=True, help="Embedding store written by compute_embeds.py.")
     parser.add_argument('--json_file', type=str, required=True, help="JSON file containing the 'keywords_to_partition' key.")
     parser.add_argument('--output_file', type=str, required=True, help="Name of the output JSON file.")
     parser.add_argument('--batch_size', type=int, default=32, help="Batch size for classification.")
     parser.add_argument('--gpu', type=int, default=0, help="GPU to use for computation.")
+    parser.add_argument('--precision', type=str, choices=CPU_PRECISIONS, default="fp32", help="Precision of the text encoder without a GPU.")
+    parser.add_argument('--num_threads', type=int, default=0, help="Threads of the text encoder without a GPU (0 for one per core).")
+    parser.add_argument('--onnx_folder', type=str, default="", help="Without a GPU, export the text encoder to ONNX under this folder and run it with ONNX Runtime.")
     parser.add_argument('--debug', action='store_true', help="Enable debug mode with detailed logging.")
 
     args = parser.parse_args()